@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Exports the events database content to a local archive, usable by the ``archive`` event source
+for replaying historical data (see pycstbox.performer.commons.sources).
+"""
+
+import sys
+import datetime
+from argparse import ArgumentTypeError
+
+from pycstbox import log
+from pycstbox.cli import get_argument_parser
+from pycstbox.performer.commons.sources import FsysEventSource, export_archive
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+if __name__ == '__main__':
+    parser = get_argument_parser("PERFORMER events archive export")
+
+    def _valid_iso_date(s):
+        try:
+            d = datetime.datetime.strptime(s, '%Y-%m-%d').date()
+        except ValueError:
+            raise ArgumentTypeError('invalid date : %s' % s)
+        else:
+            return d
+
+    parser.add_argument('archive_path', help='the path of the archive directory')
+    parser.add_argument('first_day', type=_valid_iso_date, help='first exported day, in ISO format')
+    parser.add_argument('last_day', type=_valid_iso_date, help='last exported day (included), in ISO format')
+    parser.add_argument(
+        '--var',
+        dest='var_names',
+        action='append',
+        help='name of an exported variable (can be repeated, default: all variables)'
+    )
+
+    args = parser.parse_args()
+
+    logger = log.getLogger('events-export')
+    log.set_loglevel_from_args(logger, args)
+
+    if args.last_day < args.first_day:
+        sys.exit('days out of sequence')
+
+    try:
+        count = export_archive(
+            FsysEventSource(day_cache_dir=None, logger=logger),
+            args.archive_path, args.first_day, args.last_day, args.var_names
+        )
+    except (ValueError, EnvironmentError) as e:
+        logger.fatal(e)
+        sys.exit(str(e))
+    else:
+        logger.info('%d day(s) exported to %s', count, args.archive_path)
@@ -28,6 +28,14 @@ if __name__ == '__main__':
         type=valid_period_name
     )
 
+    parser.add_argument(
+        '--refresh-cache',
+        dest='refresh_cache',
+        action='store_true',
+        help='materialize again the cached days used by the computation and clear the cached intermediate '
+             'results (after events database changes)'
+    )
+
     add_config_file_option_to_parser(parser, dflt_name='analytics.cfg', must_exist=True)
 
     def _valid_iso_date(s):
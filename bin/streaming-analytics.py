@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Maintains the running state of the streaming capable indicators from the live sensor events, so that
+the periodic analytics can produce them at period end without reading the whole period events again
+(see pycstbox.performer.commons.streaming).
+"""
+
+import sys
+from argparse import ArgumentTypeError
+
+from pycstbox import log
+from pycstbox.cli import get_argument_parser, add_config_file_option_to_parser
+from pycstbox.performer.commons.analytics import PeriodicAnalyzer
+from pycstbox.performer.commons.runner import Runner
+from pycstbox.performer.commons.streaming import StreamingRunner
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+if __name__ == '__main__':
+    parser = get_argument_parser("PERFORMER streaming analytics")
+
+    def valid_period_name(s):
+        if s not in PeriodicAnalyzer.PERIOD_NAMES:
+            raise ArgumentTypeError()
+        return s
+
+    parser.add_argument(
+        '-p', '--period',
+        dest='period',
+        help='tracked periodicity [choices: %s]' % '|'.join(PeriodicAnalyzer.PERIOD_NAMES),
+        default=PeriodicAnalyzer.PERIOD_NAMES[PeriodicAnalyzer.PERIOD_DAY],
+        type=valid_period_name
+    )
+
+    parser.add_argument(
+        '--checkpoint-period',
+        dest='checkpoint_period',
+        type=int,
+        default=300,
+        help='period (in seconds) of the states checkpoints'
+    )
+
+    add_config_file_option_to_parser(parser, dflt_name='analytics.cfg', must_exist=True)
+
+    args = parser.parse_args()
+
+    logger = log.getLogger('analytics-streaming-%s' % args.period)
+    log.set_loglevel_from_args(logger, args)
+
+    try:
+        runner = Runner(
+            config_path=args.config_path, period=PeriodicAnalyzer.period_name_to_id(args.period), logger=logger
+        )
+        StreamingRunner([runner], checkpoint_period=args.checkpoint_period, logger=logger).run()
+    except Exception as e:
+        logger.fatal(e)
+        sys.exit(str(e))
@@ -5,9 +5,17 @@
 
 import logging
 import os
+import datetime
+import multiprocessing
+import cPickle as pickle
 
 import arrow
 
+from pycstbox.performer.commons.metrics import run_metrics
+from pycstbox.performer.commons.memory import MemoryBudget
+from pycstbox.performer.commons.resultcache import ResultCache, params_hash, RESULT_CACHE_DIR, RESULT_CACHE_MAX_SIZE
+from pycstbox.performer.commons.streaming import STREAM_STATE_DIR, StateStore, catch_up
+
 __author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 
 default_logger = logging.getLogger('tsserver').getChild(__name__)
@@ -16,6 +24,11 @@ default_logger = logging.getLogger('tsserver').getChild(__name__)
 class TimeFrame(object):
     """ The definition of an immutable time frame
     """
+    # if True, the events occurring at the end of the frame are not part of it (see ShardTimeFrame)
+    end_excluded = False
+    # how far before the frame start the seeding events of the inputs are looked for (see ShardTimeFrame)
+    seed_lookback = None
+
     def __init__(self, start, end):
         """
         Either bound can be omitted but not both. Bounds can be provided as ints, floats,
@@ -56,6 +69,27 @@ class TimeFrame(object):
         return self._end
 
 
+class ShardTimeFrame(TimeFrame):
+    """ The time frame of a shard of a sharded computation (see :py:meth:`AbstractAnalyzer.process_shard`)
+
+    Consecutive shards share their boundary, so that the durations computed on each one add up exactly. The
+    events occurring at this boundary belong to the next shard only (its end being excluded from the previous
+    one), so that they are not accounted for twice.
+
+    Shards can be seeded : their inputs then include the last event of each variable preceding their start,
+    so that the state of the signals at the beginning of the shard is known.
+    """
+    def __init__(self, start, end, end_excluded=False, seed_lookback=None):
+        """
+        :param bool end_excluded: if True, the events occurring at the end of the frame are not part of it
+        :param datetime.timedelta seed_lookback: how far before the frame start the seeding events are looked
+        for (None if the shard is not seeded)
+        """
+        super(ShardTimeFrame, self).__init__(start, end)
+        self.end_excluded = end_excluded
+        self.seed_lookback = seed_lookback
+
+
 class AbstractIndicator(object):
     """ Root class for defining and indicator.
 
@@ -76,6 +110,18 @@ class AbstractIndicator(object):
         if missing:
             raise AnalyzerError('missing mandatory parameters [%s]' % (', '.join(missing)))
 
+    def output_variables(self):
+        """ Returns the PDW variables in which the indicator outputs are stored.
+
+        Variables returned here are declared in bulk before the analyzers are executed. Indicators
+        which do not define them get their variables declared one by one when outputs are stored.
+
+        :return: the variables meta data (refer to PDW services specifications, part 5.1 for details),
+        keyed by variable name
+        :rtype: dict
+        """
+        return {}
+
     def __str__(self):
         return self.name
 
@@ -85,17 +131,47 @@ class AbstractAnalyzer(object):
 
     This class serves as the foundation for concrete analyzers, which must provide
     a real implementation of the method :py:meth:`process_signals`.
+
+    Analyzers can in addition declare their computation as a per-shard map (:py:meth:`process_shard`)
+    and an associative merge (:py:meth:`merge_shards`) of the partial results. When they do so, time frames
+    covering several days are split into day shards (see :py:meth:`split_time_frame`), which are computed in
+    parallel worker processes before being merged. The outputs are then produced from the merge result by
+    :py:meth:`finalize_shards`.
+
+    Intermediate results computed on closed time frames can be cached with :py:meth:`cached_result`, so that
+    the jobs of other periods covering the same days reuse them. The partial results of sharded computations
+    are cached this way when the cache is enabled (see :py:meth:`configure_result_cache`).
+
+    Analyzers can also maintain their result incrementally from the live events stream, by defining
+    :py:meth:`stream_variables`, :py:meth:`init_stream_state`, :py:meth:`update_stream_state` and
+    :py:meth:`finalize_stream_state` (see :py:mod:`pycstbox.performer.commons.streaming`). When a check-pointed
+    state exists for the analyzed time frame, the outputs are produced from it instead of reading the
+    inputs of the whole frame.
     """
     output_as_series = False
+    stream_state_dir = STREAM_STATE_DIR
+
+    # the intermediate results cache shared by all the analyzers (None if disabled)
+    result_cache = None
+    # to be incremented when the computation changes, so that the results cached by previous versions are ignored
+    result_version = 1
+
+    # how far before their start the seeding events of the shards are looked for (None to disable seeding)
+    shard_seed_lookback = datetime.timedelta(days=1)
 
     def __init__(self,
                  indicator, time_frame,
                  logger=None,
-                 dry_run=False, save_plots_to=None
+                 dry_run=False, save_plots_to=None,
+                 shard_workers=None, memory_budget=None
                  ):
         """
         :param AbstractIndicator indicator: the definition of the indicator elaborated by the analyzer
         :param TimeFrame time_frame: the analysis time frame
+        :param int shard_workers: the number of worker processes used for sharded computations
+        (default: the number of CPUs)
+        :param float memory_budget: the memory (MB) the run can use before spilling extracted signals and
+        intermediate buffers to disk (see :py:mod:`pycstbox.performer.commons.memory`). Default: no limit
 
         :raise ValueError: if mandatory parameters are not provided, or are invalid
         :raise TypeError: in case of parameters type mismatch
@@ -118,6 +194,9 @@ class AbstractAnalyzer(object):
 
         self.dry_run = dry_run
         self.save_plots_to = save_plots_to
+        self.shard_workers = shard_workers
+        self.memory = MemoryBudget(memory_budget, logger=self.logger)
+        self._result_cache_key = None
 
     @property
     def time_frame(self):
@@ -144,11 +223,28 @@ class AbstractAnalyzer(object):
 
         :raise AnalyzerError: in case of error during process
         """
+        try:
+            self._run(outputs_timestamp)
+        finally:
+            if self.memory.spilling:
+                self.logger.info('removing spilled data')
+            self.memory.release()
 
+    def _run(self, outputs_timestamp):
         self.logger.info(
             '%s analyzing period [%s, %s]', self.__class__.__name__, self._time_frame.start, self._time_frame.end
         )
 
+        if self.supports_streaming and self._run_from_stream_state(outputs_timestamp):
+            return
+
+        if self.supports_sharding:
+            shards = self.split_time_frame()
+            # single shard frames go through the sharded path too when their result can be cached
+            if len(shards) > 1 or (self.result_cache is not None and not self.save_plots_to):
+                self._run_sharded(shards, outputs_timestamp)
+                return
+
         self.logger.info('loading inputs')
         inputs = self.load_inputs(TimeFrame(self._time_frame.start, self._time_frame.end))
         if inputs:
@@ -189,6 +285,271 @@ class AbstractAnalyzer(object):
         """
         raise NotImplementedError()
 
+    @property
+    def supports_sharding(self):
+        return type(self).process_shard.__func__ is not AbstractAnalyzer.process_shard.__func__
+
+    def split_time_frame(self):
+        """ Returns the shards of the analyzed time frame.
+
+        The default implementation does not split it. Subclasses can override this to return a list of
+        consecutive time frames covering the analyzed one.
+
+        :rtype: list of [ShardTimeFrame]
+        """
+        return [ShardTimeFrame(self._time_frame.start, self._time_frame.end)]
+
+    def process_shard(self, inputs, time_frame):
+        """ Computes the partial result of a shard.
+
+        Concrete classes supporting sharded computations must define this method, together with
+        :py:meth:`merge_shards` and :py:meth:`finalize_shards`. Since it is executed in worker processes,
+        the returned partial result must be picklable.
+
+        The inputs are loaded by :py:meth:`load_inputs` for the shard time frame (see :py:class:`ShardTimeFrame`).
+        :py:meth:`pycstbox.performer.commons.data.DataAccessMixin.extract_signals` takes care of its end
+        exclusion and seeding, and analyzers loading their inputs by other means must do so.
+
+        The seeding events are dated before the shard start : the partial result must only account for what
+        happens within the shard time frame, the seeding events giving the state at its start. This is the case
+        of the functions of :py:mod:`pycstbox.performer.commons.primitives` when given the shard bounds.
+        Since the first shard is seeded too, a sharded computation knows the state at the start of the
+        analyzed time frame, unlike a computation of the whole frame from inputs extracted at once.
+
+        Indicators which can be sharded are the ones which result is an associative aggregate of what happens in
+        consecutive sub-frames : durations and counts (summed), extrema (min/max), averages carried as sums
+        and weights until :py:meth:`finalize_shards`. Indicators depending on the whole distribution of the
+        values (medians, percentiles,...), or on sequences longer than the seed lookback
+        (:py:attr:`shard_seed_lookback`) spanning shard boundaries, cannot.
+
+        :param dict inputs: the input signals of the shard, keyed by signal name
+        :param ShardTimeFrame time_frame: the shard time frame
+        :return: the partial result
+        :raise AnalyzerError: in case of processing error
+        """
+        raise NotImplementedError()
+
+    def prepare_sharded_inputs(self, time_frame):
+        """ Prepares the inputs of the shards before the worker processes are started.
+
+        It is intended for the work shared by shards processed in parallel, such as reading the input data
+        common to adjacent shards. The default implementation does nothing.
+
+        :param TimeFrame time_frame: the time frame covered by all the shards
+        """
+
+    def merge_shards(self, result1, result2):
+        """ Merges two partial results.
+
+        The merge must be associative, since shards results are merged in time order but in any grouping.
+        Results of shards which do not overlap are merged (see :py:class:`ShardTimeFrame`), so that sums of
+        durations or counts are exact.
+
+        :return: the merged partial result
+        """
+        raise NotImplementedError()
+
+    def finalize_shards(self, result):
+        """ Produces the outputs from the merge of all the shards partial results.
+
+        Outputs are set with :py:meth:`set_output`, as done by :py:meth:`process_inputs`.
+
+        :param result: the merged partial result
+        """
+        raise NotImplementedError()
+
+    def _run_sharded(self, shards, outputs_timestamp):
+        workers = min(self.shard_workers or multiprocessing.cpu_count(), len(shards))
+        self.logger.info('computing %d shards (workers=%d)', len(shards), workers)
+        if self.save_plots_to:
+            self.logger.warn('input signals are not plotted in sharded computations')
+
+        self._outputs = {name: None for name in self.create_outputs()}
+
+        bounds = [(tf.start, tf.end, tf.end_excluded, tf.seed_lookback) for tf in shards]
+        global _sharded_analyzer
+        _sharded_analyzer = self
+        try:
+            if workers > 1:
+                self.prepare_sharded_inputs(ShardTimeFrame(shards[0].start, shards[-1].end, shards[-1].end_excluded))
+                # workers are forked, and thus inherit the analyzer from the module global
+                pool = multiprocessing.Pool(workers)
+                try:
+                    results = []
+                    for result, counters, since in pool.map(_process_shard_in_worker, bounds, chunksize=1):
+                        results.append(result)
+                        run_metrics.merge_counters(counters, since)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                results = [_process_shard(b) for b in bounds]
+        finally:
+            _sharded_analyzer = None
+
+        results = [r for r in results if r is not None]
+        if not results:
+            self.logger.warn('cannot compute indicator : no input data')
+            return
+
+        self.logger.info('merging shards results')
+        self.finalize_shards(reduce(self.merge_shards, results))
+
+        self.logger.info('storing results (if any)')
+        if self.output_as_series:
+            self.store_time_series_outputs()
+        else:
+            self.store_single_point_outputs(outputs_timestamp)
+
+    @classmethod
+    def configure_result_cache(cls, path=RESULT_CACHE_DIR, max_size=RESULT_CACHE_MAX_SIZE):
+        """ Enables the intermediate results cache for all the analyzers.
+
+        :param str path: the path of the cache directory (None to disable the cache)
+        :param float max_size: the maximum size of the cache (MB)
+        """
+        AbstractAnalyzer.result_cache = ResultCache(path, max_size) if path else None
+
+    def result_cache_params(self):
+        """ Returns the parameters which the cached results depend on.
+
+        They include by default the analyzer class, its :py:attr:`result_version` and the indicator parameters.
+        Analyzers which results depend on other parameters must add them. The parameters must be serializable
+        in JSON, results not being cached otherwise.
+
+        :rtype: dict
+        """
+        lookback = self.shard_seed_lookback
+        return {
+            'analyzer': '%s.%s' % (type(self).__module__, type(self).__name__),
+            'version': self.result_version,
+            'shard_seed_lookback': lookback.total_seconds() if lookback else None,
+            'indicator': {
+                k: v for k, v in vars(self._indicator).iteritems() if k not in ('name', 'label', 'description')
+            },
+        }
+
+    def cached_result(self, name, time_frame, compute):
+        """ Returns an intermediate result, from the cache if it has already been computed.
+
+        Results are cached only for closed time frames, i.e. ending before the current UTC day, the data of
+        the current day being still incomplete. They are not invalidated by events recorded late for a closed
+        day : the cache must then be refreshed (``--refresh-cache`` option of the periodic analytics job, which
+        also refreshes the day cache of the events).
+
+        :param str name: the result name, unique for the analyzer
+        :param TimeFrame time_frame: the time frame the result is computed on
+        :param compute: the callable computing the result if it is not cached. The result must be picklable.
+        :return: the result
+        """
+        cache = self.result_cache
+        today = datetime.datetime.combine(datetime.datetime.utcnow().date(), datetime.time())
+        if cache is None or time_frame.end > today:
+            return compute()
+
+        if self._result_cache_key is None:
+            try:
+                self._result_cache_key = params_hash(self.result_cache_params())
+            except TypeError as e:
+                self.logger.warn('results not cached : parameters not serializable in JSON (%s)', e)
+                self._result_cache_key = False
+        if self._result_cache_key is False:
+            return compute()
+        key = (self._indicator.name, self._result_cache_key, name, time_frame)
+
+        result = cache.get(*key)
+        if result is not ResultCache.MISS:
+            self.logger.info('using cached %s result [%s, %s]', name, time_frame.start, time_frame.end)
+            run_metrics.add('result_cache_hits')
+            return result
+
+        run_metrics.add('result_cache_misses')
+        result = compute()
+        try:
+            cache.put(*(key + (result,)))
+        except (EnvironmentError, pickle.PicklingError, TypeError) as e:
+            self.logger.warn('cannot cache %s result (%s)', name, e)
+        return result
+
+    @property
+    def supports_streaming(self):
+        return type(self).update_stream_state.__func__ is not AbstractAnalyzer.update_stream_state.__func__
+
+    def stream_variables(self):
+        """ Returns the names of the variables which events update the streaming state.
+
+        :rtype: list of [str]
+        """
+        raise NotImplementedError()
+
+    def init_stream_state(self):
+        """ Returns the initial streaming state for the analyzed time frame.
+
+        The state is check-pointed on disk, and must thus be picklable.
+        """
+        raise NotImplementedError()
+
+    def stream_value(self, var_name, value):
+        """ Casts an event value before it is passed to :py:meth:`update_stream_state`.
+
+        Live events and the ones caught up from the event source both go through this method, so that the
+        state is updated with the same value types whatever the events come from. The default implementation
+        returns numeric values as floats, and the other ones unchanged.
+
+        :param str var_name: the event variable name
+        :param value: the event value
+        :return: the cast value
+        """
+        if isinstance(value, (int, long, float)):
+            return float(value)
+        return value
+
+    def update_stream_state(self, state, var_name, timestamp, value):
+        """ Accounts for an event in the streaming state.
+
+        The events of a given variable are passed in chronological order. Events of different variables
+        received slightly out of order are passed as received.
+
+        :param state: the current state
+        :param str var_name: the event variable name
+        :param long timestamp: the event time (msecs from Epoch)
+        :param value: the event value
+        :return: the updated state
+        """
+        raise NotImplementedError()
+
+    def finalize_stream_state(self, state):
+        """ Produces the outputs from the state accounting for all the events of the time frame.
+
+        Outputs are set with :py:meth:`set_output`, as done by :py:meth:`process_inputs`.
+        """
+        raise NotImplementedError()
+
+    def _run_from_stream_state(self, outputs_timestamp):
+        store = StateStore(self.stream_state_dir)
+        checkpoint = store.load(self._indicator.name, self._time_frame)
+        if checkpoint is None:
+            return False
+
+        self.logger.info('completing streaming state')
+        checkpoint = catch_up(self, checkpoint, self._time_frame.end)
+
+        self._outputs = {name: None for name in self.create_outputs()}
+        self.logger.info('computing indicator(s) from streaming state')
+        self.finalize_stream_state(checkpoint.state)
+
+        self.logger.info('storing results (if any)')
+        if self.output_as_series:
+            self.store_time_series_outputs()
+        else:
+            self.store_single_point_outputs(outputs_timestamp)
+
+        store.consume(self._indicator.name, self._time_frame)
+        return True
+
     def store_single_point_outputs(self, timestamp=None):
         """ Stores the outputs of the analyzer (single points).
 
@@ -237,6 +598,50 @@ class AnalyzerError(Exception):
     """ Specialized exception for identifying analyzer processing errors """
 
 
+# the analyzer which shards are being computed, shared with the worker processes
+_sharded_analyzer = None
+
+
+def _process_shard(bounds):
+    """ Computes a shard of the current sharded analyzer.
+
+    :param tuple bounds: the shard time frame parameters (see :py:class:`ShardTimeFrame`)
+    :return: the shard partial result, or None if there is no input data for the shard
+    """
+    time_frame = ShardTimeFrame(*bounds)
+    analyzer = _sharded_analyzer
+
+    def compute():
+        analyzer.logger.info('processing shard [%s, %s]', time_frame.start, time_frame.end)
+        inputs = analyzer.load_inputs(time_frame)
+        if not inputs:
+            return None
+        return analyzer.process_shard(inputs, time_frame)
+
+    # the result of a given frame depends on how its shard is bounded and seeded (the day shards of the
+    # periodic analyzers are all the same, see PeriodicAnalyzer.split_time_frame)
+    name = 'shard'
+    if time_frame.end_excluded:
+        name += '-open'
+    if time_frame.seed_lookback:
+        name += '-seeded'
+    return analyzer.cached_result(name, time_frame, compute)
+
+
+def _process_shard_in_worker(bounds):
+    """ Computes a shard in a worker process.
+
+    :return: the shard partial result, and the metrics counters after and before its computation
+    :rtype: tuple
+    """
+    before = run_metrics.counters()
+    try:
+        result = _process_shard(bounds)
+    finally:
+        _sharded_analyzer.memory.release()
+    return result, run_metrics.counters(), before
+
+
 class PeriodicAnalyzer(AbstractAnalyzer):
     PERIOD_DAY, PERIOD_WEEK, PERIOD_MONTH = range(3)
     PERIOD_NAMES = ['day', 'week', 'month']
@@ -266,6 +671,25 @@ class PeriodicAnalyzer(AbstractAnalyzer):
 
         super(PeriodicAnalyzer, self).__init__(indicator=indicator, time_frame=tf, **kwargs)
 
+    def split_time_frame(self):
+        """ Periods are split in day shards.
+
+        A given day is sharded the same way whatever the period, so that the results cached by the day,
+        week and month jobs are shared : its shard starts at midnight and ends at the next one, excluded
+        (see :py:class:`ShardTimeFrame`), and is seeded with the events of the previous day. The last
+        shard thus ends one microsecond after the period (which ends at 23:59:59.999999), which covers the
+        same events.
+        """
+        shards = []
+        day_start = self._time_frame.start
+        while day_start < self._time_frame.end:
+            next_day = datetime.datetime.combine(day_start.date() + datetime.timedelta(days=1), datetime.time())
+            shards.append(ShardTimeFrame(
+                day_start, next_day, end_excluded=True, seed_lookback=self.shard_seed_lookback
+            ))
+            day_start = next_day
+        return shards
+
     @staticmethod
     def period_name_to_id(name):
         try:
@@ -1,14 +1,71 @@
 # -*- coding: utf-8 -*-
 
-from pycstbox import evtdb, evtdao, evtmgr
+import datetime
 
-__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+from pycstbox.performer.commons.analytics import TimeFrame, default_logger
+from pycstbox.performer.commons.metrics import run_metrics
+from pycstbox.performer.commons.memory import MemoryBudget
+from pycstbox.performer.commons.sources import get_event_source, DAO_NAME, DAY_CACHE_DIR
 
-DAO_NAME = 'fsys'
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 
 
 class DataAccessMixin(object):
-    """ This mixin provides services for extracting data from a fsys based events DAO """
+    """ This mixin provides services for extracting data from an event source.
+
+    The source is the fsys based events DAO by default, closed days (i.e. before the current UTC day) being
+    served from a materialized columnar cache (see :py:mod:`pycstbox.performer.commons.daycache`), which is
+    fed from the DAO the first time a day is requested. Setting :py:attr:`day_cache_dir` to None disables
+    the cache.
+
+    Another source can be selected by :py:meth:`configure_event_source` (see
+    :py:mod:`pycstbox.performer.commons.sources` for the available backends).
+    """
+    day_cache_dir = DAY_CACHE_DIR
+    # frames longer than this (in days) bypass the cache, to avoid materializing whole histories
+    day_cache_max_span = 366
+    # if True, the cached days covered by the extractions are materialized again from the DAO
+    # (once per process)
+    refresh_day_cache = False
+
+    # the event source backend and its parameters (default : fsys DAO)
+    event_source_config = None
+
+    @classmethod
+    def configure_event_source(cls, backend, **params):
+        """ Selects the event source used by all the analyzers.
+
+        :param str backend: the backend name or class
+        :param params: the backend specific parameters
+        """
+        cls.event_source_config = dict(params, backend=backend)
+
+    def get_event_source(self):
+        """ Returns a new instance of the configured event source.
+
+        :rtype: pycstbox.performer.commons.sources.EventSource
+        """
+        params = dict(self.event_source_config or {'backend': 'fsys'})
+        if params['backend'] == 'fsys':
+            params.setdefault('dao_name', DAO_NAME)
+            params.setdefault('day_cache_dir', self.day_cache_dir)
+            params.setdefault('day_cache_max_span', self.day_cache_max_span)
+            params.setdefault('refresh_day_cache', self.refresh_day_cache)
+        params.setdefault('logger', getattr(self, 'logger', None) or default_logger)
+        return get_event_source(**params)
+
+    def prepare_sharded_inputs(self, time_frame):
+        """ Materializes in the day cache the days read by the shards, before the workers are forked.
+
+        Otherwise, the workers processing adjacent shards would all read from the DAO the days they share,
+        such as the previous day looked up for seeding.
+        """
+        lookback = self.shard_seed_lookback or datetime.timedelta(0)
+        source = self.get_event_source()
+        try:
+            source.prepare(TimeFrame(time_frame.start - lookback, time_frame.end))
+        finally:
+            source.close()
 
     def extract_signals(self, time_frame, extracted_variables):
         """ Extract the signals containing the points belonging to the given time frame
@@ -17,31 +74,45 @@ class DataAccessMixin(object):
         Data to be extracted are specified by a dictionary which gives the names of the variables
         which points are requested, and the type of signal to be produced for each one.
 
+        If the analyzer memory budget is exceeded during the extraction, the numeric signals are moved to
+        disk (see :py:mod:`pycstbox.performer.commons.memory`).
+
+        The end exclusion and the seeding of shard time frames are honoured (see
+        :py:class:`pycstbox.performer.commons.analytics.ShardTimeFrame`).
+
         :param TimeFrame time_frame: the definition of the considered time frame
         :param dict extracted_variables: the extraction specification
         """
+        source = self.get_event_source()
+        memory = getattr(self, 'memory', None) or MemoryBudget()
+
+        signals = {}
+        count = 0
         try:
-            dao_dbus = evtdb.get_object(evtmgr.SENSOR_EVENT_CHANNEL)
-            dao_dbus.flush()
-        except:
-            # we are not on a real CSTBox (test context)
-            pass
+            if time_frame.seed_lookback:
+                seeds = source.last_events(time_frame.start, extracted_variables.keys(), time_frame.seed_lookback)
+                for var_name, (ts, value) in seeds.iteritems():
+                    signals[var_name] = memory.new_signal(extracted_variables[var_name])
+                    signals[var_name].add_point(ts, value, auto_cast=True)
+                count += len(seeds)
 
-        dao_direct = evtdao.get_dao(DAO_NAME, readonly=True)
+            for var_name, timestamps, values in source.scan(time_frame, extracted_variables.keys()):
+                if not memory.spilling and memory.check():
+                    for name, signal in signals.items():
+                        signals[name] = memory.spill_signal(signal)
 
-        signals = {}
-        var_names = extracted_variables.keys()
+                try:
+                    signal = signals[var_name]
+                except KeyError:
+                    signals[var_name] = signal = memory.new_signal(extracted_variables[var_name])
 
-        for event in (
-                evt for evt in dao_direct.get_events(time_frame.start, time_frame.end)
-                if evt.var_name in var_names
-        ):
-            var_name = event.var_name
-            try:
-                signal = signals[var_name]
-            except KeyError:
-                signals[var_name] = signal = extracted_variables[var_name]()
+                add_point = signal.add_point
+                for ts, value in zip(timestamps, values):
+                    add_point(long(ts), value, auto_cast=True)
+                count += len(timestamps)
 
-            signal.add_point(event.timestamp, event.value, auto_cast=True)
+        finally:
+            source.close()
 
+        run_metrics.add('events_read', count)
         return signals
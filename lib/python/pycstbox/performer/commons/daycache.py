@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+""" Materialized per-day columnar cache of sensor events.
+
+Each closed day is stored as a directory containing, for every variable having produced events
+during the day, two binary files :
+
+- ``<var_name>.ts`` : the timestamps of the events (msecs from Epoch)
+- ``<var_name>.val`` : the values of the events
+
+Both are flat arrays of little-endian doubles, sorted by ascending timestamps. They are memory-mapped
+when read, so that only the part of the day covered by the requested time frame is loaded.
+
+The values of the variables which events are not all numeric (booleans included) are stored instead as a
+JSON list in ``<var_name>.raw``, so that they keep their original type and are cast by the signals exactly
+as when read from the DAO.
+
+An empty day directory is valid, and means that no event has been recorded that day. A day which cannot
+be cached is recorded by a ``<day>.uncacheable`` file, so that it is not attempted again.
+"""
+
+import os
+import sys
+import mmap
+import json
+import errno
+import shutil
+import struct
+import datetime
+from array import array
+from itertools import izip, islice
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+TIMESTAMPS_EXT = '.ts'
+VALUES_EXT = '.val'
+RAW_VALUES_EXT = '.raw'
+UNCACHEABLE_EXT = '.uncacheable'
+
+_ITEM_SIZE = 8
+_ITEM_FORMAT = '<d'
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def column_values(values):
+    """ Returns the column storing a sequence of event values.
+
+    :param values: the event values
+    :return: an array of floats if all the values are numeric, the list of the values otherwise
+    :rtype: array.array or list
+    """
+    if isinstance(values, array):
+        return values
+    values = list(values)
+    if all(isinstance(v, (int, long, float)) for v in values):
+        return array('d', values)
+    return values
+
+
+class DayColumns(object):
+    """ Memory-mapped read access to the events of a variable for a cached day """
+    def __init__(self, ts_path, val_path):
+        self._ts_map = self._map(ts_path)
+        self._count = len(self._ts_map) // _ITEM_SIZE if self._ts_map else 0
+        self._val_map = self._raw_values = None
+        try:
+            if val_path.endswith(RAW_VALUES_EXT):
+                with open(val_path) as fp:
+                    self._raw_values = json.load(fp)
+            else:
+                self._val_map = self._map(val_path)
+        except:
+            self.close()
+            raise
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as fp:
+            if not os.fstat(fp.fileno()).st_size:
+                return None
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self._count
+
+    def _timestamp_at(self, i):
+        return struct.unpack_from(_ITEM_FORMAT, self._ts_map, i * _ITEM_SIZE)[0]
+
+    def _bisect(self, ts, right=False):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = self._timestamp_at(mid)
+            if t < ts or (right and t == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    @staticmethod
+    def _read(mm, first, last):
+        a = array('d')
+        a.fromstring(mm[first * _ITEM_SIZE:last * _ITEM_SIZE])
+        if not _LITTLE_ENDIAN:
+            a.byteswap()
+        return a
+
+    def slice(self, start_ms=None, end_ms=None):
+        """ Returns the events which timestamps are within the given bounds (both included).
+
+        :param float start_ms: lower bound (msecs from Epoch), omitted if None
+        :param float end_ms: upper bound (msecs from Epoch), omitted if None
+        :return: the timestamps array and the values (array of floats, or list of raw values)
+        :rtype: tuple
+        """
+        if not self._count:
+            return array('d'), array('d')
+        first = self._bisect(start_ms) if start_ms is not None else 0
+        last = self._bisect(end_ms, right=True) if end_ms is not None else self._count
+        if first >= last:
+            return array('d'), array('d')
+        if self._raw_values is not None:
+            return self._read(self._ts_map, first, last), self._raw_values[first:last]
+        return self._read(self._ts_map, first, last), self._read(self._val_map, first, last)
+
+    def close(self):
+        for mm in (self._ts_map, self._val_map):
+            if mm:
+                mm.close()
+        self._ts_map = self._val_map = self._raw_values = None
+        self._count = 0
+
+
+def columns_from_events(events):
+    """ Builds the columns of a set of events, grouped by variable.
+
+    :param events: an iterable of events, as returned by the DAO
+    :return: a dictionary of (timestamps, values) columns tuples, keyed by variable name (see
+    :py:func:`column_values`)
+    :rtype: dict
+    """
+    from evtsignals.base import to_milliseconds
+
+    columns = {}
+    for event in events:
+        try:
+            ts_col, val_col = columns[event.var_name]
+        except KeyError:
+            columns[event.var_name] = ts_col, val_col = array('d'), []
+        ts_col.append(to_milliseconds(event.timestamp))
+        val_col.append(event.value)
+
+    for var_name, (ts_col, val_col) in columns.iteritems():
+        if any(t1 < t0 for t0, t1 in izip(ts_col, islice(ts_col, 1, None))):
+            ordered = sorted(zip(ts_col, val_col), key=lambda p: p[0])
+            ts_col, val_col = array('d', (t for t, _ in ordered)), [v for _, v in ordered]
+        columns[var_name] = ts_col, column_values(val_col)
+
+    return columns
+
+
+class DayCache(object):
+    """ The store of the materialized days """
+    DAY_FORMAT = '%Y-%m-%d'
+
+    def __init__(self, root):
+        """
+        :param str root: the path of the directory hosting the cache (created if needed)
+        """
+        if not root:
+            raise ValueError('root parameter is mandatory')
+        self._root = root
+
+    @property
+    def root(self):
+        return self._root
+
+    def day_path(self, day):
+        return os.path.join(self._root, day.strftime(self.DAY_FORMAT))
+
+    def contains(self, day):
+        return os.path.isdir(self.day_path(day))
+
+    def cached_days(self):
+        """ Returns the sorted list of the days available in the cache. """
+        days = []
+        if os.path.isdir(self._root):
+            for name in os.listdir(self._root):
+                try:
+                    days.append(datetime.datetime.strptime(name, self.DAY_FORMAT).date())
+                except ValueError:
+                    # temporary directories and foreign files
+                    pass
+        return sorted(days)
+
+    def variables(self, day):
+        """ Returns the names of the variables available for a cached day.
+
+        :raise KeyError: if the day is not in the cache
+        """
+        path = self.day_path(day)
+        if not os.path.isdir(path):
+            raise KeyError(day)
+        return [name[:-len(TIMESTAMPS_EXT)] for name in os.listdir(path) if name.endswith(TIMESTAMPS_EXT)]
+
+    def is_uncacheable(self, day):
+        """ Tells if a day has been recorded as not cacheable (see :py:meth:`mark_uncacheable`). """
+        return os.path.exists(self.day_path(day) + UNCACHEABLE_EXT)
+
+    def mark_uncacheable(self, day, reason):
+        """ Records that a day cannot be cached, until it is invalidated.
+
+        :param datetime.date day: the day
+        :param str reason: the reason, kept in the marker for diagnostic
+        """
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+        with open(self.day_path(day) + UNCACHEABLE_EXT, 'w') as fp:
+            fp.write('%s\n' % reason)
+
+    def load(self, day, var_names):
+        """ Returns the memory-mapped columns of a cached day.
+
+        Variables without events that day are not included in the result.
+
+        :param datetime.date day: the day
+        :param var_names: the names of the requested variables
+        :return: the columns keyed by variable name, or None if the day is not in the cache
+        :rtype: dict of [str, DayColumns]
+        :raise EnvironmentError: if the day is replaced while being loaded
+        """
+        path = self.day_path(day)
+        if not os.path.isdir(path):
+            return None
+
+        columns = {}
+        try:
+            for var_name in var_names:
+                ts_path = os.path.join(path, var_name + TIMESTAMPS_EXT)
+                if os.path.exists(ts_path):
+                    val_path = os.path.join(path, var_name + VALUES_EXT)
+                    if not os.path.exists(val_path):
+                        val_path = os.path.join(path, var_name + RAW_VALUES_EXT)
+                    columns[var_name] = DayColumns(ts_path, val_path)
+        except:
+            for day_columns in columns.itervalues():
+                day_columns.close()
+            raise
+        return columns
+
+    def store(self, day, columns, replace=True):
+        """ Materializes a day in the cache.
+
+        The day is written in a temporary directory which is renamed once complete, so that
+        readers never see a partially written day. A replaced day is renamed aside before being
+        removed, so that readers which have already opened its files are not affected.
+
+        :param bool replace: if False and the day is already in the cache (materialized meanwhile by
+        another process), its content is kept and the new one discarded
+
+        :param datetime.date day: the day
+        :param dict columns: the (timestamps, values) columns tuples keyed by variable name (see
+        :py:func:`column_values`)
+        :raise ValueError: if non numeric values cannot be serialized
+        """
+        final_path = self.day_path(day)
+        tmp_path = os.path.join(self._root, '.%s.%d' % (day.strftime(self.DAY_FORMAT), os.getpid()))
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        try:
+            for var_name, (ts_col, val_col) in columns.iteritems():
+                val_col = column_values(val_col)
+                if isinstance(val_col, list):
+                    with open(os.path.join(tmp_path, var_name + RAW_VALUES_EXT), 'w') as fp:
+                        try:
+                            json.dump(val_col, fp)
+                        except TypeError as e:
+                            raise ValueError('values of %s not supported by the cache (%s)' % (var_name, e))
+                    cols = ((ts_col, TIMESTAMPS_EXT),)
+                else:
+                    cols = ((ts_col, TIMESTAMPS_EXT), (val_col, VALUES_EXT))
+                for col, ext in cols:
+                    col = array('d', col)
+                    if not _LITTLE_ENDIAN:
+                        col.byteswap()
+                    with open(os.path.join(tmp_path, var_name + ext), 'wb') as fp:
+                        col.tofile(fp)
+
+            self._publish(tmp_path, final_path, replace)
+
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        if os.path.exists(final_path + UNCACHEABLE_EXT):
+            os.remove(final_path + UNCACHEABLE_EXT)
+
+    @staticmethod
+    def _publish(tmp_path, final_path, replace):
+        old_path = tmp_path + '.old'
+        while True:
+            try:
+                # atomically replaces an empty directory, fails if the target is not empty
+                os.rename(tmp_path, final_path)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+            if not replace:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+            # move the current content aside and try again, since a concurrent store can publish meanwhile
+            try:
+                os.rename(final_path, old_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                shutil.rmtree(old_path, ignore_errors=True)
+
+    def invalidate(self, day):
+        """ Removes a day from the cache, forcing it to be materialized again on next use. """
+        path = self.day_path(day)
+        shutil.rmtree(path, ignore_errors=True)
+        if os.path.exists(path + UNCACHEABLE_EXT):
+            os.remove(path + UNCACHEABLE_EXT)
+
+    def invalidate_range(self, first_day, last_day):
+        """ Removes the days in the given range (both bounds included) from the cache. """
+        days = set(self.cached_days())
+        if os.path.isdir(self._root):
+            for name in os.listdir(self._root):
+                if name.endswith(UNCACHEABLE_EXT):
+                    try:
+                        days.add(datetime.datetime.strptime(name[:-len(UNCACHEABLE_EXT)], self.DAY_FORMAT).date())
+                    except ValueError:
+                        pass
+        for day in days:
+            if first_day <= day <= last_day:
+                self.invalidate(day)
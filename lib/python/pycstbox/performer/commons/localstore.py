@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+""" Background persistence of the results in the local store.
+
+The outputs uploaded to the PDW are also appended to a local file (see
+:py:attr:`pycstbox.performer.commons.pdw.PDWConnectorMixin.LOCAL_STORE`). On the boxes, this file lives on
+a slow SD card, so writing it is delegated to a background thread : lines are queued by the callers, and
+appended by batches, the file being synced on a periodic basis.
+
+Writers are shared by path within a process (see :py:func:`get_writer`). Pending lines are written and
+synced before the process exits normally. Processes exiting without running the exit handlers (such as
+the ones started by :py:mod:`multiprocessing`) must call :py:func:`flush_all` before terminating.
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+import Queue
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+# delay (seconds) during which lines are accumulated before being written
+FLUSH_PERIOD = 1.
+# period (seconds) of the file syncs
+FSYNC_PERIOD = 30.
+
+_logger = logging.getLogger('tsserver').getChild(__name__)
+
+
+class LocalStoreWriter(object):
+    """ Appends lines to a file from a background thread """
+    def __init__(self, path, flush_period=FLUSH_PERIOD, fsync_period=FSYNC_PERIOD):
+        """
+        :param str path: the path of the file
+        :param float flush_period: the delay (seconds) during which lines are accumulated before being written
+        :param float fsync_period: the period (seconds) of the file syncs
+        """
+        self.path = path
+        self.pid = os.getpid()
+        self._flush_period = flush_period
+        self._fsync_period = fsync_period
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def write_lines(self, lines):
+        """ Queues lines to be appended to the file.
+
+        :param lines: the lines, including their terminating new line
+        :raise ValueError: if the writer is closed
+        """
+        with self._lock:
+            if self._closed:
+                raise ValueError('writer closed : %s' % self.path)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='local-store-writer')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(list(lines))
+
+    def flush(self):
+        """ Waits until the queued lines are written and synced. """
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        # wait with a timeout, so that the caller remains interruptible
+        while not done.wait(1) and self._thread.is_alive():
+            pass
+
+    def close(self):
+        """ Writes the queued lines and stops the writer thread. """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        last_sync = time.time()
+        fp = None
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            # accumulate what comes during the flush period, unless a flush is requested
+            deadline = time.time() + self._flush_period
+            while isinstance(batch[-1], list):
+                remaining = deadline - time.time()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            lines = [line for item in batch if isinstance(item, list) for line in item]
+            sync_requested = not isinstance(batch[-1], list)
+            running = batch[-1] is not None
+
+            try:
+                if lines:
+                    if fp is None:
+                        fp = open(self.path, 'a')
+                    fp.write(''.join(lines))
+                    fp.flush()
+                if fp is not None and (sync_requested or time.time() - last_sync >= self._fsync_period):
+                    os.fsync(fp.fileno())
+                    last_sync = time.time()
+            except EnvironmentError as e:
+                _logger.error('cannot write local store %s (%s) : %d line(s) lost', self.path, e, len(lines))
+                if fp is not None:
+                    fp.close()
+                    fp = None
+
+            if isinstance(batch[-1], threading._Event):
+                batch[-1].set()
+
+        if fp is not None:
+            fp.close()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path):
+    """ Returns the writer of a file, shared by all the callers of the process.
+
+    :rtype: LocalStoreWriter
+    """
+    with _writers_lock:
+        writer = _writers.get(path)
+        # writers inherited from a parent process have no thread in this one
+        if writer is None or writer.pid != os.getpid():
+            writer = _writers[path] = LocalStoreWriter(path)
+        return writer
+
+
+def flush_all():
+    """ Waits until all the lines queued in the process are written and synced. """
+    with _writers_lock:
+        writers = [w for w in _writers.itervalues() if w.pid == os.getpid()]
+    for writer in writers:
+        writer.flush()
+
+
+def _close_all():
+    with _writers_lock:
+        writers = [w for w in _writers.itervalues() if w.pid == os.getpid()]
+    for writer in writers:
+        writer.close()
+
+atexit.register(_close_all)
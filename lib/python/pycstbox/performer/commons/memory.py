@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+
+""" Memory budget of the analyzers runs.
+
+When an analyzer is given a memory budget (see :py:class:`pycstbox.performer.commons.analytics.AbstractAnalyzer`),
+the resident memory of its process is checked while the inputs are extracted. Once the budget is exceeded,
+the numeric signals (analog and logic ones) already extracted and the ones extracted afterwards are moved to
+disk-backed storage (:py:class:`SpilledSignal`, which provides the same operations as in-memory signals),
+and the intermediate buffers allocated through :py:meth:`MemoryBudget.buffer` are memory-mapped files
+instead of in-memory arrays. The kernel can then reclaim their pages when memory gets short, instead of
+killing the process.
+
+Spilled signals provide their content as memory-mapped numpy arrays (see :py:meth:`SpilledSignal.as_arrays`),
+which is the form used by :py:mod:`pycstbox.performer.commons.primitives`. The signal operations based on the
+points lists load the whole signal in memory again.
+"""
+
+import os
+import atexit
+import shutil
+import tempfile
+import resource
+from itertools import izip
+
+import numpy as np
+from evtsignals.base import Signal, to_milliseconds
+
+from pycstbox.performer.commons.metrics import run_metrics
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+SPILL_DIR = '/var/tmp/cstbox/performer'
+
+MB = 1024 * 1024
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+_ITEM_SIZE = 8
+
+
+def rss_bytes():
+    """ Returns the current resident memory size of the process, or None if it cannot be known. """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * _PAGE_SIZE
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_bytes():
+    """ Returns the peak resident memory size of the process and of its terminated children.
+
+    The children are the ones waited for, such as the shard workers once their pool is joined. Both peaks
+    are the ones since the process has been started.
+    """
+    # Linux reports them in kilobytes
+    return max(
+        resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    ) * 1024
+
+
+def is_spillable(signal_class):
+    """ Tells if the signals of a given class can be spilled (i.e. if their values are numeric). """
+    from evtsignals import AnalogSignal, LogicSignal
+    return issubclass(signal_class, (AnalogSignal, LogicSignal))
+
+
+class SpillArea(object):
+    """ A temporary directory hosting spilled data, removed when closed or at process exit """
+    def __init__(self, root=SPILL_DIR):
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.path = tempfile.mkdtemp(prefix='spill-%d-' % os.getpid(), dir=root)
+        self.pid = os.getpid()
+        self._count = 0
+        atexit.register(self.close)
+
+    def new_file(self, suffix=''):
+        """ Returns the path of a new (empty) file. """
+        self._count += 1
+        path = os.path.join(self.path, '%06d%s' % (self._count, suffix))
+        open(path, 'wb').close()
+        return path
+
+    def close(self):
+        # forked processes must not remove the area of their parent
+        if self.pid == os.getpid():
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+class SpilledSignal(Signal):
+    """ A numeric signal stored on disk.
+
+    Concrete classes are derived from the class of the in-memory signals by :py:func:`spilled_class`, so that
+    spilled signals are instances of it (e.g. :py:class:`evtsignals.AnalogSignal`), and provide all its
+    operations.
+
+    Points are added with the semantics of :py:meth:`evtsignals.base.Signal.add_point`. Points added after the
+    end of the signal (which is the case of extractions) are written to disk by buffers. The ones added before
+    are inserted by rewriting the tail of the signal from the insertion position.
+
+    The length, bounds, values at a given time, slices and iteration are served from the files. The other
+    operations work on the points list of the signal (:py:attr:`points`), which loads it in memory until it is
+    moved back to disk by :py:meth:`unload` or :py:meth:`as_arrays`.
+
+    The times and values are stored as flat files of int64 msecs and float64 values.
+    """
+    BUFFER_SIZE = 8192
+    # the class of the equivalent in-memory signals (set by the concrete classes)
+    signal_class = None
+
+    def __init__(self, area):
+        """
+        :param SpillArea area: the area hosting the files
+        """
+        self._ts_path = area.new_file('.ts')
+        self._val_path = area.new_file('.val')
+        self._buf_times, self._buf_values = [], []
+        self._flushed = 0
+        # the last point, for the appends fast path
+        self._last = None
+        # the in-memory signal, when loaded by operations working on the points list
+        self._loaded = None
+
+    @classmethod
+    def from_signal(cls, signal, area):
+        """ Returns the spilled copy of an in-memory signal. """
+        spilled = spilled_class(type(signal))(area)
+        for point in signal.points:
+            spilled._buffer_point(point.timestamp, point.value)
+        spilled.flush()
+        return spilled
+
+    def __len__(self):
+        if self._loaded is not None:
+            return len(self._loaded)
+        return self._flushed + len(self._buf_times)
+
+    @property
+    def is_empty(self):
+        return len(self) == 0
+
+    def __iter__(self):
+        if self._loaded is not None:
+            return iter(self._loaded)
+        return self._iter_points()
+
+    def _iter_points(self):
+        point_class = self.point_class
+        for first in xrange(0, len(self), self.BUFFER_SIZE):
+            times, values = self._read(first, self.BUFFER_SIZE)
+            for t, v in izip(times.tolist(), values.tolist()):
+                yield point_class(t, v)
+
+    def __getitem__(self, i):
+        if self._loaded is not None or isinstance(i, slice):
+            return self._points[i]
+        count = len(self)
+        if i < 0:
+            i += count
+        if not 0 <= i < count:
+            raise IndexError('signal index out of range')
+        times, values = self._read(i, 1)
+        return self.point_class(times.tolist()[0], values.tolist()[0])
+
+    def __repr__(self):
+        return "%s(%d points in %s)" % (self.__class__.__name__, len(self), self._ts_path)
+
+    def __eq__(self, other):
+        return isinstance(other, self.signal_class) and len(self) == len(other) and \
+            all(p1 == p2 for p1, p2 in izip(self, other))
+
+    # the points list of in-memory signals, used by the inherited operations
+
+    @property
+    def _points(self):
+        return self.load()._points
+
+    @_points.setter
+    def _points(self, points):
+        self.load()._points = points
+
+    @property
+    def _keys(self):
+        return self.load()._keys
+
+    @_keys.setter
+    def _keys(self, keys):
+        self.load()._keys = keys
+
+    def add_point(self, timestamp, value, auto_cast=False):
+        if self._loaded is not None:
+            self._loaded.add_point(timestamp, value, auto_cast)
+            return self
+
+        if auto_cast:
+            value = self.cast_value(value)
+        else:
+            self._check_value(value)
+
+        timestamp = to_milliseconds(timestamp)
+        if self._last is None or timestamp > self._last[0]:
+            # most common case : the point is after the end of the signal, and is added only if it changes
+            # the signal value
+            if self._last is None or value != self._last[1]:
+                self._buffer_point(timestamp, value)
+        else:
+            self._add_point_before_end(timestamp, value)
+        return self
+
+    def _add_point_before_end(self, timestamp, value):
+        """ Adds a point which is not after the end of the signal.
+
+        The in-memory signal insertion is applied to the tail of the signal starting at the point preceding
+        the insertion position, which gives the same result as for the whole signal since the insertion only
+        depends on the points surrounding this position.
+        """
+        times = self.as_arrays()[0]
+        first = max(int(np.searchsorted(times, timestamp, side='left')) - 1, 0)
+        del times
+        tail = self._memory_signal(*self._read(first))
+        tail.add_point(timestamp, value)
+        self._truncate(first)
+        for point in tail.points:
+            self._buffer_point(point.timestamp, point.value)
+        self.flush()
+
+    def _buffer_point(self, timestamp, value):
+        self._buf_times.append(timestamp)
+        self._buf_values.append(value)
+        self._last = timestamp, value
+        if len(self._buf_times) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered points. """
+        count = len(self._buf_times)
+        if not count:
+            return
+        for path, data, dtype in (
+                (self._ts_path, self._buf_times, np.int64),
+                (self._val_path, self._buf_values, np.float64)
+        ):
+            with open(path, 'ab') as fp:
+                np.asarray(data, dtype=dtype).tofile(fp)
+        self._buf_times, self._buf_values = [], []
+        self._flushed += count
+        run_metrics.add('spilled_bytes', count * _ITEM_SIZE * 2)
+
+    def _read(self, first=0, count=None):
+        """ Reads points from the files.
+
+        :return: the times (int64 msecs) and values (float64) arrays
+        """
+        self.flush()
+        if count is None:
+            count = self._flushed - first
+        count = max(min(count, self._flushed - first), 0)
+        arrays = []
+        for path, dtype in ((self._ts_path, np.int64), (self._val_path, np.float64)):
+            with open(path, 'rb') as fp:
+                fp.seek(first * _ITEM_SIZE)
+                arrays.append(np.fromfile(fp, dtype=dtype, count=count))
+        return tuple(arrays)
+
+    def _truncate(self, count):
+        """ Keeps the given count of points in the files. """
+        self.flush()
+        for path in (self._ts_path, self._val_path):
+            with open(path, 'r+b') as fp:
+                fp.truncate(count * _ITEM_SIZE)
+        self._flushed = count
+        if count:
+            point = self[count - 1]
+            self._last = point.timestamp, point.value
+        else:
+            self._last = None
+
+    def _memory_signal(self, times, values):
+        """ Returns an in-memory signal holding exactly the given points.
+
+        (the constructor of signals sorts and reduces the points)
+        """
+        signal = self.signal_class()
+        for t, v in izip(times.tolist(), values.tolist()):
+            signal._append_point(t, v)
+        return signal
+
+    def load(self):
+        """ Loads the signal in memory.
+
+        :return: the in-memory signal, which stays the reference content of the spilled one until
+        :py:meth:`unload` is called
+        """
+        if self._loaded is None:
+            self._loaded = self._memory_signal(*self._read())
+        return self._loaded
+
+    def unload(self):
+        """ Moves the signal back to disk if it has been loaded in memory. """
+        if self._loaded is None:
+            return
+        loaded, self._loaded = self._loaded, None
+        self._truncate(0)
+        for point in loaded:
+            self._buffer_point(point.timestamp, point.value)
+        self.flush()
+
+    def as_arrays(self):
+        """ Returns the times (int64 msecs) and values (float64) as memory-mapped arrays.
+
+        The arrays are not valid anymore once points are added before the end of the signal.
+
+        :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+        """
+        self.unload()
+        self.flush()
+        if not self._flushed:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        return (
+            np.memmap(self._ts_path, dtype=np.int64, mode='r'),
+            np.memmap(self._val_path, dtype=np.float64, mode='r')
+        )
+
+    def materialize(self):
+        """ Returns the equivalent in-memory signal. """
+        self.unload()
+        return self._memory_signal(*self._read())
+
+    def clear(self):
+        self._loaded = None
+        self._buf_times, self._buf_values = [], []
+        self._truncate(0)
+
+    def start_time(self):
+        if self.is_empty:
+            raise ValueError('signal is empty')
+        return self[0].timestamp
+
+    def start_value(self):
+        if self.is_empty:
+            raise ValueError('signal is empty')
+        return self[0].value
+
+    def end_time(self):
+        if self.is_empty:
+            raise ValueError('signal is empty')
+        return self[-1].timestamp
+
+    def end_value(self):
+        if self.is_empty:
+            raise ValueError('signal is empty')
+        return self[-1].value
+
+    def get_value_at(self, timestamp, **kwargs):
+        if self._loaded is not None:
+            return self._loaded.get_value_at(timestamp, **kwargs)
+        if self.is_empty:
+            raise ValueError('signal is empty')
+
+        # the value only depends on the points surrounding the requested time, and on the first one
+        times = self.as_arrays()[0]
+        i = int(np.searchsorted(times, to_milliseconds(timestamp), side='right'))
+        del times
+        window = self._memory_signal(*self._read(max(i - 1, 0), 2 if i else 1))
+        return window.get_value_at(timestamp, **kwargs)
+
+    def get_slice(self, start_time, end_time):
+        if self._loaded is not None:
+            return self._loaded.get_slice(start_time, end_time)
+        if self.is_empty:
+            raise ValueError('signal is empty')
+
+        times = self.as_arrays()[0]
+        first = int(np.searchsorted(times, start_time, side='left'))
+        last = int(np.searchsorted(times, end_time, side='right'))
+        del times
+        return self._memory_signal(*self._read(first, last - first))
+
+    def merge(self, other, keep_our_points=True):
+        if isinstance(other, SpilledSignal):
+            other = other.materialize()
+        return self.materialize().merge(other, keep_our_points)
+
+
+_spilled_classes = {}
+
+
+def spilled_class(signal_class):
+    """ Returns the disk-backed counterpart of a numeric signal class.
+
+    :param signal_class: the class of the in-memory signals (AnalogSignal, LogicSignal or a subclass of them)
+    :rtype: type
+    :raise TypeError: if the signals of this class cannot be spilled
+    """
+    if not is_spillable(signal_class):
+        raise TypeError('signals cannot be spilled : %s' % signal_class.__name__)
+    try:
+        return _spilled_classes[signal_class]
+    except KeyError:
+        cls = _spilled_classes[signal_class] = type(
+            'Spilled' + signal_class.__name__, (SpilledSignal, signal_class), {'signal_class': signal_class}
+        )
+        return cls
+
+
+class MemoryBudget(object):
+    """ The memory budget of an analyzer run """
+    # the directory hosting the spill areas of the budgets created without an explicit one
+    spill_dir = SPILL_DIR
+
+    def __init__(self, limit_mb=None, spill_dir=None, logger=None):
+        """
+        :param float limit_mb: the budget (MB), None for no limit
+        :param str spill_dir: the directory hosting the spill areas (default: :py:attr:`spill_dir`)
+        """
+        self.limit = int(limit_mb * MB) if limit_mb else None
+        self.spilling = False
+        self._spill_dir = spill_dir or self.spill_dir
+        self._area = None
+        self._logger = logger
+
+    def check(self):
+        """ Checks the resident memory against the budget.
+
+        Once the budget has been exceeded, the run goes on spilling until its end, even if the memory
+        usage decreases in the meantime.
+
+        :return: True if the budget has been exceeded
+        """
+        if self.limit and not self.spilling:
+            rss = rss_bytes()
+            if rss is not None and rss > self.limit:
+                self.spilling = True
+                if self._logger:
+                    self._logger.warn(
+                        'memory budget exceeded (rss=%dMB budget=%dMB) : spilling to disk', rss // MB, self.limit // MB
+                    )
+        return self.spilling
+
+    @property
+    def area(self):
+        if self._area is None or self._area.pid != os.getpid():
+            self._area = SpillArea(self._spill_dir)
+        return self._area
+
+    def spill_signal(self, signal):
+        """ Moves a signal to disk if it is spillable.
+
+        :return: the spilled signal, or the original one if it cannot be spilled
+        """
+        if isinstance(signal, SpilledSignal) or not is_spillable(type(signal)):
+            return signal
+        run_metrics.add('spilled_signals')
+        return SpilledSignal.from_signal(signal, self.area)
+
+    def new_signal(self, signal_class):
+        """ Creates a signal, disk-backed if the budget has been exceeded and its class is spillable. """
+        if self.spilling and is_spillable(signal_class):
+            run_metrics.add('spilled_signals')
+            return spilled_class(signal_class)(self.area)
+        return signal_class()
+
+    def buffer(self, shape, dtype=np.float64):
+        """ Allocates an intermediate buffer, memory-mapped on disk if the budget has been exceeded.
+
+        :rtype: numpy.ndarray
+        """
+        if self.check():
+            return np.memmap(self.area.new_file('.buf'), dtype=dtype, mode='w+', shape=shape)
+        return np.empty(shape, dtype=dtype)
+
+    def release(self):
+        """ Removes the spilled data of the current process. """
+        if self._area is not None and self._area.pid == os.getpid():
+            self._area.close()
+            self._area = None
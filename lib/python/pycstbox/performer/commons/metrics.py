@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+""" Metrics of the analytics runs.
+
+Metrics are collected during a run in the module level :py:data:`run_metrics` collector, which the
+analyzers and the mixins update for the indicator being processed. At the end of the run, they are
+written in the Prometheus text exposition format, in a file intended to be picked by the textfile
+collector of node_exporter.
+"""
+
+import os
+import re
+import time
+from collections import OrderedDict
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+METRICS_DIR = '/var/lib/prometheus/node-exporter'
+PREFIX = 'performer_analytics'
+
+# the per-indicator counters, with their help text
+COUNTERS = OrderedDict((
+    ('events_read', 'Events read from the events database'),
+    ('points_uploaded', 'Points uploaded to the PDW'),
+    ('upload_bytes', 'Size of the payloads uploaded to the PDW'),
+    ('upload_raw_bytes', 'Uncompressed size of the series uploaded to the PDW'),
+    ('upload_requests', 'Upload requests sent to the PDW'),
+    ('upload_seconds', 'Cumulated duration of the upload requests'),
+    ('upload_max_seconds', 'Duration of the slowest upload request'),
+    ('pdw_requests', 'Requests sent to the PDW'),
+    ('pdw_errors', 'Failed PDW requests'),
+    ('result_cache_hits', 'Intermediate results obtained from the cache'),
+    ('result_cache_misses', 'Intermediate results computed and stored in the cache'),
+    ('spilled_signals', 'Signals moved to disk for exceeding the memory budget'),
+    ('spilled_bytes', 'Size of the data moved to disk for exceeding the memory budget'),
+    ('peak_rss_bytes', 'Peak resident memory of the analyzer process and its shard workers '
+                       '(analyzers run in their own process only)'),
+    ('rss_peak_growth_bytes', 'Growth of the runner peak resident memory during the computation '
+                              '(analyzers run in the runner process only)'),
+))
+
+# counters which aggregate by max instead of sum
+_MAX_COUNTERS = ('upload_max_seconds', 'peak_rss_bytes', 'rss_peak_growth_bytes')
+
+
+class RunMetrics(object):
+    """ Collector of the metrics of a run """
+    def __init__(self):
+        self._indicators = OrderedDict()
+        self._current = None
+
+    @property
+    def current(self):
+        """ The name of the indicator being processed """
+        return self._current
+
+    def begin_indicator(self, name):
+        self._indicators[name] = {'counters': dict.fromkeys(COUNTERS, 0), 'duration': None, 'success': None}
+        self._current = name
+
+    def end_indicator(self, duration, success):
+        data = self._indicators[self._current]
+        data['duration'] = duration
+        data['success'] = success
+        self._current = None
+
+    def add(self, counter, value=1):
+        """ Updates a counter of the current indicator.
+
+        Updates done outside the processing of an indicator are ignored.
+        """
+        if self._current is None:
+            return
+        counters = self._indicators[self._current]['counters']
+        if counter in _MAX_COUNTERS:
+            counters[counter] = max(counters[counter], value)
+        else:
+            counters[counter] += value
+
+    def counters(self):
+        """ Returns a copy of the counters of the current indicator. """
+        if self._current is None:
+            return {}
+        return dict(self._indicators[self._current]['counters'])
+
+    def merge_counters(self, counters, since=None):
+        """ Adds counters collected in another process to the ones of the current indicator.
+
+        :param dict counters: the counters to be added
+        :param dict since: the counters values when the other process started, if it has inherited them
+        """
+        since = since or {}
+        for counter, value in counters.iteritems():
+            if counter not in _MAX_COUNTERS:
+                value -= since.get(counter, 0)
+            self.add(counter, value)
+
+    def indicators(self):
+        return self._indicators.items()
+
+    def format(self, period, success, run_duration, last_success=None):
+        """ Returns the metrics in Prometheus text format.
+
+        :param str period: the name of the run period
+        :param bool success: the run outcome
+        :param float run_duration: the run duration (seconds)
+        :param float last_success: the time stamp of the last successful run of the period (if any)
+        :rtype: str
+        """
+        lines = []
+
+        def metric(name, help_text, samples):
+            name = '%s_%s' % (PREFIX, name)
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                lines.append('%s{%s} %s' % (
+                    name, ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels), _format_value(value)
+                ))
+
+        period_label = ('period', period)
+        metric('run_success', 'Outcome of the last run (1 if successful)', [((period_label,), int(bool(success)))])
+        metric('run_duration_seconds', 'Duration of the last run', [((period_label,), run_duration)])
+        if last_success:
+            metric('last_success_timestamp_seconds', 'Time of the last successful run', [((period_label,), last_success)])
+
+        indicators = [(name, data) for name, data in self._indicators.iteritems() if data['duration'] is not None]
+        if indicators:
+            def samples(key):
+                return [((period_label, ('indicator', name)), key(data)) for name, data in indicators]
+
+            metric('indicator_success', 'Outcome of the indicator computation (1 if successful)',
+                   samples(lambda d: int(bool(d['success']))))
+            metric('indicator_duration_seconds', 'Duration of the indicator computation',
+                   samples(lambda d: d['duration']))
+            for counter, help_text in COUNTERS.iteritems():
+                metric('indicator_' + counter, help_text, samples(lambda d: d['counters'][counter]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, metrics_dir, period, success, run_duration):
+        """ Writes the metrics in the file of the period, for node_exporter textfile collector.
+
+        The file is replaced atomically. The time stamp of the last successful run is kept from the
+        previous file content if this run failed.
+
+        :return: the path of the written file
+        :rtype: str
+        """
+        path = os.path.join(metrics_dir, '%s_%s.prom' % (PREFIX, period))
+        last_success = time.time() if success else read_last_success(path)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(self.format(period, success, run_duration, last_success))
+        os.rename(tmp_path, path)
+        return path
+
+
+def read_last_success(path):
+    """ Returns the time stamp of the last successful run recorded in a metrics file, if any. """
+    pattern = re.compile(r'^%s_last_success_timestamp_seconds\{[^}]*\} (\S+)$' % PREFIX)
+    try:
+        with open(path) as fp:
+            for line in fp:
+                match = pattern.match(line.strip())
+                if match:
+                    return float(match.group(1))
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+run_metrics = RunMetrics()
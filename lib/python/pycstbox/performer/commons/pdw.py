@@ -2,16 +2,38 @@
 
 import requests
 import datetime
+import time
 import zipfile
+import zlib
+import struct
 import cStringIO
 import json
+import urlparse
+from collections import OrderedDict, namedtuple
+
+from pycstbox.performer.commons.metrics import run_metrics
+from pycstbox.performer.commons import localstore
 
 __author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 
 
+# (connect, read) timeouts (in seconds) applied to PDW requests
+REQUEST_TIMEOUT = (10, 120)
+
+# upper bound of the size of a series upload request payload (bytes)
+MAX_PAYLOAD_SIZE = 256 * 1024
+# deflate level of the series archives members
+COMPRESS_LEVEL = 9
+
+
 class PDWConnectorMixin(object):
     URL = "http://pdw.performerproject.eu/api/dss/sites/%(site_id)s/%(path)s"
     LOCAL_STORE = "/var/db/cstbox/pdw.dat"
+    REQUEST_TIMEOUT = REQUEST_TIMEOUT
+    MAX_PAYLOAD_SIZE = MAX_PAYLOAD_SIZE
+
+    # variables lists of the sites, shared by all the connectors of the process
+    _known_variables = {}
 
     def __init__(self, logger, report_to=None, dry_run=False, **kwargs):
         self._logger = logger.getChild('pdw')
@@ -24,20 +46,26 @@ class PDWConnectorMixin(object):
         :param int site_id: the id of the site
         :param str var_name: the name of the variable
         :param dict var_meta: meta data of the variable (refer to PDW services specifications, part 5.1 for details)
-        :param list known_vars: the list of known variables. If passed, the PDW will not be queried for it.
+        :param list known_vars: the list of known variables. If passed, or if the list has already been obtained
+        for the site by this process, the PDW will not be queried for it.
         :return: the updated known variables list
         :rtype: list
         """
-        if not known_vars:
+        if not known_vars and site_id in self._known_variables:
+            known_vars = self._known_variables[site_id]
+            self._logger.info("using known variables list of site id=%s (len=%d)", site_id, len(known_vars))
+
+        elif not known_vars:
             self._logger.info("getting existing variables list for site id=%s", site_id)
-            reply = requests.get(self.URL % {"site_id": site_id, 'path': 'varlist'})
+            run_metrics.add('pdw_requests')
             try:
-                reply.raise_for_status()
-            except (requests.HTTPError, requests.ConnectionError) as e:
+                known_vars = self._pdw_proxy().site_variables(site_id)
+            except (requests.RequestException, PDWConnectorError) as e:
+                run_metrics.add('pdw_errors')
                 self._logger.error(e)
                 return None
             else:
-                known_vars = reply.json()['varlist']
+                self._known_variables[site_id] = known_vars
                 if known_vars:
                     self._logger.info('--> %d variable(s) already defined', len(known_vars))
                 else:
@@ -57,31 +85,29 @@ class PDWConnectorMixin(object):
                 raise ValueError(msg)
 
             try:
-                definition = [{
-                    'name': var_name,
-                    'type': var_meta['type'],
-                    'unit': var_meta.get('unit', 'none'),
-                }]
-            except KeyError as e:
-                msg = 'missing property "%s" in variable meta data' % e
-                self._logger.error(msg)
-                raise ValueError(msg)
+                definition = [self._variable_definition(var_name, var_meta)]
+            except ValueError as e:
+                self._logger.error(e)
+                raise
 
             else:
                 request = self.URL % {"site_id": site_id, 'path': 'vardefs'}
                 if not self._dry_run:
                     if True:
+                        run_metrics.add('pdw_requests')
                         reply = requests.put(
                             request,
                             json=definition,
                             headers={
                                 "Content-Type": "application/json",
                                 "Content-Disposition": "attachment;filename=vardefs.json"
-                            }
+                            },
+                            timeout=self.REQUEST_TIMEOUT
                         )
                         try:
                             reply.raise_for_status()
                         except requests.HTTPError as e:
+                            run_metrics.add('pdw_errors')
                             msg = 'variable creation failure (%s:%s) : %s' % (site_id, var_name, e)
                             self._logger.error(msg)
                             raise PDWConnectorError(msg)
@@ -116,11 +142,82 @@ class PDWConnectorMixin(object):
                 else:
                     self._simulate(request, definition)
 
-            # update the known variables list
+            # update the known variables list, without adding simulated declarations to the one shared
+            # by the process
+            if self._dry_run and known_vars is self._known_variables.get(site_id):
+                known_vars = list(known_vars)
             known_vars.append(var_name)
 
         return known_vars
 
+    @staticmethod
+    def _variable_definition(var_name, var_meta):
+        try:
+            return {
+                'name': var_name,
+                'type': var_meta['type'],
+                'unit': var_meta.get('unit', 'none'),
+            }
+        except KeyError as e:
+            raise ValueError('missing property "%s" in variable meta data' % e)
+
+    def _pdw_proxy(self):
+        return PDW(host=urlparse.urlparse(self.URL).netloc, timeout=self.REQUEST_TIMEOUT)
+
+    def declare_pdw_variables(self, site_id, var_defs):
+        """ Declares in a single request the variables not yet defined in the PDW.
+
+        The variables list of the site is obtained once, and then shared with
+        :py:meth:`create_pdw_variable_if_needed`, so that the analyzers storing their outputs in the
+        declared variables do not query it again.
+
+        :param int site_id: the id of the site
+        :param dict var_defs: the meta data of the variables (see :py:meth:`create_pdw_variable_if_needed`),
+        keyed by variable name
+        :return: the names of the variables which have been declared
+        :rtype: list
+        :raise ValueError: if the meta data of a variable is invalid
+        :raise PDWConnectorError: if the PDW request failed
+        """
+        pdw = self._pdw_proxy()
+
+        known_vars = self._known_variables.get(site_id)
+        if known_vars is None:
+            self._logger.info("getting existing variables list for site id=%s", site_id)
+            run_metrics.add('pdw_requests')
+            try:
+                known_vars = self._known_variables[site_id] = pdw.site_variables(site_id)
+            except (requests.RequestException, PDWConnectorError) as e:
+                run_metrics.add('pdw_errors')
+                msg = 'cannot get variables list (site id=%s) : %s' % (site_id, e)
+                self._logger.error(msg)
+                raise PDWConnectorError(msg)
+            self._logger.info('--> %d variable(s) already defined', len(known_vars))
+
+        missing = sorted(set(var_defs) - set(known_vars))
+        if not missing:
+            self._logger.info('all the %d variable(s) are already defined for site id=%s', len(var_defs), site_id)
+            return []
+
+        definitions = [self._variable_definition(name, var_defs[name]) for name in missing]
+        self._logger.info('declaring %d variable(s) for site id=%s', len(definitions), site_id)
+        if not self._dry_run:
+            run_metrics.add('pdw_requests')
+            try:
+                pdw.variables_definition_upload(site_id, definitions)
+            except requests.RequestException as e:
+                run_metrics.add('pdw_errors')
+                msg = 'variables creation failure (site id=%s) : %s' % (site_id, e)
+                self._logger.error(msg)
+                raise PDWConnectorError(msg)
+            else:
+                self._logger.info('variables created (%s:%s)', site_id, ', '.join(missing))
+                known_vars.extend(missing)
+        else:
+            self._simulate(pdw.site_url(site_id, 'vardefs'), definitions)
+
+        return missing
+
     def _simulate(self, request, data=None):
         self._logger.info('DRY RUN: simulating PUT request : req=%s data=%s', request, data)
 
@@ -130,76 +227,280 @@ class PDWConnectorMixin(object):
         ..important:: If the timestamp parameter is provided, it must be compatible to what is accepted by the
         :py:meth:`arrow.get() method from Arrow package (see http://crsmithdev.com/arrow/).
 
+        The points are packed by :py:class:`SeriesPayloadBuilder`, and sent in as many requests as needed
+        for each payload not to exceed :py:attr:`MAX_PAYLOAD_SIZE`. The points are also appended to
+        :py:attr:`LOCAL_STORE` by a background writer (see :py:mod:`pycstbox.performer.commons.localstore`).
+
         :param points: an iterable of tuples (var_name, value)
         :param timestamp: the timestamp to be used for the new points. Defaulted to current time
+        :raise PDWConnectorError: if an upload request failed
         """
         # ensure the list of points can be traversed several times (we can need this by the end of the method)
         if not isinstance(points, (list, tuple)):
             points = [p for p in points]
-        var_names, _ = zip(*points)
-
-        sio = cStringIO.StringIO()
-        try:
-            zf = zipfile.ZipFile(sio, 'w', zipfile.ZIP_DEFLATED)
-            try:
-                timestamp = timestamp or datetime.datetime.utcnow().date()
-                ts_iso = timestamp.isoformat()
-                with open(self.LOCAL_STORE, 'a') as fp:
-                    for name, value in points:
-                        zf.writestr(name + ".tsv", '%s\t%s\n' % (ts_iso, value))
-                        fp.write("%s\t%s\t%s\n" % (name, ts_iso, value))
-
-            finally:
-                zf.close()
 
-        finally:
-            sio.seek(0)
+        timestamp = timestamp or datetime.datetime.utcnow().date()
+        ts_iso = timestamp.isoformat()
+        builder = SeriesPayloadBuilder(self.MAX_PAYLOAD_SIZE)
+        for name, value in points:
+            builder.add(name, ts_iso, value)
+        # written in the background, so that the upload does not wait for the local storage
+        localstore.get_writer(self.LOCAL_STORE).write_lines(
+            "%s\t%s\t%s\n" % (name, ts_iso, value) for name, value in points
+        )
 
         self._logger.info("storing points for site id=%s: %s", site_id, [(name, value) for name, value in points])
 
+        payloads = builder.payloads()
         request = self.URL % {"site_id": site_id, 'path': 'series'}
-        if not self._dry_run:
-            reply = requests.put(
-                request,
-                files={
-                    'file': sio
-                },
-                headers={
-                    "Content-Type": "application/zip",
-                    "Content-Disposition": "attachment;filename=temp.zip"
-                }
+        for num, payload in enumerate(payloads, 1):
+            self._logger.info(
+                '.. payload %d/%d : %d point(s), %d bytes (compression ratio=%.1f)',
+                num, len(payloads), payload.points, len(payload.data), payload.compression_ratio
             )
+            if self._dry_run:
+                self._simulate(request)
+                continue
+
+            run_metrics.add('pdw_requests')
+            started = time.time()
             try:
+                reply = requests.put(
+                    request,
+                    files={
+                        'file': cStringIO.StringIO(payload.data)
+                    },
+                    headers={
+                        "Content-Type": "application/zip",
+                        "Content-Disposition": "attachment;filename=temp.zip"
+                    },
+                    timeout=self.REQUEST_TIMEOUT
+                )
                 reply.raise_for_status()
-            except requests.HTTPError as e:
+            except requests.RequestException as e:
+                run_metrics.add('pdw_errors')
                 msg = '!! failed : %s' % e
+                if len(payloads) > 1:
+                    msg += ' (payload %d out of %d)' % (num, len(payloads))
+                if num > 1:
+                    # the previous payloads are committed in the PDW
+                    committed = sorted(set(name for p in payloads[:num - 1] for name in p.variables))
+                    msg += ' - already uploaded : payload(s) 1 to %d, variable(s) %s' % (
+                        num - 1, ', '.join(committed)
+                    )
                 self._logger.error(msg)
                 raise PDWConnectorError(msg)
             else:
-                self._logger.info('.. success')
+                elapsed = time.time() - started
+                for counter, value in (
+                        ('points_uploaded', payload.points),
+                        ('upload_bytes', len(payload.data)),
+                        ('upload_raw_bytes', payload.raw_size),
+                        ('upload_requests', 1),
+                        ('upload_seconds', elapsed),
+                        ('upload_max_seconds', elapsed)
+                ):
+                    run_metrics.add(counter, value)
 
-        else:
-            self._simulate(request)
+        if not self._dry_run:
+            self._logger.info('.. success')
+
+
+class SeriesPayload(namedtuple('SeriesPayload', 'data points raw_size variables')):
+    """ A series upload payload (zip archive content), with the names of the variables it contains """
+    @property
+    def compression_ratio(self):
+        return float(self.raw_size) / len(self.data) if self.data else 1.
+
+
+_ZipMember = namedtuple('_ZipMember', 'name data raw_size crc compress_type points')
+
+
+class SeriesPayloadBuilder(object):
+    """ Packs points in the zip archives expected by the series upload service.
+
+    The points of a variable are grouped in a single ``<var_name>.tsv`` member, with one
+    ``<timestamp>\t<value>`` line per point. Members are deflated only when it makes them smaller, which
+    is not the case of the tiny ones. The archives are split so that none exceeds the maximum payload
+    size, the points of a variable being spread over several archives if needed.
+
+    The archives are assembled from the members deflated when sizing them, since the zipfile module would
+    deflate them again (and does not support setting the deflate level with Python 2).
+
+    Since the upload format requires a member per variable, the payloads of single points (as stored by
+    :py:meth:`PDWConnectorMixin.store_single_points`) are not smaller than with one member per point :
+    their size is dominated by the zip structures of the members, which cannot be shared by several
+    variables. The gain is then limited to the assembly time and the number of requests.
+    """
+    # size of the zip structures of a member, besides its name and data (local and central headers)
+    MEMBER_OVERHEAD = 30 + 46
+    # size of the zip end of central directory record
+    ARCHIVE_OVERHEAD = 22
+    # deflating smaller data never makes them smaller
+    MIN_DEFLATED_SIZE = 16
+
+    def __init__(self, max_size=MAX_PAYLOAD_SIZE, compress_level=COMPRESS_LEVEL):
+        """
+        :param int max_size: the maximum size of a payload (bytes)
+        :param int compress_level: the deflate level of the members
+        """
+        if max_size <= 1024:
+            raise ValueError('max_size too small : %s' % max_size)
+        self._max_size = max_size
+        self._compress_level = compress_level
+        self._lines = OrderedDict()
+
+    def add(self, var_name, timestamp, value):
+        """ Adds a point.
+
+        :param str var_name: the variable name
+        :param str timestamp: the point time, in ISO format
+        :param value: the point value
+        """
+        try:
+            self._lines[var_name].append('%s\t%s\n' % (timestamp, value))
+        except KeyError:
+            self._lines[var_name] = ['%s\t%s\n' % (timestamp, value)]
+
+    def _members(self):
+        """ Returns the archive members.
+
+        Variables which data would not fit in a payload are split in several members.
+
+        :rtype: list of [_ZipMember]
+        """
+        members = []
+        for var_name, lines in self._lines.iteritems():
+            name = var_name + '.tsv'
+            data_max = self._max_size - self.ARCHIVE_OVERHEAD - self.MEMBER_OVERHEAD - 2 * len(name)
+            if data_max <= 0:
+                raise ValueError('variable name too long : %s' % var_name)
+
+            chunk, size = [], 0
+            for line in lines:
+                if chunk and size + len(line) > data_max:
+                    members.append(self._member(name, chunk))
+                    chunk, size = [], 0
+                chunk.append(line)
+                size += len(line)
+            if chunk:
+                members.append(self._member(name, chunk))
+        return members
+
+    def _member(self, name, lines):
+        data = ''.join(lines)
+        crc = zlib.crc32(data) & 0xffffffff
+        if len(data) >= self.MIN_DEFLATED_SIZE:
+            # raw deflate stream, as stored in zip archives
+            compressor = zlib.compressobj(self._compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            deflated = compressor.compress(data) + compressor.flush()
+            if len(deflated) < len(data):
+                return _ZipMember(name, deflated, len(data), crc, zipfile.ZIP_DEFLATED, len(lines))
+        return _ZipMember(name, data, len(data), crc, zipfile.ZIP_STORED, len(lines))
+
+    def _member_size(self, member):
+        return len(member.data) + self.MEMBER_OVERHEAD + 2 * len(member.name)
+
+    def payloads(self):
+        """ Returns the payloads containing all the added points.
+
+        :rtype: list of [SeriesPayload]
+        """
+        batches, batch, batch_size = [], [], self.ARCHIVE_OVERHEAD
+        for member in self._members():
+            size = self._member_size(member)
+            # the chunks of a split variable go in distinct archives, since member names must be unique
+            if batch and (batch_size + size > self._max_size or member.name == batch[-1].name):
+                batches.append(batch)
+                batch, batch_size = [], self.ARCHIVE_OVERHEAD
+            batch.append(member)
+            batch_size += size
+        if batch:
+            batches.append(batch)
+
+        return [self._archive(members) for members in batches]
+
+    def _archive(self, members):
+        year, month, day, hour, minute, second = time.gmtime()[:6]
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+
+        sio = cStringIO.StringIO()
+        central_dir = []
+        for m in members:
+            offset = sio.tell()
+            sio.write(struct.pack(
+                zipfile.structFileHeader, zipfile.stringFileHeader, 20, 0, 0, m.compress_type,
+                dos_time, dos_date, m.crc, len(m.data), m.raw_size, len(m.name), 0
+            ))
+            sio.write(m.name)
+            sio.write(m.data)
+            central_dir.append(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir, 20, 3, 20, 0, 0, m.compress_type,
+                dos_time, dos_date, m.crc, len(m.data), m.raw_size, len(m.name), 0, 0, 0, 0, 0o600 << 16, offset
+            ) + m.name)
+
+        central_dir = ''.join(central_dir)
+        central_dir_offset = sio.tell()
+        sio.write(central_dir)
+        sio.write(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, len(members), len(members),
+            len(central_dir), central_dir_offset, 0
+        ))
+        return SeriesPayload(
+            sio.getvalue(), sum(m.points for m in members), sum(m.raw_size for m in members),
+            [m.name[:-len('.tsv')] for m in members]
+        )
 
 
 class PDW(object):
     """ Proxy class for the PERFORMER Data Warehouse """
     URL_BASE = "http://%(host)s/api/dss/"
+    DEFAULT_HOST = "pdw.performerproject.eu"
 
-    def __init__(self, host):
+    def __init__(self, host=DEFAULT_HOST, timeout=REQUEST_TIMEOUT):
         self._url_base = self.URL_BASE % {'host': host}
+        self._timeout = timeout
 
     def _make_request_url(self, route):
         return self._url_base + route
 
-    def variables_definition_upload(self, vardefs):
-        url = self._make_request_url(vardefs)
-        reply = reply = requests.put(
-            url=url,
-            data=vardefs,
+    def site_url(self, site_id, path):
+        return self._make_request_url('sites/%s/%s' % (site_id, path))
+
+    def site_variables(self, site_id):
+        """ Returns the names of the variables defined for a site.
+
+        :param int site_id: the id of the site
+        :rtype: list
+        :raise requests.RequestException: if the request failed
+        :raise PDWConnectorError: if the reply is not a valid variables list
+        """
+        reply = requests.get(self.site_url(site_id, 'varlist'), timeout=self._timeout)
+        reply.raise_for_status()
+        try:
+            variables = reply.json()['varlist']
+        except (ValueError, KeyError, TypeError) as e:
+            raise PDWConnectorError('invalid variables list reply (site id=%s) : %r' % (site_id, e))
+        if not isinstance(variables, list):
+            raise PDWConnectorError('invalid variables list reply (site id=%s) : %r' % (site_id, variables))
+        return variables
+
+    def variables_definition_upload(self, site_id, vardefs):
+        """ Declares a set of variables in a single request.
+
+        :param int site_id: the id of the site
+        :param list vardefs: the variable definitions, as dictionaries with keys `name`, `type` and `unit`
+        :raise requests.RequestException: if the request failed
+        """
+        reply = requests.put(
+            url=self.site_url(site_id, 'vardefs'),
+            data=json.dumps(vardefs),
             headers={
-                "Content-Type": "application/json"
-            }
+                "Content-Type": "application/json",
+                "Content-Disposition": "attachment;filename=vardefs.json"
+            },
+            timeout=self._timeout
         )
         reply.raise_for_status()
 
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+""" Vectorized building blocks for indicators computation.
+
+The functions of this module work on extracted signals (see :py:mod:`evtsignals`) considered as step
+signals : the value of a point holds until the next point, and the value of the last point holds up to the
+end of the analyzed time frame. Nothing is assumed before the first point of a signal, which means that
+this part of the time frame is never accounted for.
+
+Signals can be passed either as :py:class:`evtsignals.base.Signal` instances, or as (times, values)
+tuples of sequences, times being expressed in milliseconds from Epoch.
+
+Time frame bounds are accepted as msecs from Epoch or as naive UTC datetimes. If omitted, they are
+defaulted to the first and last point of the signal.
+
+Durations are returned in milliseconds.
+"""
+
+import numpy as np
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+def _to_msecs(ts):
+    from evtsignals.base import to_milliseconds
+    return to_milliseconds(ts)
+
+
+def signal_arrays(signal):
+    """ Returns the times and values of a signal as numpy arrays.
+
+    :param signal: the signal, or a (times, values) tuple
+    :return: the times (int64 msecs) and values (float64) arrays
+    :rtype: tuple of (numpy.ndarray, numpy.ndarray)
+    """
+    if isinstance(signal, tuple):
+        times, values = signal
+        return np.asarray(times, dtype=np.int64), np.asarray(values, dtype=np.float64)
+
+    as_arrays = getattr(signal, 'as_arrays', None)
+    if as_arrays:
+        return as_arrays()
+
+    points = signal.points
+    count = len(points)
+    return (
+        np.fromiter((p.timestamp for p in points), dtype=np.int64, count=count),
+        np.fromiter((p.value for p in points), dtype=np.float64, count=count)
+    )
+
+
+def _bounds(times, start, end):
+    start = times[0] if start is None else _to_msecs(start)
+    end = times[-1] if end is None else _to_msecs(end)
+    if end < start:
+        raise ValueError('invalid bounds (start=%s end=%s)' % (start, end))
+    return start, end
+
+
+def segment_durations(times, start=None, end=None):
+    """ Returns the time during which each point value holds within the given bounds.
+
+    :param numpy.ndarray times: the sorted points times (msecs)
+    :param start: time frame start
+    :param end: time frame end
+    :return: the durations (msecs), one per point
+    :rtype: numpy.ndarray
+    """
+    if not len(times):
+        return np.zeros(0, dtype=np.int64)
+    start, end = _bounds(times, start, end)
+    seg_start = np.clip(times, start, end)
+    seg_end = np.empty_like(seg_start)
+    seg_end[:-1] = seg_start[1:]
+    seg_end[-1] = end
+    return seg_end - seg_start
+
+
+def time_in_state(signal, start=None, end=None):
+    """ Returns the time while the signal is in the true (non zero) state.
+
+    :param signal: the signal
+    :param start: time frame start
+    :param end: time frame end
+    :return: the time spent in the true state (msecs)
+    :rtype: int
+    """
+    times, values = signal_arrays(signal)
+    durations = segment_durations(times, start, end)
+    return int(durations[values != 0].sum())
+
+
+def time_above(signal, threshold, start=None, end=None, strict=True):
+    """ Returns the time while the signal is above a threshold.
+
+    :param signal: the signal
+    :param float threshold: the threshold
+    :param start: time frame start
+    :param end: time frame end
+    :param bool strict: if False, time while the signal equals the threshold is included
+    :return: the time spent above the threshold (msecs)
+    :rtype: int
+    """
+    times, values = signal_arrays(signal)
+    durations = segment_durations(times, start, end)
+    above = values > threshold if strict else values >= threshold
+    return int(durations[above].sum())
+
+
+def time_below(signal, threshold, start=None, end=None, strict=True):
+    """ Returns the time while the signal is below a threshold.
+
+    See :py:func:`time_above` for parameters.
+    """
+    times, values = signal_arrays(signal)
+    durations = segment_durations(times, start, end)
+    below = values < threshold if strict else values <= threshold
+    return int(durations[below].sum())
+
+
+def state_ratio(signal, start=None, end=None):
+    """ Returns the ratio of the time frame while the signal is in the true state.
+
+    :param signal: the signal
+    :param start: time frame start
+    :param end: time frame end
+    :return: the ratio (in [0, 1]), or None for an empty signal or time frame
+    :rtype: float
+    """
+    times, values = signal_arrays(signal)
+    if not len(times):
+        return None
+    start, end = _bounds(times, start, end)
+    if end == start:
+        return None
+    return float(time_in_state((times, values), start, end)) / (end - start)
+
+
+def time_weighted_average(signal, start=None, end=None):
+    """ Returns the average of a step signal, weighted by the time each value holds.
+
+    Only the part of the time frame covered by the signal is considered.
+
+    :param signal: the signal
+    :param start: time frame start
+    :param end: time frame end
+    :return: the average, or None if the signal does not cover the time frame
+    :rtype: float
+    """
+    times, values = signal_arrays(signal)
+    durations = segment_durations(times, start, end)
+    covered = durations.sum()
+    if not covered:
+        return None
+    return float(np.dot(durations, values)) / covered
+
+
+def state_durations(signal, start=None, end=None):
+    """ Returns the time spent in each of the values taken by the signal.
+
+    :param signal: the signal
+    :param start: time frame start
+    :param end: time frame end
+    :return: the durations (msecs) keyed by value
+    :rtype: dict
+    """
+    times, values = signal_arrays(signal)
+    durations = segment_durations(times, start, end)
+    if not len(durations):
+        return {}
+    states, index = np.unique(values, return_inverse=True)
+    totals = np.bincount(index, weights=durations)
+    return {float(s): int(d) for s, d in zip(states, totals)}
+
+
+def transitions_count(signal, start=None, end=None, rising=True):
+    """ Returns the number of state transitions of the signal within the time frame.
+
+    :param signal: the signal
+    :param start: time frame start
+    :param end: time frame end
+    :param bool rising: if True, only false to true transitions are counted, otherwise all the changes are
+    :return: the transitions count
+    :rtype: int
+    """
+    times, values = signal_arrays(signal)
+    if len(times) < 2:
+        return 0
+    start, end = _bounds(times, start, end)
+    state = values != 0
+    changes = state[1:] != state[:-1]
+    if rising:
+        changes &= state[1:]
+    in_frame = (times[1:] >= start) & (times[1:] <= end)
+    return int(np.count_nonzero(changes & in_frame))
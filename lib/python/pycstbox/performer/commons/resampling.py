@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+""" Vectorized alignment of several signals on a common time line.
+
+Indicators combining several signals (e.g. outdoor, shade and lighting illuminance) need the value of
+each of them at the same instants, while the points of each signal have been recorded at their own
+irregular times. :py:func:`align` does this in a single pass for the whole set of signals, either on a
+regular time grid or on the merged time line of all the points, so that the indicator logic can then be
+expressed as array operations.
+
+Signals are accepted in the same forms as in :py:mod:`pycstbox.performer.commons.primitives`.
+
+Typical usage in a ``process_inputs`` implementation::
+
+    aligned = align(inputs, start=self.time_frame.start, end=self.time_frame.end)
+    lighting_on = aligned['lux_lighting'] > threshold
+    time_on = aligned.durations()[lighting_on & aligned.valid()].sum()
+"""
+
+import numpy as np
+from evtsignals.base import to_milliseconds
+
+from pycstbox.performer.commons.primitives import signal_arrays
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+HOLD, LINEAR = 'hold', 'linear'
+
+
+class AlignedSignals(object):
+    """ The result of the alignment of a set of signals.
+
+    Values of a signal before its first point are set to NaN.
+    """
+    def __init__(self, times, end, values, gaps):
+        self._times = times
+        self._end = end
+        self._values = values
+        self._gaps = gaps
+
+    @property
+    def times(self):
+        """ The common time line (msecs) """
+        return self._times
+
+    @property
+    def names(self):
+        return self._values.keys()
+
+    @property
+    def gaps(self):
+        """ The masks of the points located in data gaps, keyed by signal name """
+        return self._gaps
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __len__(self):
+        return len(self._times)
+
+    def valid(self, names=None):
+        """ Returns the mask of the time line points for which all the given signals are defined and
+        not in a gap.
+
+        :param names: the names of the signals to be considered (default: all)
+        :rtype: numpy.ndarray
+        """
+        mask = np.ones(len(self._times), dtype=bool)
+        for name in names or self._values:
+            mask &= ~np.isnan(self._values[name])
+            mask &= ~self._gaps[name]
+        return mask
+
+    def durations(self):
+        """ Returns the time (msecs) during which each point of the time line holds, the last one holding
+        up to the end of the alignment time frame.
+
+        :rtype: numpy.ndarray
+        """
+        if not len(self._times):
+            return np.zeros(0, dtype=np.int64)
+        return np.diff(np.append(self._times, self._end))
+
+    def as_signal(self, name):
+        """ Returns the aligned values of a signal as a (times, values) tuple, suitable for the primitives
+        functions.
+        """
+        return self._times, self._values[name]
+
+
+def regular_grid(start, end, period):
+    """ Returns a regular time grid.
+
+    :param start: grid start (msecs or naive UTC datetime)
+    :param end: grid end, excluded (msecs or naive UTC datetime)
+    :param float period: grid period (seconds)
+    :rtype: numpy.ndarray
+    """
+    step = int(period * 1000)
+    if step <= 0:
+        raise ValueError('invalid period : %s' % period)
+    return np.arange(to_milliseconds(start), to_milliseconds(end), step, dtype=np.int64)
+
+
+def merged_timeline(arrays, start=None, end=None):
+    """ Returns the sorted union of the points times of a set of signals.
+
+    If a start time is given, it is included in the time line.
+
+    :param arrays: the (times, values) arrays of the signals
+    :param start: time line start (msecs or naive UTC datetime)
+    :param end: time line end (msecs or naive UTC datetime)
+    :rtype: numpy.ndarray
+    """
+    parts = [times for times, _ in arrays]
+    if start is not None:
+        start = to_milliseconds(start)
+        parts.append(np.array([start], dtype=np.int64))
+    if not parts:
+        return np.zeros(0, dtype=np.int64)
+    timeline = np.unique(np.concatenate(parts))
+    if start is not None:
+        timeline = timeline[timeline >= start]
+    if end is not None:
+        timeline = timeline[timeline <= to_milliseconds(end)]
+    return timeline
+
+
+def _sample(times, values, grid, method, max_gap):
+    result = np.full(len(grid), np.nan)
+    gaps = np.zeros(len(grid), dtype=bool)
+    if not len(times):
+        return result, gaps
+
+    # index of the last point at or before each grid time
+    idx = np.searchsorted(times, grid, side='right') - 1
+    defined = idx >= 0
+    idx_def = idx[defined]
+
+    if method == HOLD:
+        result[defined] = values[idx_def]
+        if max_gap is not None:
+            gaps[defined] = grid[defined] - times[idx_def] > max_gap
+    elif method == LINEAR:
+        result[defined] = np.interp(grid[defined], times, values)
+        if max_gap is not None:
+            nxt = np.minimum(idx_def + 1, len(times) - 1)
+            # after the last point, the gap is measured from it
+            span = np.where(nxt > idx_def, times[nxt] - times[idx_def], grid[defined] - times[idx_def])
+            gaps[defined] = span > max_gap
+    else:
+        raise ValueError('invalid method : %s' % method)
+
+    return result, gaps
+
+
+def align(signals, grid=None, period=None, start=None, end=None, method=HOLD, max_gap=None):
+    """ Puts a set of signals on a common time line.
+
+    The time line is, by order of precedence :
+
+    - the explicit `grid` if provided,
+    - a regular grid with the given `period` between `start` and `end`,
+    - the merged time line of all the signals points otherwise.
+
+    Two methods are available for evaluating the signals on the time line :
+
+    - sample and hold (HOLD) : the value of the last point at or before the time is used. This fits
+      signals which points represent value changes, which is the case of sensor events.
+    - linear interpolation (LINEAR) : the value is interpolated between the surrounding points. After the
+      last point, its value is held.
+
+    If `max_gap` is provided, time line points farther than this from the signal points used to evaluate
+    them are flagged in the gaps masks. For the HOLD method, this is the age of the last point, for the
+    LINEAR one, the distance between the surrounding points.
+
+    :param dict signals: the signals, keyed by name
+    :param grid: an explicit time line (sorted msecs)
+    :param float period: the period (seconds) of the regular grid to be used
+    :param start: time frame start (msecs or naive UTC datetime)
+    :param end: time frame end (msecs or naive UTC datetime). Defaulted to the time of the last point
+    :param str method: values evaluation method (HOLD or LINEAR)
+    :param float max_gap: the gap detection threshold (seconds)
+    :return: the aligned signals
+    :rtype: AlignedSignals
+    :raise ValueError: if parameters are invalid
+    """
+    arrays = {name: signal_arrays(signal) for name, signal in signals.iteritems()}
+    if end is None:
+        end = max([times[-1] for times, _ in arrays.itervalues() if len(times)] or [0])
+    else:
+        end = to_milliseconds(end)
+
+    if grid is not None:
+        grid = np.asarray(grid, dtype=np.int64)
+    elif period:
+        if start is None:
+            raise ValueError('start is mandatory with a regular grid')
+        grid = regular_grid(start, end, period)
+    else:
+        grid = merged_timeline(arrays.values(), start, end)
+
+    max_gap_ms = max_gap * 1000 if max_gap is not None else None
+
+    values, gaps = {}, {}
+    for name, (times, vals) in arrays.iteritems():
+        values[name], gaps[name] = _sample(times, vals, grid, method, max_gap_ms)
+
+    return AlignedSignals(grid, end, values, gaps)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+""" Local cache of analyzers intermediate results.
+
+Results are keyed by the indicator name, a hash of the parameters which the computation depends on (see
+:py:func:`params_hash`), a result name and the time frame they have been computed on. They are stored as
+pickle files, under a directory per indicator and parameters hash, and a directory per day::
+
+    <root>/<indicator>-<params_hash>/<YYYY-MM-DD>/<name>-<start>-<end>.pkl
+
+This allows the day, week and month jobs to share the results they compute on the same days. The cache is
+shared by all the processes using the same root, entries being written atomically.
+
+The cache size is bounded : when it is exceeded, the least recently used entries are evicted, an entry being
+used when it is written or read (its modification time is updated on each read).
+"""
+
+import os
+import json
+import errno
+import shutil
+import hashlib
+import cPickle as pickle
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+RESULT_CACHE_DIR = '/var/cache/cstbox/performer/results'
+# default maximum size of the cache (MB)
+RESULT_CACHE_MAX_SIZE = 50
+
+ENTRY_EXT = '.pkl'
+_TIME_FORMAT = '%H%M%S%f'
+
+
+def params_hash(params):
+    """ Returns the hash identifying a set of computation parameters.
+
+    :param dict params: the parameters
+    :rtype: str
+    :raise TypeError: if the parameters are not serializable in JSON. Their hash would not be stable otherwise,
+    the string representation of arbitrary objects being most of the time specific to a process.
+    """
+    try:
+        serialized = json.dumps(params, sort_keys=True)
+    except ValueError as e:
+        # circular references
+        raise TypeError(str(e))
+    return hashlib.sha1(serialized).hexdigest()[:16]
+
+
+class ResultCache(object):
+    """ The store of the cached results """
+    MISS = object()
+
+    def __init__(self, root=RESULT_CACHE_DIR, max_size=RESULT_CACHE_MAX_SIZE):
+        """
+        :param str root: the path of the directory hosting the cache (created if needed)
+        :param float max_size: the maximum size of the cache (MB)
+        """
+        if not root:
+            raise ValueError('root parameter is mandatory')
+        self._root = root
+        self._max_size = int(max_size * 1024 * 1024)
+
+    @property
+    def root(self):
+        return self._root
+
+    def entry_path(self, indicator_name, params_key, name, time_frame):
+        start, end = time_frame.start, time_frame.end
+        return os.path.join(
+            self._root,
+            '%s-%s' % (indicator_name, params_key),
+            start.strftime('%Y-%m-%d'),
+            '%s-%s-%s%s' % (
+                name,
+                start.strftime(_TIME_FORMAT),
+                # frames ending on the next day midnight are not the same as the ones ending a microsecond before
+                end.strftime(_TIME_FORMAT if end.date() == start.date() else 'N' + _TIME_FORMAT),
+                ENTRY_EXT
+            )
+        )
+
+    def get(self, indicator_name, params_key, name, time_frame):
+        """ Returns a cached result.
+
+        :param str indicator_name: the indicator name
+        :param str params_key: the parameters hash (see :py:func:`params_hash`)
+        :param str name: the result name
+        :param TimeFrame time_frame: the time frame the result has been computed on
+        :return: the result, or :py:attr:`MISS` if not in the cache
+        """
+        path = self.entry_path(indicator_name, params_key, name, time_frame)
+        try:
+            with open(path, 'rb') as fp:
+                result = pickle.load(fp)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return self.MISS
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted meanwhile
+            pass
+        return result
+
+    def put(self, indicator_name, params_key, name, time_frame, result):
+        """ Stores a result, evicting the least recently used entries if the cache gets too big.
+
+        The result must be picklable.
+        """
+        path = self.entry_path(indicator_name, params_key, name, time_frame)
+        dir_path = os.path.dirname(path)
+        try:
+            os.makedirs(dir_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump(result, fp, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self.evict()
+
+    def entries(self):
+        """ Returns the cache entries, as (mtime, size, path) tuples. """
+        entries = []
+        for dir_path, _, file_names in os.walk(self._root):
+            for file_name in file_names:
+                if file_name.endswith(ENTRY_EXT):
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in its maximum size.
+
+        :return: the count of removed entries
+        :rtype: int
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+            total -= size
+            removed += 1
+            # remove the emptied directories, up to the root
+            dir_path = os.path.dirname(path)
+            while dir_path != self._root:
+                try:
+                    os.rmdir(dir_path)
+                except OSError:
+                    break
+                dir_path = os.path.dirname(dir_path)
+        return removed
+
+    def clear(self, indicator_name=None):
+        """ Removes all the entries, or the ones of a given indicator. """
+        if not os.path.isdir(self._root):
+            return
+        for name in os.listdir(self._root):
+            if indicator_name is None or name.rsplit('-', 1)[0] == indicator_name:
+                shutil.rmtree(os.path.join(self._root, name), ignore_errors=True)
@@ -5,16 +5,36 @@ import json
 import importlib
 import datetime
 import logging
+import time
+import signal
+import shutil
+import tempfile
+import multiprocessing
+from collections import namedtuple
 
 from pycstbox import log
 from pycstbox.config import CONFIG_DIR
 
-from pycstbox.performer.commons.analytics import PeriodicAnalyzer, AnalyzerError
+from pycstbox.performer.commons.analytics import AbstractAnalyzer, PeriodicAnalyzer, AnalyzerError
+from pycstbox.performer.commons.data import DataAccessMixin
+from pycstbox.performer.commons.metrics import run_metrics, METRICS_DIR
+from pycstbox.performer.commons.memory import MemoryBudget, peak_rss_bytes
+from pycstbox.performer.commons import localstore
+from pycstbox.performer.commons.pdw import PDWConnectorMixin, PDWConnectorError
 
 __author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
 
+AnalyzerSpec = namedtuple('AnalyzerSpec', 'analyzer_class analyzer_params indicator priority timeout')
+
+
+class AnalyzerTimeout(AnalyzerError):
+    """ Raised when an analyzer has been cancelled for exceeding its time budget """
+
 
 class Runner(object):
+    # grace delay (seconds) given to a cancelled analyzer process before killing it
+    CANCEL_GRACE_DELAY = 5
+
     def __init__(self, config_path, period=PeriodicAnalyzer.PERIOD_DAY, logger=None):
         if not config_path:
             raise ValueError('missing config_path parameter')
@@ -26,7 +46,9 @@ class Runner(object):
             raise ValueError('missing period parameter')
 
         self.period = period
-        
+        self.run_deadline = None
+        self.metrics_dir = METRICS_DIR
+
         self.logger = logger or log.getLogger(self.__class__.__name__)
         self.log_info = self.logger.info
         self.log_warn = self.logger.warn
@@ -34,6 +56,15 @@ class Runner(object):
         self.log_exception = self.logger.exception
 
     def prepare_analyzers(self):
+        """ Loads the configuration and prepares the analyzers it defines.
+
+        Analyzers are returned sorted by decreasing priority (configuration item `priority`, 0 if
+        not set), the configuration order being kept for analyzers of the same priority.
+
+        :return: the analyzers specifications
+        :rtype: list of [AnalyzerSpec]
+        :raise AnalyzerError: in case of configuration error
+        """
         analyzers = []
 
         try:
@@ -50,6 +81,30 @@ class Runner(object):
 
         cfg_analyzers_module = defaults.get("analyzers_module", None)
 
+        self.metrics_dir = defaults.get('metrics_dir', self.metrics_dir)
+
+        event_source = defaults.get('event_source', None)
+        if event_source:
+            try:
+                backend = event_source.pop('backend')
+            except KeyError:
+                raise AnalyzerError('missing backend in event source configuration')
+            self.log_info('event source : %s %s', backend, event_source)
+            DataAccessMixin.configure_event_source(backend, **event_source)
+
+        result_cache = defaults.get('result_cache', None)
+        if result_cache:
+            try:
+                AbstractAnalyzer.configure_result_cache(**result_cache)
+            except TypeError as e:
+                raise AnalyzerError('invalid result cache configuration (%s)' % e)
+            self.log_info('result cache : %s', result_cache)
+
+        default_timeout = self._duration(defaults.get('analyzer_timeout', None), 'analyzer_timeout')
+        self.run_deadline = self._duration(defaults.get('run_deadline', None), 'run_deadline')
+        if self.run_deadline:
+            self.log_info('run deadline : %ss', self.run_deadline)
+
         try:
             imported_config = cfg_data['import']
         except KeyError:
@@ -130,7 +185,11 @@ class Runner(object):
                                 analyzer_params = default_analyzer_params.copy()
                                 analyzer_params.update(analyzer_cfg.get('params', {}))
 
-                                analyzers.append((analyzer_class, analyzer_params, indicator))
+                                analyzers.append(AnalyzerSpec(
+                                    analyzer_class, analyzer_params, indicator,
+                                    int(effective_cfg.get('priority', 0)),
+                                    self._duration(effective_cfg.get('timeout', default_timeout), 'timeout')
+                                ))
 
                 except KeyError as e:
                     raise AnalyzerError('missing key "%s" in configuration %s' % (e, cfg_item))
@@ -147,32 +206,115 @@ class Runner(object):
             else:
                 self.log_warn('!! skipping analyzer %s', name)
 
+        # sort is stable, so configuration order is kept inside a given priority
+        analyzers.sort(key=lambda spec: -spec.priority)
         return analyzers
 
+    @staticmethod
+    def _duration(value, key):
+        """ Converts a duration configuration item to seconds.
+
+        :param value: the configured value (None if not set)
+        :param str key: the configuration item key, for error reporting
+        :return: the duration in seconds, or None if not set
+        :rtype: float
+        :raise AnalyzerError: if the value is not a positive number
+        """
+        if value is None:
+            return None
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            raise AnalyzerError('invalid %s : %r' % (key, value))
+        if seconds <= 0:
+            raise AnalyzerError('invalid %s : %r (must be positive)' % (key, value))
+        return seconds
+
+    def declare_output_variables(self, analyzers):
+        """ Declares in the PDW the output variables of the analyzers, with a single request per site.
+
+        Output variables are the ones returned by the indicators :py:meth:`AbstractIndicator.output_variables`
+        method. Their site is given by the `site_id` analyzer parameter. The variables of the analyzers
+        configured in dry run mode are handled apart, so that their declaration is only simulated.
+
+        Failures are not fatal, since analyzers declare their missing variables when storing their outputs.
+
+        :param analyzers: the analyzers specifications, as returned by :py:meth:`prepare_analyzers`
+        :return: the count of declared variables
+        :rtype: int
+        """
+        sites = {}
+        for spec in analyzers:
+            var_defs = spec.indicator.output_variables()
+            if not var_defs:
+                continue
+            site_id = spec.analyzer_params.get('site_id')
+            if site_id is None:
+                self.log_warn('site_id not configured for %s : output variables not declared', spec.indicator.name)
+                continue
+            dry_run = bool(spec.analyzer_params.get('dry_run', False))
+            sites.setdefault((site_id, dry_run), {}).update(var_defs)
+
+        declared = 0
+        for (site_id, dry_run), var_defs in sites.iteritems():
+            self.log_info('checking %d output variable(s) of site id=%s', len(var_defs), site_id)
+            connector = PDWConnectorMixin(self.logger, dry_run=dry_run)
+            try:
+                declared += len(connector.declare_pdw_variables(site_id, var_defs))
+            except (PDWConnectorError, ValueError) as e:
+                self.log_error('** output variables declaration failed : %s', e)
+        return declared
+
     def execute_analyzers(self, analyzers, computation_date=None):
+        """ Executes the analyzers in sequence.
+
+        Analyzers with a time budget (their own timeout, or what remains before the run deadline)
+        are executed in a child process, which is cancelled if the budget is exceeded. Cancelled
+        analyzers, as well as the ones skipped because the run deadline is reached, are reported
+        as being in error.
+
+        :param analyzers: the analyzers specifications, as returned by :py:meth:`prepare_analyzers`
+        :param computation_date: the reference date for the computed periods (default: now)
+        :raise AnalyzerError: if one or more analyzers failed
+        """
         computation_date = computation_date or datetime.datetime.utcnow()
+        deadline = time.time() + self.run_deadline if self.run_deadline else None
         executed = 0
         in_error = 0
-        for analyzer_class, analyzer_params, indicator in analyzers:
+        for spec in analyzers:
+            indicator = spec.indicator
             self.log_info('processing indicator : %s', indicator.name)
             executed += 1
+            run_metrics.begin_indicator(indicator.name)
+            started = time.time()
+
+            budget = spec.timeout
+            if deadline:
+                remaining = deadline - started
+                if remaining <= 0:
+                    self.log_error('** run deadline reached : indicator skipped')
+                    in_error += 1
+                    run_metrics.end_indicator(0, False)
+                    continue
+                budget = min(budget, remaining) if budget else remaining
+
+            success = False
             try:
                 self.log_info('.. initialization parameters :')
                 self.log_info('.. + period = %s', PeriodicAnalyzer.PERIOD_NAMES[self.period])
                 self.log_info('.. + computation_date = %s', computation_date)
-                for k, v in analyzer_params.iteritems():
+                for k, v in spec.analyzer_params.iteritems():
                     self.log_info('.. + %s = %s', k, v)
 
-                analyzer = analyzer_class(
-                    indicator,
-                    self.period,
-                    computation_date,
-                    logger=self.logger.getChild(indicator.name),
-                    **analyzer_params
-                )
-                self.log_info('.. elaboration')
-                analyzer.run(outputs_timestamp=computation_date)
+                if budget:
+                    self.log_info('.. time budget : %.1fs', budget)
+                    self._run_analyzer_process(spec, computation_date, budget)
+                else:
+                    self._run_analyzer_in_process(spec, computation_date)
 
+            except AnalyzerTimeout as e:
+                self.log_error('** analyzer cancelled : %s', e)
+                in_error += 1
             except AnalyzerError as e:
                 self.log_error('** analyzer error : %s', e)
                 in_error += 1
@@ -180,20 +322,159 @@ class Runner(object):
                 self.log_exception('** unexpected error : %s', e)
                 in_error += 1
             else:
+                success = True
                 self.log_info('!! done.')
+            finally:
+                counters = run_metrics.counters()
+                if counters.get('spilled_signals') or counters.get('spilled_bytes'):
+                    self.log_warn(
+                        '.. memory budget exceeded : %d signal(s) spilled to disk (%.1fMB)',
+                        counters['spilled_signals'], counters['spilled_bytes'] / 1048576.
+                    )
+                run_metrics.end_indicator(time.time() - started, success)
 
         if in_error:
             raise AnalyzerError('%d indicator(s) computation completed with %s error(s)' % (executed, in_error))
 
+    def make_analyzer(self, spec, computation_date):
+        """ Creates the analyzer of a spec, for the period preceding a computation date.
+
+        :param AnalyzerSpec spec: the analyzer spec, as returned by :py:meth:`prepare_analyzers`
+        :param datetime.datetime computation_date: the computation date
+        :rtype: AbstractAnalyzer
+        """
+        return spec.analyzer_class(
+            spec.indicator,
+            self.period,
+            computation_date,
+            logger=self.logger.getChild(spec.indicator.name),
+            **spec.analyzer_params
+        )
+
+    def _run_analyzer(self, spec, computation_date):
+        analyzer = self.make_analyzer(spec, computation_date)
+        self.log_info('.. elaboration')
+        analyzer.run(outputs_timestamp=computation_date)
+
+    def _run_analyzer_in_process(self, spec, computation_date):
+        # the peak of the runner process covers its whole life, hence only its growth is significant
+        peak = peak_rss_bytes()
+        try:
+            self._run_analyzer(spec, computation_date)
+        finally:
+            run_metrics.add('rss_peak_growth_bytes', peak_rss_bytes() - peak)
+
+    def _analyzer_process(self, spec, computation_date, spill_dir, conn):
+        # make the analyzer the leader of its own process group, so that it can be cancelled
+        # together with any process it could have started
+        os.setpgrp()
+        MemoryBudget.spill_dir = spill_dir
+        outcome = None
+        try:
+            self._run_analyzer(spec, computation_date)
+        except AnalyzerError as e:
+            outcome = (True, str(e))
+        except Exception as e:
+            self.log_exception('** unexpected error : %s', e)
+            outcome = (False, str(e))
+        finally:
+            # the process exits without running the exit handlers
+            localstore.flush_all()
+            run_metrics.add('peak_rss_bytes', peak_rss_bytes())
+            conn.send((outcome, run_metrics.counters()))
+            conn.close()
+
+    def _run_analyzer_process(self, spec, computation_date, budget):
+        """ Runs an analyzer in a child process, cancelling it if not completed within the budget.
+
+        The data spilled by the analyzer are stored in a directory of its own, which is removed once the
+        process has ended, since a cancelled process cannot clean them up itself.
+
+        :raise AnalyzerTimeout: if the analyzer has been cancelled
+        :raise AnalyzerError: if the analyzer failed
+        """
+        if not os.path.isdir(MemoryBudget.spill_dir):
+            os.makedirs(MemoryBudget.spill_dir)
+        spill_dir = tempfile.mkdtemp(prefix='analyzer-%s-' % spec.indicator.name, dir=MemoryBudget.spill_dir)
+
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=self._analyzer_process,
+            args=(spec, computation_date, spill_dir, child_conn),
+            name='analyzer-%s' % spec.indicator.name
+        )
+        process.start()
+        child_conn.close()
+
+        try:
+            process.join(budget)
+            cancelled = process.is_alive()
+        finally:
+            if process.is_alive():
+                self._cancel_process(process)
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+        if cancelled:
+            parent_conn.close()
+            raise AnalyzerTimeout('time budget (%.1fs) exceeded' % budget)
+
+        if parent_conn.poll():
+            outcome, counters = parent_conn.recv()
+            run_metrics.merge_counters(counters)
+        else:
+            outcome = (False, 'exit code=%s' % process.exitcode)
+        parent_conn.close()
+        if outcome:
+            is_analyzer_error, msg = outcome
+            raise AnalyzerError(msg if is_analyzer_error else 'unexpected error : %s' % msg)
+
+    def _cancel_process(self, process):
+        for sig, delay in ((signal.SIGTERM, self.CANCEL_GRACE_DELAY), (signal.SIGKILL, None)):
+            try:
+                os.killpg(process.pid, sig)
+            except OSError:
+                # process group already gone
+                pass
+            process.join(delay)
+            if not process.is_alive():
+                return
+
+    def write_metrics(self, success, run_duration):
+        """ Writes the metrics of the run for node_exporter textfile collector.
+
+        Failing to do so is not considered as a run error.
+        """
+        if not self.metrics_dir:
+            return
+        if not os.path.isdir(self.metrics_dir):
+            self.log_warn('metrics not written (directory not found: %s)', self.metrics_dir)
+            return
+        try:
+            path = run_metrics.write_textfile(
+                self.metrics_dir, PeriodicAnalyzer.PERIOD_NAMES[self.period], success, run_duration
+            )
+        except EnvironmentError as e:
+            self.log_error('cannot write metrics (%s)', e)
+        else:
+            self.log_info('metrics written to %s', path)
+
     @staticmethod
     def main(args):
         logger = log.getLogger('analytics-%s' % args.period)
         log.set_loglevel_from_args(logger, args)
+        started = time.time()
+        runner = None
 
         def die(msg):
             logger.fatal(msg)
+            if runner:
+                runner.write_metrics(False, time.time() - started)
             return msg
 
+        if getattr(args, 'refresh_cache', False):
+            logger.info('cached days will be refreshed from the events database')
+            DataAccessMixin.refresh_day_cache = True
+
         try:
             logger.info('creating runner')
             runner = Runner(
@@ -204,6 +485,13 @@ class Runner(object):
             logger.info('preparing analyzers')
             analyzers = runner.prepare_analyzers()
 
+            if getattr(args, 'refresh_cache', False) and AbstractAnalyzer.result_cache:
+                logger.info('clearing the intermediate results cache')
+                AbstractAnalyzer.result_cache.clear()
+
+            logger.info('declaring output variables')
+            runner.declare_output_variables(analyzers)
+
         except AnalyzerError as e:
             return die("analysis preparation error (%s)" % e)
 
@@ -221,4 +509,5 @@ class Runner(object):
 
             else:
                 logger.info('completed without error')
+                runner.write_metrics(True, time.time() - started)
                 return 0
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+""" Event sources used by :py:class:`pycstbox.performer.commons.data.DataAccessMixin`.
+
+An event source provides range-scan reads of the recorded events, in the form of chunks of columns
+(timestamps and values of a given variable). Two backends are available :
+
+- ``fsys`` : the events database of the box, accessed through the `fsys` DAO, with closed days served
+  from the materialized day cache (see :py:mod:`pycstbox.performer.commons.daycache`),
+- ``archive`` : a local directory storing the events by day, in the same columnar format as the day cache.
+  It is intended for replaying large histories, for instance when recomputing indicators on a server
+  from an archive exported with :py:func:`export_archive`.
+
+Other backends can be plugged by giving the fully qualified name of a :py:class:`EventSource` subclass.
+"""
+
+import datetime
+import importlib
+from bisect import bisect_left
+from array import array
+
+from evtsignals.base import to_milliseconds
+
+from pycstbox.performer.commons.analytics import TimeFrame, default_logger
+from pycstbox.performer.commons.daycache import DayCache, columns_from_events
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+DAO_NAME = 'fsys'
+DAY_CACHE_DIR = '/var/cache/cstbox/performer/days'
+
+ONE_DAY = datetime.timedelta(days=1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _day_bounds(day):
+    day_start = datetime.datetime.combine(day, datetime.time())
+    return day_start, day_start + ONE_DAY - ONE_MICROSECOND
+
+
+class EventSource(object):
+    """ Root class of event sources """
+    def __init__(self, logger=None):
+        self.logger = logger or default_logger
+
+    def scan(self, time_frame, var_names):
+        """ Reads the events of a set of variables within a time frame.
+
+        Events are returned as chunks, each one containing the events of a single variable. The chunks of
+        a given variable are returned in chronological order.
+
+        :param TimeFrame time_frame: the time frame (bounds included, unless its end is excluded)
+        :param var_names: the names of the variables (None for all the variables)
+        :return: an iterable of (var_name, timestamps, values) tuples, timestamps being expressed in msecs
+        from Epoch
+        """
+        raise NotImplementedError()
+
+    def prepare(self, time_frame):
+        """ Makes the events of a time frame readily available to the scans to come.
+
+        It is called before scanning the time frame from parallel processes, so that the work shared by the
+        scans is done once. The default implementation does nothing.
+
+        :param TimeFrame time_frame: the time frame
+        """
+
+    def last_events(self, before, var_names, lookback):
+        """ Returns the last event of each variable preceding a given time.
+
+        The events are looked for day by day back from the given time, until all the variables are found
+        or the lookback is exhausted.
+
+        :param datetime.datetime before: the time (excluded)
+        :param var_names: the names of the variables (None for all the variables)
+        :param datetime.timedelta lookback: how far before the given time the events are looked for
+        :return: a dictionary of (timestamp, value) tuples keyed by variable name, the variables without events
+        within the lookback being omitted
+        """
+        before_ms = to_milliseconds(before)
+        limit = before - lookback
+        last = {}
+        end = before
+        while end > limit and (var_names is None or len(last) < len(var_names)):
+            start = max(limit, datetime.datetime.combine((end - ONE_MICROSECOND).date(), datetime.time()))
+            remaining = None if var_names is None else [name for name in var_names if name not in last]
+            found = {}
+            for var_name, timestamps, values in self.scan(TimeFrame(start, end), remaining):
+                i = bisect_left(timestamps, before_ms)
+                if i:
+                    found[var_name] = long(timestamps[i - 1]), values[i - 1]
+            for var_name, event in found.iteritems():
+                last.setdefault(var_name, event)
+            end = start
+        return last
+
+    def close(self):
+        """ Releases the resources used by the source. """
+
+
+class FsysEventSource(EventSource):
+    """ The events database of the box, fronted by the day cache """
+    # days materialized again during this process when refresh is requested
+    _refreshed_days = set()
+
+    def __init__(self, dao_name=DAO_NAME,
+                 day_cache_dir=DAY_CACHE_DIR, day_cache_max_span=366, refresh_day_cache=False,
+                 **kwargs):
+        """
+        :param str dao_name: the name of the events DAO
+        :param str day_cache_dir: the path of the day cache (None to disable the cache)
+        :param int day_cache_max_span: frames longer than this (in days) bypass the cache, to avoid
+        materializing whole histories
+        :param bool refresh_day_cache: if True, the cached days covered by the scans are materialized
+        again from the DAO (once per process)
+        """
+        super(FsysEventSource, self).__init__(**kwargs)
+        from pycstbox import evtdb, evtdao, evtmgr
+
+        try:
+            dao_dbus = evtdb.get_object(evtmgr.SENSOR_EVENT_CHANNEL)
+            dao_dbus.flush()
+        except:
+            # we are not on a real CSTBox (test context)
+            pass
+
+        self._dao = evtdao.get_dao(dao_name, readonly=True)
+        self._cache = DayCache(day_cache_dir) if day_cache_dir else None
+        self._cache_max_span = day_cache_max_span
+        self._refresh = refresh_day_cache
+
+    def _scan_dao(self, start, end, var_names):
+        # the events are read day by day, so that only the ones of a single day are held in memory
+        day = start.date()
+        while day <= end.date():
+            day_start, day_end = _day_bounds(day)
+            for chunk in _events_chunks(self._dao.get_events(max(start, day_start), min(end, day_end)), var_names):
+                yield chunk
+            day += ONE_DAY
+
+    def _load_cached_day(self, day, var_names):
+        # None if the day is missing, or is being replaced by a concurrent refresh
+        try:
+            return _load_day(self._cache, day, var_names)
+        except (KeyError, EnvironmentError) as e:
+            self.logger.warn('cannot load cached day %s (%s)', day, e)
+            return None
+
+    def _uses_cache(self, start, end):
+        today = datetime.datetime.utcnow().date()
+        return self._cache and start.date() < today and (end.date() - start.date()).days <= self._cache_max_span
+
+    def _materialize(self, day, refresh):
+        """ Reads a day from the DAO and stores it in the cache.
+
+        :return: the events of the day
+        :rtype: list
+        """
+        if refresh:
+            self._refreshed_days.add(day)
+        events = list(self._dao.get_events(*_day_bounds(day)))
+        try:
+            # a day materialized meanwhile by a concurrent scan is kept, unless refreshing
+            self._cache.store(day, columns_from_events(events), replace=refresh)
+        except (ValueError, EnvironmentError) as e:
+            self.logger.warn('cannot cache day %s (%s)', day, e)
+            if isinstance(e, ValueError):
+                # the content of the day is the cause => do not attempt it again on next scans
+                self._cache.mark_uncacheable(day, e)
+        return events
+
+    def prepare(self, time_frame):
+        """ Materializes the closed days of the time frame missing in the cache. """
+        start, end = time_frame.start, _inclusive_end(time_frame)
+        if not self._uses_cache(start, end):
+            return
+        last_day = min(end.date(), datetime.datetime.utcnow().date() - ONE_DAY)
+        day = start.date()
+        while day <= last_day:
+            refresh = self._refresh and day not in self._refreshed_days
+            if refresh or not (self._cache.contains(day) or self._cache.is_uncacheable(day)):
+                self._materialize(day, refresh)
+            day += ONE_DAY
+
+    def scan(self, time_frame, var_names):
+        if var_names is not None:
+            var_names = set(var_names)
+        start, end = time_frame.start, _inclusive_end(time_frame)
+        if not self._uses_cache(start, end):
+            for chunk in self._scan_dao(start, end, var_names):
+                yield chunk
+            return
+
+        today = datetime.datetime.utcnow().date()
+        start_ms, end_ms = to_milliseconds(start), to_milliseconds(end)
+        day, last_day = start.date(), end.date()
+        while day <= last_day:
+            day_start, day_end = _day_bounds(day)
+
+            if day >= today:
+                # the day is not closed yet => always read it from the DAO
+                for chunk in self._scan_dao(max(day_start, start), end, var_names):
+                    yield chunk
+                return
+
+            refresh = self._refresh and day not in self._refreshed_days
+            if not refresh and self._cache.is_uncacheable(day):
+                for chunk in self._scan_dao(max(day_start, start), min(day_end, end), var_names):
+                    yield chunk
+                day += ONE_DAY
+                continue
+
+            columns = None if refresh else self._load_cached_day(day, var_names)
+            if columns is None:
+                events = self._materialize(day, refresh)
+                columns = self._load_cached_day(day, var_names)
+                if columns is None:
+                    for chunk in _events_chunks(events, var_names, start_ms, end_ms):
+                        yield chunk
+                    day += ONE_DAY
+                    continue
+
+            for chunk in _scan_day_columns(columns, start_ms, end_ms):
+                yield chunk
+
+            day += ONE_DAY
+
+
+class ArchiveEventSource(EventSource):
+    """ A local archive of events, stored by day in the day cache format """
+    def __init__(self, path, **kwargs):
+        """
+        :param str path: the path of the archive directory
+        """
+        super(ArchiveEventSource, self).__init__(**kwargs)
+        if not path:
+            raise ValueError('path parameter is mandatory')
+        self._archive = DayCache(path)
+
+    def scan(self, time_frame, var_names):
+        end = _inclusive_end(time_frame)
+        start_ms, end_ms = to_milliseconds(time_frame.start), to_milliseconds(end)
+        first_day, last_day = time_frame.start.date(), end.date()
+        for day in self._archive.cached_days():
+            if first_day <= day <= last_day:
+                for chunk in _scan_day_columns(_load_day(self._archive, day, var_names) or {}, start_ms, end_ms):
+                    yield chunk
+
+
+def _inclusive_end(time_frame):
+    return time_frame.end - ONE_MICROSECOND if time_frame.end_excluded else time_frame.end
+
+
+def _events_chunks(events, var_names, start_ms=None, end_ms=None):
+    columns = {}
+    for event in events:
+        if var_names is not None and event.var_name not in var_names:
+            continue
+        ts = to_milliseconds(event.timestamp)
+        if start_ms is not None and not start_ms <= ts <= end_ms:
+            continue
+        try:
+            ts_col, val_col = columns[event.var_name]
+        except KeyError:
+            columns[event.var_name] = ts_col, val_col = [], []
+        ts_col.append(ts)
+        val_col.append(event.value)
+    for var_name, (ts_col, val_col) in columns.iteritems():
+        yield var_name, ts_col, val_col
+
+
+def _load_day(cache, day, var_names):
+    if var_names is None:
+        if not cache.contains(day):
+            return None
+        var_names = cache.variables(day)
+    return cache.load(day, var_names)
+
+
+def _scan_day_columns(columns, start_ms, end_ms):
+    for var_name, day_columns in columns.iteritems():
+        try:
+            timestamps, values = day_columns.slice(start_ms, end_ms)
+        finally:
+            day_columns.close()
+        if timestamps:
+            yield var_name, timestamps, values
+
+
+BACKENDS = {
+    'fsys': FsysEventSource,
+    'archive': ArchiveEventSource,
+}
+
+
+def get_event_source(backend='fsys', **kwargs):
+    """ Creates an event source.
+
+    :param str backend: the backend name (see :py:data:`BACKENDS`) or the fully qualified name of an
+    :py:class:`EventSource` subclass
+    :param kwargs: the backend specific parameters
+    :rtype: EventSource
+    :raise ValueError: if the backend is unknown
+    """
+    try:
+        source_class = BACKENDS[backend]
+    except KeyError:
+        if '.' not in backend:
+            raise ValueError('unknown event source backend : %s' % backend)
+        module_name, class_name = backend.rsplit('.', 1)
+        try:
+            source_class = getattr(importlib.import_module(module_name), class_name)
+        except (ImportError, AttributeError) as e:
+            raise ValueError('cannot load event source backend %s (%s)' % (backend, e))
+
+    return source_class(**kwargs)
+
+
+def export_archive(source, path, first_day, last_day, var_names=None):
+    """ Exports the events of a range of days from a source to an archive.
+
+    Days already present in the archive are replaced.
+
+    :param EventSource source: the source of the events
+    :param str path: the path of the archive directory
+    :param datetime.date first_day: first exported day
+    :param datetime.date last_day: last exported day (included)
+    :param var_names: the names of the exported variables (default: all)
+    :return: the count of exported days
+    :rtype: int
+    :raise ValueError: if an event value cannot be stored in the archive
+    """
+    archive = DayCache(path)
+    count = 0
+    day = first_day
+    while day <= last_day:
+        columns = {}
+        for var_name, timestamps, values in source.scan(TimeFrame(*_day_bounds(day)), var_names):
+            ts_col, val_col = columns.setdefault(var_name, (array('d'), []))
+            ts_col.extend(float(t) for t in timestamps)
+            val_col.extend(values)
+        archive.store(day, columns)
+        count += 1
+        day += ONE_DAY
+    return count
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+""" Live computation of indicators from the sensor events stream.
+
+Analyzers supporting this mode (see :py:attr:`AbstractAnalyzer.supports_streaming`) maintain a running
+state, updated event by event as they are published on the event manager sensor channel. The state of
+the current period is check-pointed on disk on a regular basis, so that when the period is over, the
+periodic analyzer finalizes the indicator from it instead of reading the whole period raw data again.
+
+Events missed while the streaming process was not running are caught up from the event source of the
+analyzer (see :py:class:`pycstbox.performer.commons.data.DataAccessMixin`), so that a check-pointed state
+always accounts for all the events of its period up to the last event time of each variable.
+"""
+
+import os
+import glob
+import json
+import datetime
+import cPickle as pickle
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+STREAM_STATE_DIR = '/var/lib/cstbox/performer/stream'
+
+
+class StreamCheckpoint(object):
+    """ The running state of an analyzer for a given time frame """
+    def __init__(self, state, start_ts):
+        """
+        :param state: the analyzer specific state
+        :param long start_ts: the time (msecs) up to which events are not part of the state
+        """
+        self.state = state
+        self.start_ts = start_ts
+        # the time (msecs) of the last event accounted for in the state, by variable, so that events of
+        # different sensors received slightly out of order are not lost
+        self.last_ts = {}
+
+    def last_event_time(self, var_name):
+        return self.last_ts.get(var_name, self.start_ts)
+
+    def apply(self, analyzer, var_name, timestamp, value):
+        """ Updates the state with an event, unless it is older than the last accounted one of its variable.
+
+        :param AbstractAnalyzer analyzer: the analyzer owning the state
+        :param str var_name: the event variable name
+        :param long timestamp: the event time (msecs from Epoch)
+        :param value: the event value, as received or read from the event source
+        """
+        if timestamp <= self.last_event_time(var_name):
+            return
+        value = analyzer.stream_value(var_name, value)
+        self.state = analyzer.update_stream_state(self.state, var_name, timestamp, value)
+        self.last_ts[var_name] = timestamp
+
+
+class StateStore(object):
+    """ The on-disk store of the check-pointed states
+
+    Once the periodic analyzer has computed the indicator from the checkpoint of a period, the checkpoint is
+    replaced by a marker telling that the period has been consumed, so that the streaming process does not
+    save it again when rolling over to the next period.
+    """
+    TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+    def __init__(self, root=STREAM_STATE_DIR):
+        self._root = root
+
+    def path(self, indicator_name, time_frame, ext='.state'):
+        return os.path.join(self._root, '%s-%s%s' % (indicator_name, time_frame.start.strftime(self.TIME_FORMAT), ext))
+
+    def load(self, indicator_name, time_frame):
+        """ Returns the checkpoint of an indicator for a time frame, or None if there is none. """
+        try:
+            with open(self.path(indicator_name, time_frame), 'rb') as fp:
+                return pickle.load(fp)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save(self, indicator_name, time_frame, checkpoint):
+        """ Saves a checkpoint, atomically replacing the previous one. """
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+        path = self.path(indicator_name, time_frame)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(checkpoint, fp, pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, path)
+
+    def remove(self, indicator_name, time_frame):
+        try:
+            os.remove(self.path(indicator_name, time_frame))
+        except OSError:
+            pass
+
+    def consume(self, indicator_name, time_frame):
+        """ Removes the checkpoint of a period which indicator has been computed, leaving a consumed marker. """
+        if not os.path.isdir(self._root):
+            os.makedirs(self._root)
+        open(self.path(indicator_name, time_frame, '.consumed'), 'w').close()
+        self.remove(indicator_name, time_frame)
+
+    def is_consumed(self, indicator_name, time_frame):
+        return os.path.exists(self.path(indicator_name, time_frame, '.consumed'))
+
+    def expire(self, indicator_name, before):
+        """ Removes the consumed markers of the periods of an indicator starting before a given time. """
+        limit = before.strftime(self.TIME_FORMAT)
+        prefix_len = len(indicator_name) + 1
+        for path in glob.glob(os.path.join(self._root, indicator_name + '-*.consumed')):
+            if os.path.basename(path)[prefix_len:-len('.consumed')] < limit:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def catch_up(analyzer, checkpoint, until):
+    """ Applies to a checkpoint the events recorded after the last one of their variable, up to a given time.
+
+    The events are read from the event source of the analyzer, which must thus include
+    :py:class:`pycstbox.performer.commons.data.DataAccessMixin`.
+
+    :param AbstractAnalyzer analyzer: the analyzer
+    :param StreamCheckpoint checkpoint: the checkpoint to be updated
+    :param datetime.datetime until: the upper time bound (included)
+    :return: the updated checkpoint
+    :rtype: StreamCheckpoint
+    """
+    from pycstbox.performer.commons.analytics import TimeFrame
+
+    variables = analyzer.stream_variables()
+    start_ts = min(checkpoint.last_event_time(var_name) for var_name in variables)
+    start = datetime.datetime.utcfromtimestamp((start_ts + 1) / 1000.)
+    if start >= until:
+        return checkpoint
+
+    source = analyzer.get_event_source()
+    try:
+        events = []
+        for var_name, timestamps, values in source.scan(TimeFrame(start, until), variables):
+            events.extend((long(ts), var_name, value) for ts, value in zip(timestamps, values))
+    finally:
+        source.close()
+
+    # the state must be updated in the chronological order of events, whatever their variable
+    events.sort(key=lambda e: e[0])
+    for ts, var_name, value in events:
+        checkpoint.apply(analyzer, var_name, ts, value)
+
+    return checkpoint
+
+
+class StreamTracker(object):
+    """ Maintains the running state of an indicator for the current period """
+    def __init__(self, make_analyzer, store, logger):
+        """
+        :param make_analyzer: a callable returning the analyzer of the period containing the time passed to it
+        :param StateStore store: the checkpoints store
+        :param logger: the logger
+        """
+        self._make_analyzer = make_analyzer
+        self._store = store
+        self._logger = logger
+        self.analyzer = self.checkpoint = None
+        self._variables = self._end_ms = None
+
+    @property
+    def name(self):
+        return self.analyzer._indicator.name
+
+    def start_frame(self, now):
+        """ Starts tracking the period containing the given time, resuming it from its checkpoint if any. """
+        from evtsignals.base import to_milliseconds
+
+        self.analyzer = analyzer = self._make_analyzer(now)
+        time_frame = analyzer.time_frame
+        self._variables = set(analyzer.stream_variables())
+        self._end_ms = to_milliseconds(time_frame.end)
+
+        checkpoint = self._store.load(self.name, time_frame)
+        if checkpoint is None:
+            self._logger.info('[%s] starting period [%s, %s]', self.name, time_frame.start, time_frame.end)
+            checkpoint = StreamCheckpoint(analyzer.init_stream_state(), to_milliseconds(time_frame.start) - 1)
+        else:
+            self._logger.info('[%s] resuming period [%s, %s]', self.name, time_frame.start, time_frame.end)
+        self.checkpoint = catch_up(analyzer, checkpoint, min(now, time_frame.end))
+        self.save()
+        # the previous periods are over, and are not saved anymore
+        self._store.expire(self.name, time_frame.start)
+
+    def on_event(self, timestamp, var_name, value):
+        """ Updates the state with a live event.
+
+        Events older than the last accounted one of the same variable are ignored.
+        """
+        if timestamp > self._end_ms:
+            self.roll_over(datetime.datetime.utcfromtimestamp(timestamp / 1000.))
+        if var_name in self._variables:
+            self.checkpoint.apply(self.analyzer, var_name, timestamp, value)
+
+    def roll_over(self, now):
+        """ Closes the current period and starts the one containing the given time.
+
+        The state of the closed period is not saved if the periodic analyzer has already consumed it.
+        """
+        if self._store.is_consumed(self.name, self.analyzer.time_frame):
+            self._logger.info('[%s] period already computed', self.name)
+        else:
+            self.checkpoint = catch_up(self.analyzer, self.checkpoint, self.analyzer.time_frame.end)
+            self.save()
+            self._logger.info('[%s] period completed', self.name)
+        self.start_frame(now)
+
+    def save(self):
+        self._store.save(self.name, self.analyzer.time_frame, self.checkpoint)
+
+
+class StreamingRunner(object):
+    """ Feeds the streaming capable analyzers of a set of periodic runners from the events stream """
+    def __init__(self, runners, store=None, checkpoint_period=300, logger=None):
+        """
+        :param runners: the :py:class:`pycstbox.performer.commons.runner.Runner` instances, one per period
+        :param StateStore store: the checkpoints store
+        :param int checkpoint_period: the checkpoints period (seconds)
+        """
+        from pycstbox import log
+
+        self.logger = logger or log.getLogger(self.__class__.__name__)
+        self._store = store or StateStore()
+        self._checkpoint_period = checkpoint_period
+        self._trackers = []
+        self._runners = runners
+
+    def prepare(self):
+        """ Creates the trackers of the streaming capable analyzers, and brings their state up to date.
+
+        :return: the count of trackers
+        :rtype: int
+        """
+        now = datetime.datetime.utcnow()
+        for runner in self._runners:
+            for spec in runner.prepare_analyzers():
+                def make_analyzer(at, runner=runner, spec=spec):
+                    # analyzers work on the period before their computation date
+                    return runner.make_analyzer(spec, at + datetime.timedelta(days=1))
+
+                if not make_analyzer(now).supports_streaming:
+                    self.logger.info('%s does not support streaming (skipped)', spec.indicator.name)
+                    continue
+
+                tracker = StreamTracker(make_analyzer, self._store, self.logger)
+                tracker.start_frame(now)
+                self._trackers.append(tracker)
+        return len(self._trackers)
+
+    def on_event(self, timestamp, var_type, var_name, data):
+        try:
+            value = json.loads(data).get('value') if data else None
+        except ValueError:
+            self.logger.error('invalid event data : %s', data)
+            return
+        for tracker in self._trackers:
+            try:
+                tracker.on_event(long(timestamp), str(var_name), value)
+            except Exception as e:
+                self.logger.exception('[%s] event processing error : %s', tracker.name, e)
+
+    def checkpoint(self):
+        """ Saves the states, and rolls over the trackers which period has ended. """
+        now = datetime.datetime.utcnow()
+        for tracker in self._trackers:
+            try:
+                if now > tracker.analyzer.time_frame.end:
+                    tracker.roll_over(now)
+                else:
+                    tracker.save()
+            except Exception as e:
+                self.logger.exception('[%s] checkpoint error : %s', tracker.name, e)
+        # keep the timer active
+        return True
+
+    def run(self):
+        """ Subscribes to the sensor events channel and processes events until interrupted. """
+        import gobject
+        from pycstbox import dbuslib, evtmgr
+
+        dbuslib.dbus_init()
+        svc = evtmgr.get_object(evtmgr.SENSOR_EVENT_CHANNEL)
+        # subscribe before catching up, so that the events received meanwhile are queued until the loop runs
+        svc.connect_to_signal('onCSTBoxEvent', self.on_event, dbus_interface=evtmgr.SERVICE_INTERFACE)
+        if not self.prepare():
+            self.logger.warn('no analyzer supports streaming')
+            return
+        gobject.timeout_add_seconds(self._checkpoint_period, self.checkpoint)
+
+        self.logger.info('listening to sensor events (checkpoint period=%ds)', self._checkpoint_period)
+        loop = gobject.MainLoop()
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            self.logger.info('interrupted')
+        finally:
+            self.checkpoint()
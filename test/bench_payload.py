@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Compares the series upload payloads built by SeriesPayloadBuilder with the former layout (one deflated
+archive member per point, all the points in a single archive).
+
+With a single point per variable (the default, as stored by store_single_points), both layouts have the same
+size, the upload format requiring a member per variable. The builder gains come with several points per variable.
+
+Usage: bench_payload.py [variables_count [points_per_variable]]
+"""
+
+import sys
+import timeit
+import warnings
+import zipfile
+import cStringIO
+
+from pycstbox.performer.commons.pdw import SeriesPayloadBuilder
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+def make_points(var_count, points_count):
+    return [
+        ('indicator_%03d' % v, '2016-05-%02dT00:00:00' % (1 + p % 28), round(v * 0.37 + p * 1.13, 2))
+        for v in range(var_count) for p in range(points_count)
+    ]
+
+
+def per_point_archive(points):
+    sio = cStringIO.StringIO()
+    zf = zipfile.ZipFile(sio, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for name, ts_iso, value in points:
+            zf.writestr(name + ".tsv", '%s\t%s\n' % (ts_iso, value))
+    finally:
+        zf.close()
+    return [sio.getvalue()]
+
+
+def builder_payloads(points):
+    builder = SeriesPayloadBuilder()
+    for name, ts_iso, value in points:
+        builder.add(name, ts_iso, value)
+    return [p.data for p in builder.payloads()]
+
+
+def bench(label, func, raw_size, repeat=5):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    payloads = func()
+    size = sum(len(p) for p in payloads)
+    print('%-30s %10.2f ms %10d bytes %5d request(s)   ratio=%.2f' % (
+        label, best * 1000, size, len(payloads), float(raw_size) / size
+    ))
+    return best, size
+
+
+if __name__ == '__main__':
+    var_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    points_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    # the per-point layout produces duplicate member names when variables have several points
+    warnings.simplefilter('ignore')
+
+    points = make_points(var_count, points_count)
+    raw_size = sum(len('%s\t%s\n' % (ts, v)) for _, ts, v in points)
+
+    print('variables : %d - points per variable : %d - raw size : %d bytes' % (var_count, points_count, raw_size))
+    t_legacy, s_legacy = bench('per-point members', lambda: per_point_archive(points), raw_size)
+    t_builder, s_builder = bench('payload builder', lambda: builder_payloads(points), raw_size)
+    print('%-30s %10.1fx %10.1fx smaller' % ('.. gain', t_legacy / t_builder, float(s_legacy) / s_builder))
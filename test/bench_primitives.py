@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Compares the vectorized analytics primitives with the equivalent per-point loops.
+
+Usage: bench_primitives.py [points_count]
+"""
+
+import sys
+import timeit
+
+from evtsignals import AnalogSignal, LogicSignal
+
+from pycstbox.performer.commons import primitives
+
+from test_primitives import random_points, naive_segments
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+def naive_time_above(signal, threshold, start, end):
+    return sum(d for v, d in naive_segments(signal.points, start, end) if v > threshold)
+
+
+def naive_time_in_state(signal, start, end):
+    return sum(d for v, d in naive_segments(signal.points, start, end) if v)
+
+
+def naive_time_weighted_average(signal, start, end):
+    total = covered = 0
+    for v, d in naive_segments(signal.points, start, end):
+        total += v * d
+        covered += d
+    return float(total) / covered if covered else None
+
+
+def bench(label, func, repeat=5):
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print('%-40s %10.2f ms' % (label, best * 1000))
+    return best
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    analog = AnalogSignal(random_points(count, 0))
+    logic = LogicSignal(random_points(count, 0, logic=True))
+    start, end = analog.start_time(), analog.end_time()
+
+    print('points : %d' % count)
+    for name, naive, vectorized, signal, args in (
+        ('time_above', naive_time_above, primitives.time_above, analog, (50,)),
+        ('time_in_state', naive_time_in_state, primitives.time_in_state, logic, ()),
+        ('time_weighted_average', naive_time_weighted_average, primitives.time_weighted_average, analog, ()),
+    ):
+        t_naive = bench(name + ' (loop)', lambda: naive(signal, *(args + (start, end))))
+        t_vect = bench(name + ' (numpy)', lambda: vectorized(signal, *(args + (start, end))))
+        arrays = primitives.signal_arrays(signal)
+        t_arrays = bench(name + ' (numpy, pre-extracted)', lambda: vectorized(arrays, *(args + (start, end))))
+        print('%-40s %10.1fx / %.1fx' % ('.. speedup', t_naive / t_vect, t_naive / t_arrays))
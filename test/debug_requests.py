@@ -13,7 +13,7 @@ definition = [{
 
 req = requests.Request(
     'PUT',
-    "http://localhost:8888/vardefs",
+    "http://localhost:8888/api/dss/sites/3/vardefs",
     json=definition,
     headers={
         "Content-Type": "application/json",
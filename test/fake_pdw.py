@@ -1,24 +1,281 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+""" A local fake of the PERFORMER Data Warehouse, for testing the upload path under degraded
+network conditions.
+
+It implements the ``varlist``, ``vardefs`` and ``series`` routes of the sites API, and can simulate:
+
+- a latency (with random jitter) added to every request,
+- a bandwidth cap, delaying the replies by the time needed to transfer the request body,
+- server errors, replied with a given probability,
+- connection drops (the connection is closed without reply), with a given probability.
+
+Throughput statistics are printed when the server is stopped, and can be obtained at any time
+with a GET on ``/stats``.
+"""
+
+import sys
+import time
+import json
+import random
+import zipfile
+import cStringIO
+import threading
+from argparse import ArgumentParser
+
+import tornado.gen
+import tornado.httpserver
+import tornado.httputil
 import tornado.ioloop
+import tornado.netutil
 import tornado.web
 
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+SITES_ROUTE = r'/api/dss/sites/(\d+)/'
+
+
+class FakePDWStats(object):
+    """ Statistics of the requests processed by the fake PDW """
+    def __init__(self):
+        self.started = time.time()
+        self.requests = {}
+        self.errors = 0
+        self.drops = 0
+        self.bytes_received = 0
+        self.points_received = 0
+        self.durations = []
+
+    def as_dict(self):
+        elapsed = time.time() - self.started
+        durations = sorted(self.durations)
+        return {
+            'elapsed': elapsed,
+            'requests': dict(self.requests),
+            'errors': self.errors,
+            'drops': self.drops,
+            'bytes_received': self.bytes_received,
+            'points_received': self.points_received,
+            'bytes_per_second': self.bytes_received / elapsed if elapsed else 0,
+            'points_per_second': self.points_received / elapsed if elapsed else 0,
+            'max_request_seconds': durations[-1] if durations else 0,
+            'median_request_seconds': durations[len(durations) // 2] if durations else 0,
+        }
+
+
+class FakePDW(object):
+    def __init__(self, latency=0, jitter=0, bandwidth=None, error_rate=0, drop_rate=0, seed=None, verbose=False):
+        """
+        :param float latency: the delay (seconds) added to every request
+        :param float jitter: the maximum random delay (seconds) added to the latency
+        :param int bandwidth: the bandwidth cap (bytes per second) applied to the request bodies (None for no cap)
+        :param float error_rate: the probability of replying with a server error
+        :param float drop_rate: the probability of closing the connection without reply
+        :param seed: the seed of the faults random generator, for reproducible runs
+        :param bool verbose: if True, the received data are printed
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.verbose = verbose
+        self.random = random.Random(seed)
+
+        # variable definitions and recorded points, keyed by site id
+        self.variables = {}
+        self.series = {}
+        self.stats = FakePDWStats()
+
+        self._ioloop = self._server = self._thread = None
+
+    def make_app(self):
+        params = {'pdw': self}
+        return tornado.web.Application([
+            (SITES_ROUTE + 'varlist', VarListHandler, params),
+            (SITES_ROUTE + 'vardefs', VarDefsHandler, params),
+            (SITES_ROUTE + 'series', SeriesHandler, params),
+            (r'/stats', StatsHandler, params),
+        ])
+
+    def delay(self, body_size):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if self.bandwidth:
+            delay += float(body_size) / self.bandwidth
+        return delay
+
+    def fault(self):
+        """ Returns the fault to be simulated for a request ('drop', 'error' or None) """
+        draw = self.random.random()
+        if draw < self.drop_rate:
+            return 'drop'
+        if draw < self.drop_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def start_thread(self, port=0):
+        """ Starts the server in a background thread.
+
+        :param int port: the listening port (0 for any free port)
+        :return: the listening port
+        """
+        sockets = tornado.netutil.bind_sockets(port, 'localhost')
+        ready = threading.Event()
+
+        def serve():
+            self._ioloop = tornado.ioloop.IOLoop()
+            self._ioloop.make_current()
+            self._server = tornado.httpserver.HTTPServer(self.make_app())
+            self._server.add_sockets(sockets)
+            ready.set()
+            self._ioloop.start()
+            self._ioloop.close(all_fds=True)
+
+        self._thread = threading.Thread(target=serve)
+        self._thread.daemon = True
+        self._thread.start()
+        ready.wait()
+        return sockets[0].getsockname()[1]
+
+    def stop(self):
+        """ Stops a server started by :py:meth:`start_thread`. """
+        def _stop():
+            self._server.stop()
+            self._ioloop.stop()
+
+        self._ioloop.add_callback(_stop)
+        self._thread.join()
+
+
+class FakePDWHandler(tornado.web.RequestHandler):
+    def initialize(self, pdw):
+        self.pdw = pdw
+
+    @tornado.gen.coroutine
+    def simulate_network(self):
+        """ Applies the simulated network conditions.
+
+        :return: True if the request must be processed, False if a fault has been simulated
+        """
+        pdw = self.pdw
+        route = self.request.path.rsplit('/', 1)[-1]
+        pdw.stats.requests[route] = pdw.stats.requests.get(route, 0) + 1
+        self._started = time.time()
+
+        yield tornado.gen.sleep(pdw.delay(len(self.request.body)))
+
+        fault = pdw.fault()
+        if fault == 'drop':
+            pdw.stats.drops += 1
+            self.request.connection.stream.close()
+            raise tornado.gen.Return(False)
+        if fault == 'error':
+            pdw.stats.errors += 1
+            self.send_error(503)
+            raise tornado.gen.Return(False)
+
+        pdw.stats.bytes_received += len(self.request.body)
+        raise tornado.gen.Return(True)
+
+    def on_finish(self):
+        started = getattr(self, '_started', None)
+        if started:
+            self.pdw.stats.durations.append(time.time() - started)
+
+
+class VarListHandler(FakePDWHandler):
+    @tornado.gen.coroutine
+    def get(self, site_id):
+        if (yield self.simulate_network()):
+            self.write({'varlist': sorted(self.pdw.variables.get(site_id, {}))})
+
+
+class VarDefsHandler(FakePDWHandler):
+    @tornado.gen.coroutine
+    def put(self, site_id):
+        if (yield self.simulate_network()):
+            try:
+                definitions = json.loads(self.request.body)
+                variables = self.pdw.variables.setdefault(site_id, {})
+                for definition in definitions:
+                    variables[definition['name']] = definition
+            except (ValueError, TypeError, KeyError) as e:
+                raise tornado.web.HTTPError(400, 'invalid variable definitions (%s)' % e)
+
+            if self.pdw.verbose:
+                print('vardefs[%s]: %s' % (site_id, definitions))
+
+
+class SeriesHandler(FakePDWHandler):
+    @tornado.gen.coroutine
+    def put(self, site_id):
+        if (yield self.simulate_network()):
+            try:
+                archive = zipfile.ZipFile(cStringIO.StringIO(_zip_content(self.request.body)))
+                points = 0
+                site_series = self.pdw.series.setdefault(site_id, {})
+                for member in archive.namelist():
+                    var_name = member.rsplit('.', 1)[0]
+                    lines = [l.split('\t') for l in archive.read(member).splitlines() if l]
+                    site_series.setdefault(var_name, []).extend(lines)
+                    points += len(lines)
+            except (zipfile.BadZipfile, ValueError) as e:
+                raise tornado.web.HTTPError(400, 'invalid series archive (%s)' % e)
+
+            self.pdw.stats.points_received += points
+            if self.pdw.verbose:
+                print('series[%s]: %d point(s) in %d variable(s)' % (site_id, points, len(archive.namelist())))
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, pdw):
+        self.pdw = pdw
+
+    def get(self):
+        self.write(self.pdw.stats.as_dict())
+
+
+def _zip_content(body):
+    """ Returns the zip archive contained in a series upload body.
 
-class MainHandler(tornado.web.RequestHandler):
-    def put(self):
-        print('-' * 80)
-        print(self.request)
-        print('body:' + self.request.body)
+    The connector sends the archive as a multipart form, while labelling the request content as a zip.
+    Both forms are thus accepted.
+    """
+    if not body.startswith('--'):
+        return body
 
+    boundary = body[2:body.index('\r\n')]
+    arguments, files = {}, {}
+    tornado.httputil.parse_multipart_form_data(boundary, body, arguments, files)
+    for parts in files.itervalues():
+        return parts[0]['body']
+    raise ValueError('no file in multipart body')
 
-def make_app():
-    return tornado.web.Application([
-        (r"/vardefs", MainHandler),
-    ])
 
 if __name__ == "__main__":
-    app = make_app()
-    app.listen(8888)
-    tornado.ioloop.IOLoop.current().start()
+    parser = ArgumentParser(description="Fake PDW server")
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--latency', type=float, default=0, help='delay added to every request (s)')
+    parser.add_argument('--jitter', type=float, default=0, help='maximum random delay added to the latency (s)')
+    parser.add_argument('--bandwidth', type=int, help='bandwidth cap of the uploads (bytes/s)')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0, help='server errors probability')
+    parser.add_argument('--drop-rate', dest='drop_rate', type=float, default=0, help='connection drops probability')
+    parser.add_argument('--seed', type=int, help='seed of the faults random generator')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the received data')
+    args = parser.parse_args()
 
+    pdw = FakePDW(
+        latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, drop_rate=args.drop_rate, seed=args.seed, verbose=args.verbose
+    )
+    app = pdw.make_app()
+    app.listen(args.port)
+    print('fake PDW listening on port %d' % args.port)
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        json.dump(pdw.stats.as_dict(), sys.stdout, indent=4, sort_keys=True)
+        print('')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Load test of the PDW upload path.
+
+Drives :py:class:`pycstbox.performer.commons.pdw.PDWConnectorMixin` against a PDW (by default the fake one
+of ``fake_pdw.py``, started in-process with the requested network conditions), and reports the upload
+performance and the retries needed to get the points stored.
+
+The connector does not retry failed uploads by itself : the retry policy simulated here (fixed count,
+exponential back-off) is applied around :py:meth:`store_single_points`, the way a caller would do.
+
+Usage examples::
+
+    load_pdw.py --uploads 200 --points 50 --latency 0.3 --bandwidth 8000 --error-rate 0.05 --drop-rate 0.02
+    load_pdw.py --url http://localhost:8888 --uploads 100      # against an already running server
+"""
+
+import sys
+import os
+import time
+import json
+import logging
+import tempfile
+import threading
+import datetime
+from argparse import ArgumentParser
+
+import requests
+
+from pycstbox.performer.commons.pdw import PDWConnectorMixin, PDWConnectorError
+from pycstbox.performer.commons import localstore
+
+from fake_pdw import FakePDW
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+SITE_ID = 3
+
+
+class LoadTestConnector(PDWConnectorMixin):
+    """ The tested connector, which URL and local store are set from the command line """
+
+
+class UploadStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.uploads = self.failed = self.attempts = self.points = 0
+        self.durations = []
+        self.retries_histogram = {}
+
+    def record(self, points, attempts, duration, success):
+        with self._lock:
+            self.uploads += 1
+            self.attempts += attempts
+            self.retries_histogram[attempts - 1] = self.retries_histogram.get(attempts - 1, 0) + 1
+            if success:
+                self.points += points
+                self.durations.append(duration)
+            else:
+                self.failed += 1
+
+    def report(self, elapsed):
+        durations = sorted(self.durations)
+
+        def percentile(p):
+            return durations[min(len(durations) - 1, int(len(durations) * p))] if durations else 0
+
+        return {
+            'elapsed': elapsed,
+            'uploads': self.uploads,
+            'failed_uploads': self.failed,
+            'requests': self.attempts,
+            'retries': dict(self.retries_histogram),
+            'points_stored': self.points,
+            'points_per_second': self.points / elapsed if elapsed else 0,
+            'upload_seconds_p50': percentile(.5),
+            'upload_seconds_p95': percentile(.95),
+            'upload_seconds_max': durations[-1] if durations else 0,
+        }
+
+
+def with_retries(action, retries, retry_delay):
+    """ Executes an action, retrying it with an exponential back-off if it fails.
+
+    :return: the count of attempts and the error of the last one (None if successful)
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            action()
+        except PDWConnectorError as e:
+            if attempt > retries:
+                return attempt, e
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+        else:
+            return attempt, None
+
+
+def var_name(i):
+    return 'load_%03d' % i
+
+
+def upload_worker(connector, jobs, stats, points_count, retries, retry_delay, logger):
+    timestamp = datetime.datetime.utcnow()
+    while True:
+        with stats._lock:
+            if not jobs:
+                return
+            job = jobs.pop()
+
+        points = [(var_name(i), job * 1000 + i) for i in range(points_count)]
+        started = time.time()
+        attempts, error = with_retries(
+            lambda: connector.store_single_points(SITE_ID, points, timestamp), retries, retry_delay
+        )
+        if error:
+            logger.error('upload #%d failed after %d attempt(s) : %s', job, attempts, error)
+        stats.record(points_count, attempts, time.time() - started, error is None)
+
+
+def main():
+    parser = ArgumentParser(description="PDW upload load test")
+    parser.add_argument('--url', help='base URL of the tested PDW (default: in-process fake PDW)')
+    parser.add_argument('--uploads', type=int, default=100, help='count of uploads')
+    parser.add_argument('--points', type=int, default=20, help='points per upload')
+    parser.add_argument('--concurrency', type=int, default=1, help='count of concurrent uploaders')
+    parser.add_argument('--retries', type=int, default=3, help='retries of a failed upload')
+    parser.add_argument('--retry-delay', dest='retry_delay', type=float, default=.5,
+                        help='initial delay between retries (s), doubled at each one')
+    parser.add_argument('--timeout', type=float, default=30, help='read timeout of the requests (s)')
+    group = parser.add_argument_group('fake PDW network conditions')
+    group.add_argument('--latency', type=float, default=0)
+    group.add_argument('--jitter', type=float, default=0)
+    group.add_argument('--bandwidth', type=int)
+    group.add_argument('--error-rate', dest='error_rate', type=float, default=0)
+    group.add_argument('--drop-rate', dest='drop_rate', type=float, default=0)
+    group.add_argument('--seed', type=int)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARN)
+    logger = logging.getLogger('load-pdw')
+
+    fake_pdw = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        fake_pdw = FakePDW(
+            latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+            error_rate=args.error_rate, drop_rate=args.drop_rate, seed=args.seed
+        )
+        base_url = 'http://localhost:%d' % fake_pdw.start_thread()
+
+    fd, local_store = tempfile.mkstemp(suffix='.dat')
+    os.close(fd)
+
+    LoadTestConnector.URL = base_url + '/api/dss/sites/%(site_id)s/%(path)s'
+    LoadTestConnector.LOCAL_STORE = local_store
+    LoadTestConnector.REQUEST_TIMEOUT = (10, args.timeout)
+    connector = LoadTestConnector(logger)
+
+    attempts, error = with_retries(
+        lambda: connector.declare_pdw_variables(SITE_ID, {var_name(i): {'type': 'load'} for i in range(args.points)}),
+        args.retries, args.retry_delay
+    )
+    if error:
+        sys.exit('variables declaration failed after %d attempt(s) : %s' % (attempts, error))
+
+    stats = UploadStats()
+    jobs = list(reversed(range(args.uploads)))
+    started = time.time()
+    try:
+        workers = [
+            threading.Thread(
+                target=upload_worker,
+                args=(connector, jobs, stats, args.points, args.retries, args.retry_delay, logger)
+            )
+            for _ in range(args.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - started
+
+        report = {'client': stats.report(elapsed)}
+        if fake_pdw:
+            report['server'] = fake_pdw.stats.as_dict()
+        else:
+            try:
+                report['server'] = requests.get(base_url + '/stats', timeout=10).json()
+            except (requests.RequestException, ValueError):
+                pass
+
+    finally:
+        if fake_pdw:
+            fake_pdw.stop()
+        localstore.flush_all()
+        os.remove(local_store)
+
+    json.dump(report, sys.stdout, indent=4, sort_keys=True)
+    print('')
+    return 1 if stats.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
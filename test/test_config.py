@@ -50,6 +50,21 @@ class ConfigTestCase(unittest.TestCase):
         self.assertEquals(len(analyzers), 2)
         self.assertSetEqual({a[0].__name__ for a in analyzers}, {'WU1', 'WU3'})
 
+    def test_05_priority(self):
+        cfg_path = os.path.join(__here__, 'fixtures/analytics-priority.cfg')
+        runner = Runner(config_path=cfg_path, period=PeriodicAnalyzer.PERIOD_DAY)
+        analyzers = runner.prepare_analyzers()
+        self.assertListEqual([a.analyzer_class.__name__ for a in analyzers], ['WU2', 'WU1', 'WU3'])
+        self.assertListEqual([a.timeout for a in analyzers], [120, 600, 600])
+        self.assertEqual(runner.run_deadline, 3000)
+
+    def test_06_bad_timeout(self):
+        cfg_path = os.path.join(__here__, 'fixtures/analytics-bad_timeout.cfg')
+        runner = Runner(config_path=cfg_path, period=PeriodicAnalyzer.PERIOD_DAY)
+        with self.assertRaises(AnalyzerError) as cm:
+            runner.prepare_analyzers()
+        self.assertIn('invalid analyzer_timeout', cm.exception.message)
+
 
 class ConfigRelativePathTestCase(unittest.TestCase):
     import_name = 'wu.cfg'
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import datetime
+import tempfile
+import shutil
+from collections import namedtuple
+
+from array import array
+
+from evtsignals import LogicSignal
+
+from pycstbox.performer.commons.daycache import DayCache, columns_from_events, column_values
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+Event = namedtuple('Event', 'timestamp var_type var_name value')
+
+DAY = datetime.date(2016, 5, 3)
+
+
+def _ts(h, m=0):
+    return datetime.datetime.combine(DAY, datetime.time(h, m))
+
+
+def _ms(dt):
+    return (dt - datetime.datetime(1970, 1, 1)).total_seconds() * 1000
+
+
+class DayCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = DayCache(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _store_sample_day(self):
+        events = [
+            Event(_ts(8), 'temperature', 'temp', 20.5),
+            Event(_ts(9), 'opened', 'window', True),
+            Event(_ts(10), 'temperature', 'temp', '21'),
+            Event(_ts(9, 30), 'temperature', 'temp', 21.5),
+            Event(_ts(11), 'opened', 'window', 'false'),
+        ]
+        self.cache.store(DAY, columns_from_events(events))
+
+    def test_01_column_values(self):
+        self.assertIsInstance(column_values([True, 12, 12.5]), array)
+        self.assertListEqual(list(column_values([True, 12, 12.5])), [1., 12., 12.5])
+        # non numeric values are kept as they are
+        self.assertListEqual(column_values([12.5, '12.5', 'foo']), [12.5, '12.5', 'foo'])
+
+    def test_02_round_trip(self):
+        self.assertIsNone(self.cache.load(DAY, ['temp']))
+        self._store_sample_day()
+        self.assertTrue(self.cache.contains(DAY))
+        self.assertListEqual(self.cache.cached_days(), [DAY])
+        self.assertSetEqual(set(self.cache.variables(DAY)), {'temp', 'window'})
+
+        columns = self.cache.load(DAY, ['temp', 'window', 'missing'])
+        self.assertSetEqual(set(columns), {'temp', 'window'})
+
+        timestamps, values = columns['temp'].slice()
+        self.assertListEqual(list(timestamps), [_ms(_ts(8)), _ms(_ts(9, 30)), _ms(_ts(10))])
+        self.assertListEqual(list(values), [20.5, 21.5, '21'])
+
+        timestamps, values = columns['window'].slice()
+        self.assertListEqual(list(values), [True, 'false'])
+
+        for c in columns.itervalues():
+            c.close()
+
+    def test_03_slice(self):
+        self._store_sample_day()
+        temp = self.cache.load(DAY, ['temp'])['temp']
+        try:
+            timestamps, values = temp.slice(_ms(_ts(9)), _ms(_ts(10)))
+            self.assertListEqual(list(values), [21.5, '21'])
+            timestamps, values = temp.slice(_ms(_ts(10, 1)), None)
+            self.assertEqual(len(timestamps), 0)
+        finally:
+            temp.close()
+
+    def test_04_empty_day_and_invalidation(self):
+        self.cache.store(DAY, {})
+        self.assertDictEqual(self.cache.load(DAY, ['temp']), {})
+
+        self.cache.invalidate(DAY)
+        self.assertFalse(self.cache.contains(DAY))
+        self.assertIsNone(self.cache.load(DAY, ['temp']))
+
+        self.cache.mark_uncacheable(DAY, 'unsupported values')
+        self.assertTrue(self.cache.is_uncacheable(DAY))
+        self.assertListEqual(self.cache.cached_days(), [])
+        self.cache.invalidate_range(DAY, DAY)
+        self.assertFalse(self.cache.is_uncacheable(DAY))
+
+    def test_05_logic_values(self):
+        # cast by the signals the same way as when read from the DAO
+        events = [Event(_ts(8), 'presence', 'occupied', '2'), Event(_ts(9), 'presence', 'occupied', '1.0')]
+        self.cache.store(DAY, columns_from_events(events))
+        occupied = self.cache.load(DAY, ['occupied'])['occupied']
+        try:
+            timestamps, values = occupied.slice()
+        finally:
+            occupied.close()
+        expected = LogicSignal()
+        cached = LogicSignal()
+        for event, ts, value in zip(events, timestamps, values):
+            expected.add_point(event.timestamp, event.value, auto_cast=True)
+            cached.add_point(long(ts), value, auto_cast=True)
+        self.assertEqual(cached, expected)
+        self.assertFalse(cached.start_value())
+
+        with self.assertRaises(ValueError):
+            self.cache.store(DAY, {'foo': ([0.], [object()])})
+
+    def test_06_replace(self):
+        self.cache.store(DAY, {'temp': ([_ms(_ts(8))], [20.])})
+        temp = self.cache.load(DAY, ['temp'])['temp']
+        try:
+            # materialized meanwhile by another process => kept
+            self.cache.store(DAY, {'temp': ([_ms(_ts(8))], [21.])}, replace=False)
+            self.assertListEqual(list(self.cache.load(DAY, ['temp'])['temp'].slice()[1]), [20.])
+
+            self.cache.store(DAY, {'temp': ([_ms(_ts(8))], [22.])})
+            self.assertListEqual(list(self.cache.load(DAY, ['temp'])['temp'].slice()[1]), [22.])
+            # readers of the replaced content are not affected
+            self.assertListEqual(list(temp.slice()[1]), [20.])
+            self.assertListEqual(self.cache.cached_days(), [DAY])
+        finally:
+            temp.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
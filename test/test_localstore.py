@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import time
+import tempfile
+import shutil
+import threading
+
+from pycstbox.performer.commons import localstore
+from pycstbox.performer.commons.localstore import LocalStoreWriter
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+class LocalStoreWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'pdw.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _content(self):
+        with open(self.path) as fp:
+            return fp.read()
+
+    def test_01_batching(self):
+        writer = LocalStoreWriter(self.path, flush_period=60)
+        writer.write_lines(['a\n', 'b\n'])
+        writer.write_lines(['c\n'])
+        # nothing written before the end of the flush period
+        time.sleep(0.1)
+        self.assertFalse(os.path.exists(self.path))
+
+        writer.flush()
+        self.assertEqual(self._content(), 'a\nb\nc\n')
+        writer.close()
+
+    def test_02_periodic_write(self):
+        writer = LocalStoreWriter(self.path, flush_period=0.05)
+        writer.write_lines(['a\n'])
+        time.sleep(0.5)
+        self.assertEqual(self._content(), 'a\n')
+        writer.close()
+
+    def test_03_close(self):
+        writer = LocalStoreWriter(self.path, flush_period=60)
+        writer.write_lines('line %d\n' % i for i in range(1000))
+        writer.close()
+        self.assertEqual(self._content().splitlines(), ['line %d' % i for i in range(1000)])
+        with self.assertRaises(ValueError):
+            writer.write_lines(['x\n'])
+
+    def test_04_concurrent_writers(self):
+        writer = LocalStoreWriter(self.path, flush_period=0.01)
+
+        def produce(name):
+            for i in range(200):
+                writer.write_lines(['%s\t%d\n' % (name, i)])
+
+        threads = [threading.Thread(target=produce, args=('t%d' % n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        writer.close()
+
+        lines = [line.split('\t') for line in self._content().splitlines()]
+        self.assertEqual(len(lines), 800)
+        # each producer lines are kept in order
+        for n in range(4):
+            self.assertEqual([int(i) for name, i in lines if name == 't%d' % n], range(200))
+
+    def test_05_shared_writer(self):
+        writer = localstore.get_writer(self.path)
+        self.assertIs(localstore.get_writer(self.path), writer)
+
+        writer.write_lines(['a\n'])
+        localstore.flush_all()
+        self.assertEqual(self._content(), 'a\n')
+
+    def test_06_write_error(self):
+        writer = LocalStoreWriter(os.path.join(self.tmp_dir, 'missing', 'pdw.dat'), flush_period=0)
+        writer.write_lines(['a\n'])
+        # lines are lost, but the writer goes on
+        writer.flush()
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import datetime
+import tempfile
+import shutil
+import random
+
+import numpy as np
+from evtsignals import AnalogSignal, LogicSignal
+
+from pycstbox.performer.commons.analytics import PeriodicAnalyzer, AbstractIndicator
+from pycstbox.performer.commons.data import DataAccessMixin
+from pycstbox.performer.commons.daycache import DayCache
+from pycstbox.performer.commons.memory import MemoryBudget, SpillArea, SpilledSignal, spilled_class, rss_bytes
+from pycstbox.performer.commons import primitives
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+DAY = datetime.date(2016, 5, 3)
+T0 = 1462233600000      # DAY 00:00 UTC
+MINUTE = 60 * 1000
+
+POINTS = [(T0 + i * MINUTE, float(i // 3 % 7)) for i in range(1000)]
+
+
+class SpilledSignalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.area = SpillArea(self.root)
+
+    def tearDown(self):
+        self.area.close()
+        shutil.rmtree(self.root)
+
+    def _check_same(self, signal_class, points, buffer_size=16):
+        expected = signal_class()
+        spilled = spilled_class(signal_class)(self.area)
+        spilled.BUFFER_SIZE = buffer_size
+        for t, v in points:
+            expected.add_point(t, v, auto_cast=True)
+            spilled.add_point(t, v, auto_cast=True)
+
+        self.assertIsInstance(spilled, signal_class)
+        self.assertEqual(len(spilled), len(expected))
+        self.assertEqual(list(spilled), expected.points)
+        times, values = spilled.as_arrays()
+        self.assertIsInstance(times, np.memmap)
+        exp_times, exp_values = primitives.signal_arrays(expected)
+        self.assertTrue(np.array_equal(times, exp_times))
+        self.assertTrue(np.array_equal(values, exp_values))
+        self.assertEqual(spilled.materialize(), expected)
+
+    def test_01_analog(self):
+        self._check_same(AnalogSignal, POINTS)
+
+    def test_02_logic(self):
+        self._check_same(LogicSignal, [(t, v > 3) for t, v in POINTS])
+
+    def test_03_from_signal(self):
+        signal = AnalogSignal()
+        for t, v in POINTS:
+            signal.add_point(t, v)
+        spilled = SpilledSignal.from_signal(signal, self.area)
+        self.assertEqual(spilled.materialize(), signal)
+        self.assertEqual(primitives.time_weighted_average(spilled), primitives.time_weighted_average(signal))
+
+    def test_04_unordered_points(self):
+        rnd = random.Random(0)
+        points = [(T0 + rnd.randint(0, 200) * MINUTE, float(rnd.randint(0, 2))) for _ in range(500)]
+        self._check_same(AnalogSignal, points)
+        self._check_same(LogicSignal, [(t, v > 0) for t, v in points])
+        # the same as the ordered points once the signal is loaded
+        self._check_same(AnalogSignal, sorted(points), buffer_size=1)
+
+    def test_05_operations(self):
+        signals = {}
+        for signal_class, points in ((AnalogSignal, POINTS), (LogicSignal, [(t, v > 3) for t, v in POINTS])):
+            expected = signal_class(points)
+            spilled = SpilledSignal.from_signal(expected, self.area)
+            signals[signal_class] = expected, spilled
+
+            self.assertEqual(spilled, expected)
+            self.assertEqual(spilled.start_time(), expected.start_time())
+            self.assertEqual(spilled.end_value(), expected.end_value())
+            self.assertEqual(spilled[10], expected[10])
+            for t in (T0 - MINUTE, T0, T0 + 10 * MINUTE + 1, T0 + 2000 * MINUTE):
+                self.assertEqual(spilled.get_value_at(t), expected.get_value_at(t))
+            self.assertEqual(
+                spilled.get_slice(T0 + MINUTE, T0 + 100 * MINUTE), expected.get_slice(T0 + MINUTE, T0 + 100 * MINUTE)
+            )
+
+        expected, spilled = signals[LogicSignal]
+        self.assertEqual(spilled.integrate(), expected.integrate())
+        trigger = signals[AnalogSignal][0].trigger(5)
+        self.assertEqual(spilled.logic_and(trigger), expected.logic_and(trigger))
+        self.assertEqual(trigger.logic_or(spilled), trigger.logic_or(expected))
+
+        # operations modifying the points list
+        spilled.invert()
+        expected.invert()
+        self.assertEqual(spilled.as_arrays()[1].tolist(), [float(p.value) for p in expected])
+
+
+class MemoryBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_01_no_budget(self):
+        budget = MemoryBudget(spill_dir=self.root)
+        self.assertFalse(budget.check())
+        self.assertNotIsInstance(budget.buffer(10), np.memmap)
+        self.assertIsInstance(budget.new_signal(AnalogSignal), AnalogSignal)
+
+    def test_02_exceeded(self):
+        self.assertTrue(rss_bytes())
+        budget = MemoryBudget(1, spill_dir=self.root)
+        self.assertTrue(budget.check())
+        self.assertIsInstance(budget.buffer(10), np.memmap)
+        self.assertIsInstance(budget.new_signal(AnalogSignal), SpilledSignal)
+        self.assertIsInstance(budget.new_signal(AnalogSignal), AnalogSignal)
+        # non numeric signals are kept in memory
+        self.assertIsInstance(budget.new_signal(list), list)
+
+        self.assertTrue(os.listdir(self.root))
+        budget.release()
+        self.assertFalse(os.listdir(self.root))
+
+
+class TemperatureAnalyzer(DataAccessMixin, PeriodicAnalyzer):
+    Indicator = AbstractIndicator
+
+    def __init__(self, indicator, period, computation_date, **kwargs):
+        super(TemperatureAnalyzer, self).__init__('test', indicator, period, computation_date, **kwargs)
+
+
+class HeatingAnalyzer(TemperatureAnalyzer):
+    """ Uses the operations of the in-memory signals """
+    def load_inputs(self, time_frame):
+        return self.extract_signals(time_frame, {'temp': AnalogSignal, 'heating': LogicSignal})
+
+    def create_outputs(self):
+        return ['heating_time', 'heating_when_warm', 'noon_temp', 'start']
+
+    def process_inputs(self, inputs):
+        self.spilled = isinstance(inputs['temp'], SpilledSignal)
+        temp, heating = inputs['temp'], inputs['heating']
+        self.set_output('heating_time', heating.integrate(self.time_frame.start, self.time_frame.end))
+        self.set_output('heating_when_warm', heating.logic_and(temp.trigger(4)).integrate())
+        self.set_output('noon_temp', temp.get_value_at(datetime.datetime.combine(DAY, datetime.time(12))))
+        self.set_output('start', temp.start_time())
+
+    def store_single_point_outputs(self, timestamp=None):
+        self.stored = dict(self._outputs)
+
+
+class SpillingExtractionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        times, values = zip(*POINTS)
+        DayCache(self.root + '/archive').store(DAY, {'temp': (times, values), 'heating': (times, values)})
+        TemperatureAnalyzer.event_source_config = {'backend': 'archive', 'path': self.root + '/archive'}
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _extract(self, **kwargs):
+        analyzer = TemperatureAnalyzer(
+            AbstractIndicator('temperature', 'temperature', 'temperature'),
+            PeriodicAnalyzer.PERIOD_DAY, datetime.datetime(2016, 5, 4), **kwargs
+        )
+        analyzer.memory._spill_dir = self.root + '/spill'
+        signals = analyzer.extract_signals(analyzer.time_frame, {'temp': AnalogSignal, 'heating': LogicSignal})
+        return analyzer, signals
+
+    def test_01_spilled_extraction(self):
+        _, expected = self._extract()
+        analyzer, signals = self._extract(memory_budget=1)
+        self.assertTrue(analyzer.memory.spilling)
+        for name in ('temp', 'heating'):
+            self.assertIsInstance(signals[name], SpilledSignal)
+            self.assertEqual(signals[name].materialize(), expected[name])
+        self.assertEqual(
+            primitives.time_weighted_average(signals['temp']), primitives.time_weighted_average(expected['temp'])
+        )
+        analyzer.memory.release()
+        self.assertFalse(os.listdir(self.root + '/spill'))
+
+    def test_02_analyzer_run(self):
+        results = []
+        for budget in (None, 1):
+            analyzer = HeatingAnalyzer(
+                AbstractIndicator('heating', 'heating', 'heating'),
+                PeriodicAnalyzer.PERIOD_DAY, datetime.datetime(2016, 5, 4), memory_budget=budget
+            )
+            analyzer.memory._spill_dir = self.root + '/spill'
+            analyzer.run()
+            self.assertEqual(analyzer.spilled, bool(budget))
+            results.append(analyzer.stored)
+        self.assertTrue(results[0]['heating_time'])
+        self.assertDictEqual(results[1], results[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+
+from pycstbox.performer.commons.metrics import RunMetrics, read_last_success
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+class RunMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = RunMetrics()
+        self.metrics.begin_indicator('WU1')
+        self.metrics.add('events_read', 100)
+        self.metrics.add('upload_max_seconds', 0.5)
+        self.metrics.add('upload_max_seconds', 0.2)
+        self.metrics.merge_counters({'events_read': 150, 'pdw_errors': 1}, since={'events_read': 100})
+        self.metrics.end_indicator(1.5, True)
+
+        self.metrics.add('events_read', 1000)
+
+    def test_01_counters(self):
+        (name, data), = self.metrics.indicators()
+        self.assertEqual(name, 'WU1')
+        self.assertEqual(data['counters']['events_read'], 150)
+        self.assertEqual(data['counters']['upload_max_seconds'], 0.5)
+        self.assertEqual(data['counters']['pdw_errors'], 1)
+
+    def test_02_format(self):
+        text = self.metrics.format('day', True, 12.5, 1462233600.)
+        self.assertIn('performer_analytics_run_success{period="day"} 1\n', text)
+        self.assertIn('performer_analytics_indicator_events_read{period="day",indicator="WU1"} 150\n', text)
+        self.assertIn('performer_analytics_indicator_duration_seconds{period="day",indicator="WU1"} 1.5\n', text)
+        self.assertIn('# TYPE performer_analytics_indicator_upload_bytes gauge\n', text)
+
+    def test_03_last_success_kept(self):
+        metrics_dir = tempfile.mkdtemp()
+        try:
+            path = self.metrics.write_textfile(metrics_dir, 'week', True, 10)
+            last_success = read_last_success(path)
+            self.assertIsNotNone(last_success)
+
+            self.metrics.write_textfile(metrics_dir, 'week', False, 10)
+            self.assertEqual(read_last_success(path), last_success)
+            with open(path) as fp:
+                self.assertIn('performer_analytics_run_success{period="week"} 0\n', fp.read())
+        finally:
+            shutil.rmtree(metrics_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
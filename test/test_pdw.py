@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import logging
+import json
+import os
+import tempfile
+import threading
+import datetime
+import zipfile
+import cStringIO
+import BaseHTTPServer
+
+from pycstbox.performer.commons.pdw import PDWConnectorMixin, PDWConnectorError, SeriesPayloadBuilder
+from pycstbox.performer.commons import localstore
+from pycstbox.performer.commons.analytics import PeriodicAnalyzer, AbstractIndicator
+from pycstbox.performer.commons.runner import Runner, AnalyzerSpec
+
+from fake_pdw import FakePDW
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+class RecordingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Minimal PDW stub, recording the received requests """
+    variables = []
+    requests = []
+    # replaces the variables list reply if set
+    reply_body = None
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path, None))
+        body = self.reply_body or json.dumps({'varlist': self.variables})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append(('PUT', self.path, data))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class BulkDeclarationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), RecordingHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+
+        RecordingHandler.variables = ['existing']
+        RecordingHandler.requests = []
+        RecordingHandler.reply_body = None
+        PDWConnectorMixin._known_variables.clear()
+
+        self.url = 'http://localhost:%d/api/dss/sites/%%(site_id)s/%%(path)s' % self.server.server_port
+        self.connector = PDWConnectorMixin(logging.getLogger())
+        self.connector.URL = self.url
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        PDWConnectorMixin._known_variables.clear()
+
+    def test_01_single_request(self):
+        var_defs = {
+            'existing': {'type': 'ratio'},
+            'wu1': {'type': 'ratio'},
+            'wu2': {'type': 'ratio', 'unit': '%'},
+        }
+        declared = self.connector.declare_pdw_variables(3, var_defs)
+        self.assertListEqual(declared, ['wu1', 'wu2'])
+
+        get, put = RecordingHandler.requests
+        self.assertEqual(get[:2], ('GET', '/api/dss/sites/3/varlist'))
+        self.assertEqual(put[:2], ('PUT', '/api/dss/sites/3/vardefs'))
+        self.assertListEqual(json.loads(put[2]), [
+            {'name': 'wu1', 'type': 'ratio', 'unit': 'none'},
+            {'name': 'wu2', 'type': 'ratio', 'unit': '%'},
+        ])
+
+        # nothing left to declare, and variables list not queried again
+        self.assertListEqual(self.connector.declare_pdw_variables(3, var_defs), [])
+        self.connector.create_pdw_variable_if_needed(3, 'wu2', var_defs['wu2'])
+        self.assertEqual(len(RecordingHandler.requests), 2)
+
+    def test_02_invalid_meta(self):
+        with self.assertRaises(ValueError):
+            self.connector.declare_pdw_variables(3, {'wu1': {'unit': '%'}})
+
+    def test_03_dry_run(self):
+        var_defs = {'wu1': {'type': 'ratio'}}
+        dry_connector = PDWConnectorMixin(logging.getLogger(), dry_run=True)
+        dry_connector.URL = self.url
+        self.assertListEqual(dry_connector.declare_pdw_variables(3, var_defs), ['wu1'])
+        dry_connector.create_pdw_variable_if_needed(3, 'wu2', {'type': 'ratio'})
+        self.assertEqual([r[0] for r in RecordingHandler.requests], ['GET'])
+
+        # simulated declarations are not taken as done by the next connectors
+        self.assertListEqual(self.connector.declare_pdw_variables(3, var_defs), ['wu1'])
+        self.connector.create_pdw_variable_if_needed(3, 'wu2', {'type': 'ratio'})
+        self.assertEqual([r[0] for r in RecordingHandler.requests], ['GET', 'PUT', 'PUT'])
+
+    def test_04_invalid_varlist(self):
+        RecordingHandler.reply_body = json.dumps({'error': 'unknown site'})
+        with self.assertRaises(PDWConnectorError):
+            self.connector.declare_pdw_variables(3, {'wu1': {'type': 'ratio'}})
+        self.assertIsNone(self.connector.create_pdw_variable_if_needed(3, 'wu1', {'type': 'ratio'}))
+
+        # not fatal for the run
+        indicator = AbstractIndicator('wu', 'wu', 'wu')
+        indicator.output_variables = lambda: {'wu1': {'type': 'ratio'}}
+        runner = Runner(config_path='/dev/null', period=PeriodicAnalyzer.PERIOD_DAY)
+        spec = AnalyzerSpec(None, {'site_id': 3}, indicator, 0, None)
+        PDWConnectorMixin.URL, url = self.url, PDWConnectorMixin.URL
+        try:
+            self.assertEqual(runner.declare_output_variables([spec]), 0)
+        finally:
+            PDWConnectorMixin.URL = url
+
+    def test_05_mixed_dry_run(self):
+        live, dry = AbstractIndicator('wu', 'wu', 'wu'), AbstractIndicator('wd', 'wd', 'wd')
+        live.output_variables = lambda: {'wu1': {'type': 'ratio'}}
+        dry.output_variables = lambda: {'wd1': {'type': 'ratio'}}
+        runner = Runner(config_path='/dev/null', period=PeriodicAnalyzer.PERIOD_DAY)
+        specs = [
+            AnalyzerSpec(None, {'site_id': 3}, live, 0, None),
+            AnalyzerSpec(None, {'site_id': 3, 'dry_run': True}, dry, 0, None),
+        ]
+        PDWConnectorMixin.URL, url = self.url, PDWConnectorMixin.URL
+        try:
+            self.assertEqual(runner.declare_output_variables(specs), 2)
+        finally:
+            PDWConnectorMixin.URL = url
+
+        # only the variables of the live analyzer are really created
+        puts = [json.loads(r[2]) for r in RecordingHandler.requests if r[0] == 'PUT']
+        self.assertListEqual(puts, [[{'name': 'wu1', 'type': 'ratio', 'unit': 'none'}]])
+
+
+class SeriesPayloadBuilderTestCase(unittest.TestCase):
+    def test_01_size_cap(self):
+        builder = SeriesPayloadBuilder(max_size=4096)
+        expected = {}
+        for v in range(40):
+            for d in range(1, 31):
+                builder.add('var_%02d' % v, '2016-05-%02d' % d, v * 1.5 + d)
+                expected.setdefault('var_%02d.tsv' % v, []).append('2016-05-%02d\t%s' % (d, v * 1.5 + d))
+        # a variable which data do not fit in a single payload
+        for i in range(1000):
+            builder.add('big', '2016-05-01T00:%02d:%02d' % (i // 60 % 60, i % 60), i)
+            expected.setdefault('big.tsv', []).append('2016-05-01T00:%02d:%02d\t%s' % (i // 60 % 60, i % 60, i))
+
+        payloads = builder.payloads()
+        self.assertGreater(len(payloads), 1)
+        received = {}
+        for payload in payloads:
+            self.assertLessEqual(len(payload.data), 4096)
+            self.assertGreater(payload.compression_ratio, 1)
+            archive = zipfile.ZipFile(cStringIO.StringIO(payload.data))
+            for name in archive.namelist():
+                received.setdefault(name, []).extend(archive.read(name).splitlines())
+        self.assertDictEqual(received, expected)
+        self.assertEqual(sum(p.points for p in payloads), 40 * 30 + 1000)
+
+    def test_02_tiny_members_stored(self):
+        builder = SeriesPayloadBuilder()
+        builder.add('wu1', '2016-05-03', 0.5)
+        payload, = builder.payloads()
+        info, = zipfile.ZipFile(cStringIO.StringIO(payload.data)).infolist()
+        self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+
+    def test_03_compress_level(self):
+        sizes = []
+        for level in (1, 9):
+            builder = SeriesPayloadBuilder(compress_level=level)
+            for i in range(2000):
+                builder.add('var_%d' % (i % 3), '2016-05-01T%02d:%02d:00' % (i // 60 % 24, i % 60), i % 17 * 0.25)
+            payload, = builder.payloads()
+            archive = zipfile.ZipFile(cStringIO.StringIO(payload.data))
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('var_1.tsv').splitlines()[0], '2016-05-01T00:01:00\t0.25')
+            sizes.append(len(payload.data))
+        self.assertLess(sizes[1], sizes[0])
+
+
+class FakePDWUploadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pdw = FakePDW(seed=0)
+        port = self.pdw.start_thread()
+
+        fd, self.local_store = tempfile.mkstemp()
+        os.close(fd)
+        self.connector = PDWConnectorMixin(logging.getLogger())
+        self.connector.URL = 'http://localhost:%d/api/dss/sites/%%(site_id)s/%%(path)s' % port
+        self.connector.LOCAL_STORE = self.local_store
+
+    def tearDown(self):
+        self.pdw.stop()
+        localstore.flush_all()
+        os.remove(self.local_store)
+
+    def test_01_upload(self):
+        self.connector.store_single_points(3, [('wu1', 0.5), ('wu2', 12)], datetime.date(2016, 5, 3))
+        self.assertDictEqual(self.pdw.series['3'], {
+            'wu1': [['2016-05-03', '0.5']],
+            'wu2': [['2016-05-03', '12']],
+        })
+        self.assertEqual(self.pdw.stats.points_received, 2)
+
+        localstore.flush_all()
+        with open(self.local_store) as fp:
+            self.assertEqual(fp.read(), 'wu1\t2016-05-03\t0.5\nwu2\t2016-05-03\t12\n')
+
+    def test_02_batches(self):
+        self.connector.MAX_PAYLOAD_SIZE = 2048
+        points = [('var_%03d' % i, i) for i in range(200)]
+        self.connector.store_single_points(3, points, datetime.date(2016, 5, 3))
+        self.assertGreater(self.pdw.stats.requests['series'], 1)
+        self.assertEqual(self.pdw.stats.points_received, 200)
+        self.assertEqual(len(self.pdw.series['3']), 200)
+
+    def test_03_faults(self):
+        self.pdw.drop_rate = 1
+        with self.assertRaises(PDWConnectorError):
+            self.connector.store_single_points(3, [('wu1', 0.5)])
+
+        self.pdw.drop_rate, self.pdw.error_rate = 0, 1
+        with self.assertRaises(PDWConnectorError):
+            self.connector.store_single_points(3, [('wu1', 0.5)])
+
+        stats = self.pdw.stats.as_dict()
+        self.assertEqual((stats['drops'], stats['errors'], stats['points_received']), (1, 1, 0))
+
+    def test_04_partial_failure(self):
+        self.connector.MAX_PAYLOAD_SIZE = 2048
+        faults = iter([None, 'error'])
+        self.pdw.fault = lambda: next(faults, None)
+        points = [('var_%03d' % i, i) for i in range(200)]
+        with self.assertRaises(PDWConnectorError) as cm:
+            self.connector.store_single_points(3, points, datetime.date(2016, 5, 3))
+
+        # the error tells which variables have been committed by the first payload
+        uploaded = sorted(self.pdw.series['3'])
+        self.assertTrue(uploaded)
+        self.assertIn('payload 2 out of', str(cm.exception))
+        self.assertIn('variable(s) %s\n' % ', '.join(uploaded), str(cm.exception) + '\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
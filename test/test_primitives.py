@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import random
+import datetime
+
+from evtsignals import AnalogSignal, LogicSignal
+
+from pycstbox.performer.commons import primitives
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+T0 = 1462233600000      # 2016-05-03 00:00 UTC
+HOUR = 3600 * 1000
+
+
+def naive_segments(points, start, end):
+    """ Reference implementation : per-point loop yielding (value, duration) pairs """
+    for i, (t, v) in enumerate(points):
+        t_next = points[i + 1][0] if i + 1 < len(points) else end
+        seg_start, seg_end = max(t, start), min(t_next, end)
+        if seg_end > seg_start:
+            yield v, seg_end - seg_start
+
+
+def random_points(count, seed, logic=False):
+    rnd = random.Random(seed)
+    t = T0
+    points = []
+    for _ in range(count):
+        t += rnd.randint(1, 600) * 1000
+        points.append((t, rnd.random() < 0.5 if logic else rnd.uniform(0, 100)))
+    return points
+
+
+class PrimitivesTestCase(unittest.TestCase):
+    def test_01_simple_cases(self):
+        sig = LogicSignal([(T0, True), (T0 + HOUR, False), (T0 + 3 * HOUR, True)])
+        self.assertEqual(primitives.time_in_state(sig, T0, T0 + 4 * HOUR), 2 * HOUR)
+        self.assertEqual(primitives.time_in_state(sig, T0 + HOUR / 2, T0 + 2 * HOUR), HOUR / 2)
+        self.assertAlmostEqual(primitives.state_ratio(sig, T0, T0 + 4 * HOUR), 0.5)
+        self.assertEqual(primitives.transitions_count(sig), 1)
+        self.assertEqual(primitives.transitions_count(sig, rising=False), 2)
+
+        ana = AnalogSignal([(T0, 10.), (T0 + HOUR, 20.)])
+        self.assertEqual(primitives.time_above(ana, 15, T0, T0 + 3 * HOUR), 2 * HOUR)
+        self.assertEqual(primitives.time_below(ana, 15, T0, T0 + 3 * HOUR), HOUR)
+        self.assertAlmostEqual(primitives.time_weighted_average(ana, T0, T0 + 4 * HOUR), 17.5)
+        self.assertDictEqual(primitives.state_durations(ana, T0, T0 + 2 * HOUR), {10.: HOUR, 20.: HOUR})
+
+    def test_02_datetime_bounds(self):
+        sig = LogicSignal([(T0, True), (T0 + HOUR, False)])
+        start = datetime.datetime(2016, 5, 3)
+        self.assertEqual(primitives.time_in_state(sig, start, start + datetime.timedelta(hours=2)), HOUR)
+
+    def test_03_empty_signal(self):
+        empty = ([], [])
+        self.assertEqual(primitives.time_in_state(empty), 0)
+        self.assertIsNone(primitives.state_ratio(empty))
+        self.assertIsNone(primitives.time_weighted_average(empty))
+        self.assertDictEqual(primitives.state_durations(empty), {})
+
+    def test_04_against_naive_loops(self):
+        for seed in range(5):
+            points = random_points(500, seed)
+            start, end = points[10][0] + 1000, points[-10][0] - 1000
+            segments = list(naive_segments(points, start, end))
+            signal = AnalogSignal(points)
+
+            expected = sum(d for v, d in segments if v > 50)
+            self.assertEqual(primitives.time_above(signal, 50, start, end), expected)
+
+            expected = sum(d * v for v, d in segments) / sum(d for v, d in segments)
+            self.assertAlmostEqual(primitives.time_weighted_average(signal, start, end), expected)
+
+            points = random_points(500, seed, logic=True)
+            signal = LogicSignal(points)
+            segments = list(naive_segments(signal.points, start, end))
+            expected = sum(d for v, d in segments if v)
+            self.assertEqual(primitives.time_in_state(signal, start, end), expected)
+            self.assertEqual(primitives.time_in_state(signal, start, end), signal.integrate(start, end))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy as np
+from evtsignals import AnalogSignal
+
+from pycstbox.performer.commons.resampling import align, HOLD, LINEAR
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+T0 = 1462233600000      # 2016-05-03 00:00 UTC
+MINUTE = 60 * 1000
+
+
+class AlignTestCase(unittest.TestCase):
+    def setUp(self):
+        self.signals = {
+            'a': AnalogSignal([(T0, 1.), (T0 + 10 * MINUTE, 2.)]),
+            'b': AnalogSignal([(T0 + 5 * MINUTE, 10.), (T0 + 15 * MINUTE, 20.)]),
+        }
+
+    def test_01_merged_timeline(self):
+        aligned = align(self.signals, start=T0, end=T0 + 20 * MINUTE)
+        self.assertListEqual(list(aligned.times), [T0, T0 + 5 * MINUTE, T0 + 10 * MINUTE, T0 + 15 * MINUTE])
+        self.assertListEqual(list(aligned['a']), [1., 1., 2., 2.])
+        self.assertTrue(np.isnan(aligned['b'][0]))
+        self.assertListEqual(list(aligned['b'][1:]), [10., 10., 20.])
+        self.assertListEqual(list(aligned.valid()), [False, True, True, True])
+        self.assertListEqual(list(aligned.durations()), [5 * MINUTE] * 4)
+
+    def test_02_regular_grid(self):
+        aligned = align(self.signals, period=300, start=T0, end=T0 + 20 * MINUTE, method=LINEAR)
+        self.assertEqual(len(aligned), 4)
+        self.assertListEqual(list(aligned['a']), [1., 1.5, 2., 2.])
+        self.assertListEqual(list(aligned['b'][1:]), [10., 15., 20.])
+
+    def test_03_gaps(self):
+        aligned = align(self.signals, period=60, start=T0, end=T0 + 20 * MINUTE, method=HOLD, max_gap=240)
+        gaps = aligned.gaps['a']
+        self.assertFalse(gaps[4])
+        self.assertTrue(gaps[5])
+        self.assertFalse(gaps[10])
+
+        aligned = align(self.signals, period=60, start=T0, end=T0 + 20 * MINUTE, method=LINEAR, max_gap=540)
+        self.assertTrue(aligned.gaps['a'][:10].all())
+        self.assertFalse(aligned.gaps['a'][10:].any())
+        self.assertTrue(aligned.gaps['b'][5:15].all())
+
+
+if __name__ == '__main__':
+    unittest.main()
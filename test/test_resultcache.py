@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import time
+import datetime
+import tempfile
+import shutil
+import logging
+
+from pycstbox.performer.commons.analytics import AbstractAnalyzer, AbstractIndicator, PeriodicAnalyzer, TimeFrame
+from pycstbox.performer.commons.resultcache import ResultCache, params_hash
+
+from test_sharding import OccupationAnalyzer, ShardedOccupationAnalyzer
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+DAY = TimeFrame(datetime.datetime(2016, 5, 3), datetime.datetime(2016, 5, 4))
+DAY_EOD = TimeFrame(datetime.datetime(2016, 5, 3), datetime.datetime(2016, 5, 3, 23, 59, 59, 999999))
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_01_params_hash(self):
+        self.assertEqual(params_hash({'a': 1, 'b': [1, 2]}), params_hash({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(params_hash({'a': 1}), params_hash({'a': 2}))
+        # the representation of arbitrary objects is not stable across processes
+        with self.assertRaises(TypeError):
+            params_hash({'a': object()})
+
+    def test_02_get_put(self):
+        cache = ResultCache(self.root)
+        self.assertIs(cache.get('occupation', 'k1', 'shard', DAY), ResultCache.MISS)
+        cache.put('occupation', 'k1', 'shard', DAY, {'on': 1200})
+        cache.put('occupation', 'k1', 'shard', DAY_EOD, None)
+        self.assertDictEqual(cache.get('occupation', 'k1', 'shard', DAY), {'on': 1200})
+        self.assertIsNone(cache.get('occupation', 'k1', 'shard', DAY_EOD))
+        self.assertIs(cache.get('occupation', 'k2', 'shard', DAY), ResultCache.MISS)
+        self.assertIs(cache.get('occupation', 'k1', 'durations', DAY), ResultCache.MISS)
+
+        cache.clear('occupation')
+        self.assertIs(cache.get('occupation', 'k1', 'shard', DAY), ResultCache.MISS)
+
+    def test_03_lru_eviction(self):
+        cache = ResultCache(self.root, max_size=2.5 / 1024)     # room for 2 entries of 1KB
+        frames = [
+            TimeFrame(datetime.datetime(2016, 5, d), datetime.datetime(2016, 5, d + 1)) for d in range(1, 4)
+        ]
+        cache.put('occupation', 'k', 'shard', frames[0], 'x' * 1000)
+        cache.put('occupation', 'k', 'shard', frames[1], 'x' * 1000)
+        # make the first entry the most recently used one
+        old = time.time() - 60
+        os.utime(cache.entry_path('occupation', 'k', 'shard', frames[1]), (old, old))
+        os.utime(cache.entry_path('occupation', 'k', 'shard', frames[0]), (old - 60, old - 60))
+        cache.get('occupation', 'k', 'shard', frames[0])
+
+        cache.put('occupation', 'k', 'shard', frames[2], 'x' * 1000)
+        self.assertIsNot(cache.get('occupation', 'k', 'shard', frames[0]), ResultCache.MISS)
+        self.assertIs(cache.get('occupation', 'k', 'shard', frames[1]), ResultCache.MISS)
+        self.assertIsNot(cache.get('occupation', 'k', 'shard', frames[2]), ResultCache.MISS)
+        self.assertLessEqual(cache.size(), 2.5 * 1024)
+
+
+class CountingAnalyzer(ShardedOccupationAnalyzer):
+    loaded = []
+
+    def load_inputs(self, time_frame):
+        self.loaded.append(time_frame.start)
+        return super(CountingAnalyzer, self).load_inputs(time_frame)
+
+
+class CachedShardsTestCase(unittest.TestCase):
+    indicator = AbstractIndicator('occupation', 'occupation', 'occupation')
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        AbstractAnalyzer.configure_result_cache(self.root)
+        CountingAnalyzer.loaded = []
+
+    def tearDown(self):
+        AbstractAnalyzer.configure_result_cache(None)
+        shutil.rmtree(self.root)
+
+    def _run(self, analyzer_class, period, computation_date):
+        analyzer = analyzer_class(self.indicator, period, computation_date, shard_workers=1)
+        analyzer.run()
+        return analyzer.stored
+
+    def test_01_overlapping_periods(self):
+        # month of May, then week from May 16 to 22 (Sunday)
+        month = datetime.datetime(2016, 6, 1)
+        week = datetime.datetime(2016, 5, 23)
+
+        self._run(CountingAnalyzer, PeriodicAnalyzer.PERIOD_MONTH, month)
+        self.assertEqual(len(CountingAnalyzer.loaded), 31)
+
+        CountingAnalyzer.loaded = []
+        result = self._run(CountingAnalyzer, PeriodicAnalyzer.PERIOD_WEEK, week)
+        # all the days of the week have been computed by the month job
+        self.assertListEqual(CountingAnalyzer.loaded, [])
+
+        AbstractAnalyzer.configure_result_cache(None)
+        self.assertDictEqual(result, self._run(OccupationAnalyzer, PeriodicAnalyzer.PERIOD_WEEK, week))
+
+    def test_02_rerun_and_day(self):
+        month = datetime.datetime(2016, 6, 1)
+        result = self._run(CountingAnalyzer, PeriodicAnalyzer.PERIOD_MONTH, month)
+        self.assertEqual(len(CountingAnalyzer.loaded), 31)
+
+        CountingAnalyzer.loaded = []
+        self.assertDictEqual(self._run(CountingAnalyzer, PeriodicAnalyzer.PERIOD_MONTH, month), result)
+        self.assertListEqual(CountingAnalyzer.loaded, [])
+
+        # the day job of May 31 shares the last day shard of the month job
+        self._run(CountingAnalyzer, PeriodicAnalyzer.PERIOD_DAY, month)
+        self.assertListEqual(CountingAnalyzer.loaded, [])
+
+        AbstractAnalyzer.configure_result_cache(None)
+        self.assertDictEqual(result, self._run(OccupationAnalyzer, PeriodicAnalyzer.PERIOD_MONTH, month))
+
+    def test_03_unstable_params(self):
+        indicator = AbstractIndicator('occupation', 'occupation', 'occupation')
+        indicator.logger = logging.getLogger('occupation')
+        for _ in range(2):
+            analyzer = CountingAnalyzer(indicator, PeriodicAnalyzer.PERIOD_WEEK, datetime.datetime(2016, 5, 23))
+            analyzer.shard_workers = 1
+            analyzer.run()
+        self.assertEqual(len(CountingAnalyzer.loaded), 14)
+        self.assertFalse(os.listdir(self.root))
+
+
+if __name__ == '__main__':
+    unittest.main()
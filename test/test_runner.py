@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import time
+import os
+import shutil
+import tempfile
+
+from pycstbox.performer.commons.runner import Runner, AnalyzerSpec
+from pycstbox.performer.commons.analytics import PeriodicAnalyzer, AnalyzerError, AbstractIndicator
+from pycstbox.performer.commons.metrics import run_metrics
+from pycstbox.performer.commons.memory import MemoryBudget
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+
+class SleepingAnalyzer(object):
+    """ Fake analyzer which only waits for a given time before failing or succeeding """
+    def __init__(self, indicator, period, computation_date, logger=None, duration=0, fail=False, spill=False):
+        self.duration = duration
+        self.fail = fail
+        self.spill = spill
+
+    def run(self, outputs_timestamp=None):
+        if self.spill:
+            MemoryBudget().area.new_file()
+        time.sleep(self.duration)
+        if self.fail:
+            raise AnalyzerError('failed on purpose')
+
+
+def make_spec(name, timeout=None, **params):
+    return AnalyzerSpec(SleepingAnalyzer, params, AbstractIndicator(name, name, name), 0, timeout)
+
+
+class ExecutionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.runner = Runner(config_path='/dev/null', period=PeriodicAnalyzer.PERIOD_DAY)
+        self.spill_dir, MemoryBudget.spill_dir = MemoryBudget.spill_dir, tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(MemoryBudget.spill_dir)
+        MemoryBudget.spill_dir = self.spill_dir
+
+    def test_01_no_budget(self):
+        self.runner.execute_analyzers([make_spec('a'), make_spec('b', duration=0.1)])
+        counters = dict(run_metrics.indicators())['b']['counters']
+        self.assertEqual(counters['peak_rss_bytes'], 0)
+        self.assertGreaterEqual(counters['rss_peak_growth_bytes'], 0)
+
+    def test_02_within_budget(self):
+        self.runner.execute_analyzers([make_spec('a', timeout=5, duration=0.1)])
+        self.assertTrue(dict(run_metrics.indicators())['a']['counters']['peak_rss_bytes'])
+
+    def test_03_timeout(self):
+        t0 = time.time()
+        with self.assertRaises(AnalyzerError) as cm:
+            self.runner.execute_analyzers([
+                make_spec('slow', timeout=0.5, duration=30, spill=True),
+                make_spec('fast', timeout=5)
+            ])
+        self.assertLess(time.time() - t0, 10)
+        self.assertIn('with 1 error(s)', cm.exception.message)
+        # the data spilled by the cancelled analyzer are removed
+        self.assertListEqual(os.listdir(MemoryBudget.spill_dir), [])
+
+    def test_04_error_in_process(self):
+        with self.assertRaises(AnalyzerError) as cm:
+            self.runner.execute_analyzers([make_spec('a', timeout=5, fail=True)])
+        self.assertIn('with 1 error(s)', cm.exception.message)
+
+    def test_05_run_deadline(self):
+        self.runner.run_deadline = 0.5
+        with self.assertRaises(AnalyzerError) as cm:
+            self.runner.execute_analyzers([
+                make_spec('a', duration=30),
+                make_spec('b'),
+                make_spec('c'),
+            ])
+        self.assertIn('3 indicator(s) computation completed with 3 error(s)', cm.exception.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
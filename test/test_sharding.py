@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import datetime
+import random
+import tempfile
+import shutil
+
+from evtsignals import LogicSignal
+from evtsignals.base import to_milliseconds
+
+from pycstbox.performer.commons.analytics import PeriodicAnalyzer, AbstractIndicator, ShardTimeFrame
+from pycstbox.performer.commons.data import DataAccessMixin
+from pycstbox.performer.commons.daycache import DayCache
+from pycstbox.performer.commons import primitives
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+COMPUTATION_DATE = datetime.datetime(2016, 6, 1, 12)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _make_points():
+    rnd = random.Random(0)
+    t = datetime.datetime(2016, 4, 25)
+    points = []
+    state = False
+    while t < datetime.datetime(2016, 6, 2):
+        next_t = t + datetime.timedelta(minutes=rnd.randint(1, 240))
+        # some changes occur exactly at midnight, on the boundary of the day shards
+        if next_t.date() != t.date() and rnd.random() < 0.5:
+            next_t = datetime.datetime.combine(next_t.date(), datetime.time())
+        t = next_t
+        state = not state
+        points.append((t, state))
+    return points
+
+POINTS = _make_points()
+
+
+class OccupationAnalyzer(PeriodicAnalyzer):
+    """ Computes the time while the signal is on, with or without sharding """
+    Indicator = AbstractIndicator
+
+    def __init__(self, indicator, period, computation_date, **kwargs):
+        super(OccupationAnalyzer, self).__init__('test', indicator, period, computation_date, **kwargs)
+        self.stored = None
+
+    def load_inputs(self, time_frame):
+        # previous point included, so that the state at the start of the frame is known
+        points = [p for p in POINTS if p[0] < time_frame.end or p[0] == time_frame.end and not time_frame.end_excluded]
+        first = max(0, len([p for p in points if p[0] < time_frame.start]) - 1)
+        points = points[first:]
+        return {'occupied': LogicSignal(points)} if points else None
+
+    def create_outputs(self):
+        return ['on_time', 'changes']
+
+    def process_inputs(self, inputs):
+        # up to the next midnight, as the day shards
+        occupied, start, end = inputs['occupied'], self.time_frame.start, self.time_frame.end + ONE_MICROSECOND
+        self.set_output('on_time', primitives.time_in_state(occupied, start, end))
+        self.set_output('changes', primitives.transitions_count(occupied, start, end, rising=False))
+
+    def store_single_point_outputs(self, timestamp=None):
+        self.stored = dict(self._outputs)
+
+
+class ShardedOccupationAnalyzer(OccupationAnalyzer):
+    def process_shard(self, inputs, time_frame):
+        occupied, start, end = inputs['occupied'], time_frame.start, time_frame.end
+        return (
+            primitives.time_in_state(occupied, start, end),
+            primitives.transitions_count(occupied, start, end, rising=False)
+        )
+
+    def merge_shards(self, result1, result2):
+        return result1[0] + result2[0], result1[1] + result2[1]
+
+    def finalize_shards(self, result):
+        self.set_output('on_time', result[0])
+        self.set_output('changes', result[1])
+
+
+class ArchivedOccupationAnalyzer(DataAccessMixin, OccupationAnalyzer):
+    """ Extracts its inputs from an archive, seeded as the shards """
+    def load_inputs(self, time_frame):
+        time_frame = ShardTimeFrame(time_frame.start, time_frame.end, seed_lookback=self.shard_seed_lookback)
+        return self.extract_signals(time_frame, {'occupied': LogicSignal}) or None
+
+
+class ShardedArchivedOccupationAnalyzer(DataAccessMixin, ShardedOccupationAnalyzer):
+    def load_inputs(self, time_frame):
+        return self.extract_signals(time_frame, {'occupied': LogicSignal}) or None
+
+
+class ShardingTestCase(unittest.TestCase):
+    indicator = AbstractIndicator('occupation', 'occupation', 'occupation')
+
+    def _run(self, analyzer_class, period, **kwargs):
+        analyzer = analyzer_class(self.indicator, period, COMPUTATION_DATE, **kwargs)
+        analyzer.run()
+        return analyzer.stored
+
+    def test_01_split(self):
+        analyzer = ShardedOccupationAnalyzer(self.indicator, PeriodicAnalyzer.PERIOD_MONTH, COMPUTATION_DATE)
+        shards = analyzer.split_time_frame()
+        self.assertEqual(len(shards), 31)
+        self.assertEqual(shards[0].start, analyzer.time_frame.start)
+        self.assertEqual(shards[-1].end, analyzer.time_frame.end + ONE_MICROSECOND)
+        self.assertTrue(all(tf.end_excluded and tf.seed_lookback for tf in shards))
+
+        # the day shard is the same as in the month
+        analyzer = ShardedOccupationAnalyzer(self.indicator, PeriodicAnalyzer.PERIOD_DAY, COMPUTATION_DATE)
+        day_shards = analyzer.split_time_frame()
+        self.assertEqual(len(day_shards), 1)
+        self.assertEqual(vars(day_shards[0]), vars(shards[-1]))
+        self.assertFalse(OccupationAnalyzer(
+            self.indicator, PeriodicAnalyzer.PERIOD_DAY, COMPUTATION_DATE
+        ).supports_sharding)
+
+    def test_02_same_results(self):
+        self.assertIn(datetime.time(), [p[0].time() for p in POINTS])
+        for period in (PeriodicAnalyzer.PERIOD_WEEK, PeriodicAnalyzer.PERIOD_MONTH):
+            expected = self._run(OccupationAnalyzer, period)
+            self.assertTrue(expected['on_time'])
+            self.assertDictEqual(self._run(ShardedOccupationAnalyzer, period, shard_workers=1), expected)
+            self.assertDictEqual(self._run(ShardedOccupationAnalyzer, period, shard_workers=3), expected)
+
+    def test_03_extracted_inputs(self):
+        root = tempfile.mkdtemp()
+        try:
+            archive = DayCache(root)
+            days = {}
+            for t, state in POINTS:
+                times, values = days.setdefault(t.date(), ([], []))
+                times.append(to_milliseconds(t))
+                values.append(float(state))
+            for day, columns in days.iteritems():
+                archive.store(day, {'occupied': columns})
+            DataAccessMixin.event_source_config = {'backend': 'archive', 'path': root}
+
+            # the shards end exclusion and seeding make the results match the ones of the whole period
+            for period in (PeriodicAnalyzer.PERIOD_WEEK, PeriodicAnalyzer.PERIOD_MONTH):
+                expected = self._run(ArchivedOccupationAnalyzer, period)
+                self.assertTrue(expected['changes'])
+                self.assertDictEqual(self._run(ShardedArchivedOccupationAnalyzer, period, shard_workers=1), expected)
+        finally:
+            DataAccessMixin.event_source_config = None
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    unittest.main()
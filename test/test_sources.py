@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import datetime
+import tempfile
+import shutil
+
+from pycstbox.performer.commons.analytics import TimeFrame, ShardTimeFrame
+from pycstbox.performer.commons.daycache import DayCache
+from pycstbox.performer.commons.sources import get_event_source, ArchiveEventSource, export_archive
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+DAY1 = datetime.date(2016, 5, 3)
+DAY2 = datetime.date(2016, 5, 4)
+T0 = 1462233600000      # DAY1 00:00 UTC
+HOUR = 3600 * 1000
+
+
+class ArchiveSourceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.archive_path = self.root + '/archive'
+        archive = DayCache(self.archive_path)
+        archive.store(DAY1, {
+            'temp': ([T0 + 8 * HOUR, T0 + 20 * HOUR], [20., 21.]),
+            'window': ([T0 + 9 * HOUR], [1.]),
+        })
+        archive.store(DAY2, {
+            'temp': ([T0 + 30 * HOUR], [22.]),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_01_backend_selection(self):
+        self.assertIsInstance(get_event_source('archive', path=self.archive_path), ArchiveEventSource)
+        self.assertIsInstance(
+            get_event_source('pycstbox.performer.commons.sources.ArchiveEventSource', path=self.archive_path),
+            ArchiveEventSource
+        )
+        with self.assertRaises(ValueError):
+            get_event_source('foo')
+
+    def test_02_scan(self):
+        source = get_event_source('archive', path=self.archive_path)
+        chunks = list(source.scan(
+            TimeFrame(datetime.datetime(2016, 5, 3, 12), datetime.datetime(2016, 5, 4, 23)), ['temp']
+        ))
+        self.assertListEqual(
+            [(name, list(ts), list(values)) for name, ts, values in chunks],
+            [('temp', [T0 + 20 * HOUR], [21.]), ('temp', [T0 + 30 * HOUR], [22.])]
+        )
+
+    def test_03_excluded_end(self):
+        source = get_event_source('archive', path=self.archive_path)
+        # the event at the end of the frame belongs to the next one
+        frame = ShardTimeFrame(datetime.datetime(2016, 5, 3, 8), datetime.datetime(2016, 5, 3, 20), end_excluded=True)
+        self.assertListEqual(
+            [(name, list(ts)) for name, ts, values in source.scan(frame, ['temp'])], [('temp', [T0 + 8 * HOUR])]
+        )
+
+    def test_04_export(self):
+        source = get_event_source('archive', path=self.archive_path)
+        export_path = self.root + '/export'
+        self.assertEqual(export_archive(source, export_path, DAY1, DAY2), 2)
+
+        exported = DayCache(export_path)
+        self.assertSetEqual(set(exported.variables(DAY1)), {'temp', 'window'})
+        columns = exported.load(DAY1, ['temp'])
+        self.assertListEqual(list(columns['temp'].slice()[1]), [20., 21.])
+        columns['temp'].close()
+
+
+if __name__ == '__main__':
+    unittest.main()
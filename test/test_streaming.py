@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import datetime
+import tempfile
+import shutil
+
+from pycstbox.performer.commons.analytics import PeriodicAnalyzer, AbstractIndicator
+from pycstbox.performer.commons.data import DataAccessMixin
+from pycstbox.performer.commons.daycache import DayCache
+from pycstbox.performer.commons.streaming import StateStore, StreamTracker
+from pycstbox import log
+
+__author__ = 'Eric Pascual - CSTB (eric.pascual@cstb.fr)'
+
+DAY = datetime.date(2016, 5, 3)
+T0 = 1462233600000      # DAY 00:00 UTC
+HOUR = 3600 * 1000
+COMPUTATION_DATE = datetime.datetime(2016, 5, 4, 1)
+
+ARCHIVED = {
+    'temp': ([T0 + 2 * HOUR, T0 + 8 * HOUR, T0 + 20 * HOUR], [19., 20., 24.]),
+    'window': ([T0 + 9 * HOUR], [1.]),
+}
+
+
+class PointsList(list):
+    """ Plain points list, to compare exact values """
+    def add_point(self, ts, value, auto_cast=True):
+        self.append((ts, value))
+
+
+class TemperatureAnalyzer(DataAccessMixin, PeriodicAnalyzer):
+    """ Computes the mean and max of the temperature events """
+    Indicator = AbstractIndicator
+
+    def __init__(self, indicator, period, computation_date, **kwargs):
+        super(TemperatureAnalyzer, self).__init__('test', indicator, period, computation_date, **kwargs)
+        self.stored = None
+        self.batch_loaded = False
+
+    def load_inputs(self, time_frame):
+        self.batch_loaded = True
+        return self.extract_signals(time_frame, {'temp': PointsList})
+
+    def create_outputs(self):
+        return ['mean', 'max']
+
+    def process_inputs(self, inputs):
+        state = self.init_stream_state()
+        for ts, value in inputs['temp']:
+            state = self.update_stream_state(state, 'temp', ts, value)
+        self.finalize_stream_state(state)
+
+    def stream_variables(self):
+        return ['temp', 'rh']
+
+    def init_stream_state(self):
+        return 0, 0., None
+
+    def update_stream_state(self, state, var_name, timestamp, value):
+        if var_name != 'temp':
+            return state
+        count, total, max_value = state
+        return count + 1, total + value, max(max_value, value)
+
+    def finalize_stream_state(self, state):
+        count, total, max_value = state
+        self.set_output('mean', total / count)
+        self.set_output('max', max_value)
+
+    def store_single_point_outputs(self, timestamp=None):
+        self.stored = dict(self._outputs)
+
+
+class StreamingTestCase(unittest.TestCase):
+    indicator = AbstractIndicator('temperature', 'temperature', 'temperature')
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        DayCache(self.root + '/archive').store(DAY, ARCHIVED)
+        TemperatureAnalyzer.event_source_config = {'backend': 'archive', 'path': self.root + '/archive'}
+        TemperatureAnalyzer.stream_state_dir = self.root + '/state'
+        self.store = StateStore(TemperatureAnalyzer.stream_state_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _make_analyzer(self, at=None):
+        # analyzers work on the period before their computation date
+        computation_date = at + datetime.timedelta(days=1) if at and at.date() > DAY else COMPUTATION_DATE
+        return TemperatureAnalyzer(self.indicator, PeriodicAnalyzer.PERIOD_DAY, computation_date)
+
+    def test_01_batch_fallback(self):
+        analyzer = self._make_analyzer()
+        self.assertTrue(analyzer.supports_streaming)
+        analyzer.run()
+        self.assertTrue(analyzer.batch_loaded)
+        self.assertDictEqual(analyzer.stored, {'mean': 21., 'max': 24.})
+
+    def test_02_catch_up_and_live_events(self):
+        tracker = StreamTracker(self._make_analyzer, self.store, log.getLogger('test'))
+        # started mid-day : the morning events are caught up from the source
+        tracker.start_frame(datetime.datetime(2016, 5, 3, 12))
+        self.assertEqual(tracker.checkpoint.state, (2, 39., 20.))
+
+        # live events, including one already accounted for, one of an untracked variable, and one older than
+        # the last event of another variable
+        tracker.on_event(T0 + 8 * HOUR, 'temp', 20.)
+        tracker.on_event(T0 + 13 * HOUR, 'window', 0.)
+        tracker.on_event(T0 + 15 * HOUR, 'rh', 40)
+        tracker.on_event(T0 + 14 * HOUR, 'temp', 30)
+        self.assertEqual(tracker.checkpoint.state, (3, 69., 30.))
+        # live values are cast as the caught up ones
+        self.assertIsInstance(tracker.checkpoint.state[2], float)
+        tracker.save()
+
+        # the events missed after the last live one are caught up at finalization
+        analyzer = self._make_analyzer()
+        analyzer.run()
+        self.assertFalse(analyzer.batch_loaded)
+        self.assertDictEqual(analyzer.stored, {'mean': 93. / 4, 'max': 30.})
+        self.assertIsNone(self.store.load(self.indicator.name, analyzer.time_frame))
+
+    def test_03_resume(self):
+        tracker = StreamTracker(self._make_analyzer, self.store, log.getLogger('test'))
+        tracker.start_frame(datetime.datetime(2016, 5, 3, 12))
+        tracker.on_event(T0 + 14 * HOUR, 'temp', 30.)
+        tracker.on_event(T0 + 21 * HOUR, 'rh', 40.)
+        tracker.save()
+
+        tracker = StreamTracker(self._make_analyzer, self.store, log.getLogger('test'))
+        tracker.start_frame(datetime.datetime(2016, 5, 3, 23))
+        self.assertEqual(tracker.checkpoint.state, (4, 93., 30.))
+
+    def test_04_roll_over_consumed(self):
+        tracker = StreamTracker(self._make_analyzer, self.store, log.getLogger('test'))
+        tracker.start_frame(datetime.datetime(2016, 5, 3, 23))
+        analyzer = self._make_analyzer()
+        analyzer.run()
+        self.assertFalse(analyzer.batch_loaded)
+        self.assertTrue(self.store.is_consumed(self.indicator.name, analyzer.time_frame))
+
+        # the period computed by the periodic analyzer is not saved again when rolling over
+        tracker.roll_over(datetime.datetime(2016, 5, 4, 0, 5))
+        self.assertIsNone(self.store.load(self.indicator.name, analyzer.time_frame))
+        # and its marker is not needed anymore
+        self.assertFalse(self.store.is_consumed(self.indicator.name, analyzer.time_frame))
+        self.assertIsNotNone(self.store.load(self.indicator.name, tracker.analyzer.time_frame))
+
+
+if __name__ == '__main__':
+    unittest.main()